@@ -0,0 +1,567 @@
+# ann_index.py — FAISS の近似最近傍（ANN）インデックス（embed.py / build_index.py / dense_index.py 共通）
+#
+# ANN_INDEX で種類を選ぶ:
+#   flat     : IndexFlatIP（厳密。既定）
+#   ivf_flat : IVF（nlist 個のクラスタのうち nprobe 個だけ見る）+ 生ベクトル
+#   ivf_pq   : IVF + 直積量子化（1 ベクトル ANN_PQ_M バイト）
+#   hnsw     : HNSW グラフ（efSearch で精度と速度を調整）
+# ANN_CODEC でベクトルの持ち方を選ぶ（1536 次元なら 1 件あたり）:
+#   flat 6KB（float32, 既定） / fp16 3KB / int8 1.5KB / pq ANN_PQ_M バイト
+#   flat 以外は元の float32 を <faiss.index>.raw.npy（ラベル昇順, mmap）に残し、
+#   上位 k × ANN_RERANK 件を圧縮したまま探してから元ベクトルで正確に並べ直す
+# ANN_REDUCE で次元を減らす（pca / rp = ランダム射影, 次元は ANN_REDUCE_DIM）:
+#   学習した射影行列はインデックス（IndexPreTransform）の中に保存され、検索時のクエリにも同じ射影がかかる
+#   次元を減らしたときも元ベクトルを残して並べ直す
+#
+# - 学習（IVF のクラスタ・PQ の符号帳）は最大 ANN_TRAIN_SAMPLE 件の無作為サンプルで行う
+# - 検索パラメータ（nprobe / efSearch）と構築条件は <faiss.index>.ann.json に保存し、読む側も同じ値で検索する
+#   （環境変数 ANN_NPROBE / ANN_EF_SEARCH が明示されていればそちらを優先）
+# - ラベル（embed.py の sha1 由来 int64 / build_index.py の位置）で add / remove / reconstruct できる
+#     IVF はラベルをそのまま持ち、直接マップ（ハッシュ表）で reconstruct / remove する
+#     Flat / HNSW は IndexIDMap2 で包む。HNSW は削除できないので、削除時は残りのベクトルで組み直す
+#     （組み直し・種類の変換は元ベクトルがあればそれを使うので、圧縮しても精度は落ちない）
+#
+# python ann_index.py bench … 今の faiss.index のベクトルで各種類の recall@k（厳密解比）と p50/p95 遅延を測る
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+import numpy as np
+import faiss
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+KINDS = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+CODECS = ("flat", "fp16", "int8", "pq")
+ANN_INDEX = os.getenv("ANN_INDEX", "flat").lower()
+ANN_CODEC = os.getenv("ANN_CODEC", "flat").lower()
+REDUCERS = ("pca", "rp")
+ANN_REDUCE = os.getenv("ANN_REDUCE", "").lower()
+ANN_REDUCE_DIM = int(os.getenv("ANN_REDUCE_DIM", "256"))
+DEFAULT_REDUCE = f"{ANN_REDUCE}:{ANN_REDUCE_DIM}" if ANN_REDUCE else ""  # "pca:256" など。空 = 減らさない
+ANN_RERANK = int(os.getenv("ANN_RERANK", "4"))  # 圧縮時に k の何倍を元ベクトルで並べ直すか（1 以下で無効）
+ANN_REPORT_QUERIES = int(os.getenv("ANN_REPORT_QUERIES", "200"))
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))  # 0 = 件数から自動（約 4√n）
+ANN_PQ_M = int(os.getenv("ANN_PQ_M", "0"))  # 0 = 次元の約数で 64 以下・次元/4 以下の最大値
+ANN_PQ_NBITS = int(os.getenv("ANN_PQ_NBITS", "8"))
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+ANN_EF_CONSTRUCTION = int(os.getenv("ANN_EF_CONSTRUCTION", "200"))
+ANN_TRAIN_SAMPLE = int(os.getenv("ANN_TRAIN_SAMPLE", "100000"))
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+
+
+def _env_int(name: str) -> Optional[int]:
+    v = os.getenv(name)
+    return int(v) if v else None
+
+
+def params_path(index_path: str) -> str:
+    return f"{index_path}.ann.json"
+
+
+def read_params(index_path: str) -> Dict[str, Any]:
+    p = params_path(index_path)
+    if not os.path.exists(p):
+        return {"kind": "flat"}
+    with open(p, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def auto_nlist(n: int) -> int:
+    # クラスタあたり 39 件以上（faiss の学習の目安）を保てる範囲で約 4√n
+    return int(min(max(4 * np.sqrt(n), 1), n // 39))
+
+
+def auto_pq_m(dim: int) -> int:
+    return max(m for m in range(1, min(64, max(dim // 4, 1)) + 1) if dim % m == 0)
+
+
+def target(kind: str = ANN_INDEX, codec: str = ANN_CODEC, reduce: str = DEFAULT_REDUCE) -> Tuple[str, str, str]:
+    """(種類, 持ち方, 次元削減) を正規化する（ivf_pq = IVF + pq）。"""
+    if kind not in KINDS:
+        raise ValueError(f"ANN_INDEX は {', '.join(KINDS)} のいずれかです: {kind}")
+    if codec not in CODECS:
+        raise ValueError(f"ANN_CODEC は {', '.join(CODECS)} のいずれかです: {codec}")
+    if reduce and reduce.split(":")[0] not in REDUCERS:
+        raise ValueError(f"ANN_REDUCE は {', '.join(REDUCERS)} のいずれかです: {reduce}")
+    if kind == "ivf_pq" or (kind == "ivf_flat" and codec == "pq"):
+        return "ivf_pq", "pq", reduce
+    return kind, codec, reduce
+
+
+def spec(p: Dict[str, Any]) -> Tuple[str, str, str]:
+    return p.get("kind", "flat"), p.get("codec", "flat"), p.get("reduce", "")
+
+
+def lossy(p: Dict[str, Any]) -> bool:
+    """元ベクトルと内積が変わる持ち方か（圧縮・次元削減）。"""
+    return p.get("codec", "flat") != "flat" or bool(p.get("reduce"))
+
+
+def plan(kind: str, dim: int, n: int, codec: str = ANN_CODEC, reduce: str = DEFAULT_REDUCE) -> Dict[str, Any]:
+    """種類・持ち方・次元削減と件数から構築条件を決める（学習に件数が足りないときは落とす）。"""
+    kind, codec, reduce = target(kind, codec, reduce)
+    p: Dict[str, Any] = {"kind": kind, "codec": codec, "dim": dim}
+    if reduce:
+        out = int(reduce.split(":")[1])
+        if out >= dim or (reduce.startswith("pca") and n < out):
+            logger.warning("ann: %d 次元・%d 件では %s に減らせないので元の次元のまま作ります", dim, n, reduce)
+        else:
+            p["reduce"] = reduce
+            dim = out  # 以降（PQ の分割数など）は減らした後の次元で決める
+    if codec == "pq" and n < (1 << ANN_PQ_NBITS):
+        logger.warning("ann: %d 件では PQ を学習できないので float32 のまま持ちます", n)
+        p["kind"], p["codec"] = ("flat" if kind == "ivf_pq" else kind), "flat"
+        kind, codec = p["kind"], p["codec"]
+    if kind in ("ivf_flat", "ivf_pq"):
+        nlist = ANN_NLIST or auto_nlist(n)
+        if nlist < 8 or n < nlist:
+            logger.warning("ann: %d 件では %s を学習できないので flat で作ります", n, kind)
+            return plan("flat", p["dim"], n, codec, reduce)
+        p["nlist"] = nlist
+        p["nprobe"] = min(_env_int("ANN_NPROBE") or DEFAULT_NPROBE, nlist)
+    elif kind == "hnsw":
+        p["hnsw_m"] = ANN_HNSW_M
+        p["ef_construction"] = ANN_EF_CONSTRUCTION
+        p["ef_search"] = _env_int("ANN_EF_SEARCH") or DEFAULT_EF_SEARCH
+    if codec == "pq":
+        p["pq_m"] = ANN_PQ_M or auto_pq_m(dim)
+        p["pq_nbits"] = 8 if kind == "hnsw" else ANN_PQ_NBITS  # HNSW の PQ は 8 ビット固定
+    return p
+
+
+def factory_string(p: Dict[str, Any]) -> str:
+    kind, codec = p["kind"], p.get("codec", "flat")
+    if codec == "pq":
+        storage = f"PQ{p['pq_m']}" if kind == "hnsw" else f"PQ{p['pq_m']}x{p['pq_nbits']}"
+    else:
+        storage = {"flat": "Flat", "fp16": "SQfp16", "int8": "SQ8"}[codec]
+    prefix = ""
+    if p.get("reduce"):
+        method, out = p["reduce"].split(":")
+        prefix = f"PCA{out}," if method == "pca" else f"RR{out},"
+    if kind in ("ivf_flat", "ivf_pq"):
+        return f"{prefix}IVF{p['nlist']},{storage}"
+    if kind == "hnsw":
+        return f"{prefix}HNSW{p['hnsw_m']},{storage}"
+    return prefix + storage
+
+
+def new_index(p: Dict[str, Any]):
+    """構築条件 p どおりの空インデックス（未学習のことがある）。ラベルで add_with_ids できる形で返す。"""
+    index = faiss.index_factory(p["dim"], factory_string(p), faiss.METRIC_INNER_PRODUCT)
+    if p["kind"].startswith("ivf"):
+        return index  # ラベル付き追加は IVF 自身が対応。直接マップは学習後に付ける
+    if p["kind"] == "hnsw":
+        _inner(index).hnsw.efConstruction = p["ef_construction"]
+    return faiss.IndexIDMap2(index)
+
+
+def apply_params(index, p: Dict[str, Any]) -> None:
+    """検索パラメータを反映する（環境変数で明示されていればそちらを優先）。"""
+    kind = p.get("kind", "flat")
+    ps = faiss.ParameterSpace()
+    if kind.startswith("ivf"):
+        ps.set_index_parameter(index, "nprobe", _env_int("ANN_NPROBE") or p.get("nprobe", DEFAULT_NPROBE))
+    elif kind == "hnsw":
+        ps.set_index_parameter(index, "efSearch", _env_int("ANN_EF_SEARCH") or p.get("ef_search", DEFAULT_EF_SEARCH))
+
+
+def build(X: np.ndarray, labels: np.ndarray, kind: str = ANN_INDEX, codec: str = ANN_CODEC,
+          reduce: str = DEFAULT_REDUCE) -> Tuple[Any, Dict[str, Any]]:
+    """ベクトル X（正規化済み）とラベルから学習・追加まで済ませたインデックスを作る。"""
+    X = np.ascontiguousarray(X, dtype="float32")
+    p = plan(kind, X.shape[1], len(X), codec, reduce)
+    index = new_index(p)
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        sample = X if len(X) <= ANN_TRAIN_SAMPLE else X[np.sort(rng.choice(len(X), ANN_TRAIN_SAMPLE, replace=False))]
+        t0 = time.perf_counter()
+        index.train(sample)
+        p["trained_on"] = len(sample)
+        logger.info("ann: %s を %d 件で学習しました（%.1fs）", factory_string(p), len(sample), time.perf_counter() - t0)
+    if p["kind"].startswith("ivf"):
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    if len(X):
+        index.add_with_ids(X, np.asarray(labels, dtype=np.int64))
+    apply_params(index, p)
+    return index, p
+
+
+def labels_of(index) -> np.ndarray:
+    """インデックスに入っている全ラベル。"""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    ivf = faiss.extract_index_ivf(index)
+    inv = ivf.invlists
+    parts = [faiss.rev_swig_ptr(inv.get_ids(l), inv.list_size(l)).copy()
+             for l in range(inv.nlist) if inv.list_size(l)]
+    return np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+
+
+class RawVectors:
+    """圧縮したインデックスの元ベクトル（float32, ラベル昇順）。再ランキングと作り直しにだけ使う。"""
+
+    def __init__(self, ids: np.ndarray, X: np.ndarray, path: Optional[str] = None):
+        self.ids = ids
+        self.X = X
+        self.path = path  # open() で開いたファイル（書き戻し不要の判定用）
+
+    @classmethod
+    def from_unsorted(cls, ids: np.ndarray, X: np.ndarray) -> "RawVectors":
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+        return cls(ids[order], np.ascontiguousarray(np.asarray(X, dtype="float32")[order]))
+
+    @classmethod
+    def of_index(cls, index) -> "RawVectors":
+        return cls.from_unsorted(*all_vectors(index))
+
+    @staticmethod
+    def paths(index_path: str) -> Tuple[str, str]:
+        return f"{index_path}.raw.npy", f"{index_path}.raw_ids.npy"
+
+    @classmethod
+    def open(cls, index_path: str) -> Optional["RawVectors"]:
+        xp, ip = cls.paths(index_path)
+        if not (os.path.exists(xp) and os.path.exists(ip)):
+            return None
+        return cls(np.load(ip, mmap_mode="r"), np.load(xp, mmap_mode="r"), path=os.path.abspath(index_path))
+
+    @classmethod
+    def drop(cls, index_path: str) -> None:
+        for f in cls.paths(index_path):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def write(self, index_path: str) -> None:
+        if self.path == os.path.abspath(index_path):
+            return
+        for f, arr in zip(self.paths(index_path), (self.X, self.ids)):
+            np.save(f"{f}.tmp.npy", arr)
+            os.replace(f"{f}.tmp.npy", f)
+
+    def get(self, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(ベクトル, 見つかったか)。見つからないラベルの行は 0。"""
+        labels = np.asarray(labels, dtype=np.int64)
+        V = np.zeros((len(labels), self.X.shape[1]), dtype="float32")
+        if not len(self.ids):
+            return V, np.zeros(len(labels), dtype=bool)
+        pos = np.searchsorted(self.ids, labels).clip(max=len(self.ids) - 1)
+        hit = self.ids[pos] == labels
+        V[hit] = self.X[pos[hit]]
+        return V, hit
+
+    def updated(self, remove: Sequence[int], add_ids: np.ndarray, add_X: np.ndarray) -> "RawVectors":
+        """remove を除き add を加えた新しい組（メモリ上。write で書き出す）。"""
+        drop = np.concatenate([np.asarray(remove, dtype=np.int64), np.asarray(add_ids, dtype=np.int64)])
+        keep = ~np.isin(self.ids, drop)
+        return RawVectors.from_unsorted(np.concatenate([self.ids[keep], add_ids]),
+                                        np.concatenate([self.X[keep], np.asarray(add_X, dtype="float32")]))
+
+
+def all_vectors(index, raw: Optional[RawVectors] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """(ラベル, ベクトル)。元ベクトルが無い圧縮インデックスでは復元値（近似）になる。"""
+    if raw is not None:
+        return np.asarray(raw.ids), np.asarray(raw.X)
+    labels = labels_of(index)
+    if not len(labels):
+        return labels, np.zeros((0, index.d), dtype="float32")
+    return labels, index.reconstruct_batch(labels)
+
+
+def _pretransform(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else faiss.downcast_index(index)
+    return inner if isinstance(inner, faiss.IndexPreTransform) else None
+
+
+def _inner(index):
+    """IDMap・次元削減を外した本体。"""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexPreTransform):
+        inner = faiss.downcast_index(inner.index)
+    return inner
+
+
+def reduce_of(index) -> str:
+    pt = _pretransform(index)
+    if pt is None:
+        return ""
+    vt = faiss.downcast_VectorTransform(pt.chain.at(0))
+    return f"{'pca' if isinstance(vt, faiss.PCAMatrix) else 'rp'}:{vt.d_out}"
+
+
+def kind_of(index) -> str:
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def codec_of(index) -> str:
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    return "flat"
+
+
+def search(index, Q: np.ndarray, k: int, raw: Optional[RawVectors] = None,
+           rerank: int = ANN_RERANK) -> Tuple[np.ndarray, np.ndarray]:
+    """index.search と同じ (sims, labels)。raw があれば k × rerank 件を元ベクトルの内積で並べ直す。"""
+    Q = np.ascontiguousarray(Q, dtype="float32")
+    if raw is None or rerank <= 1:
+        return index.search(Q, k)
+    _, cand = index.search(Q, k * rerank)
+    sims = np.full((len(Q), k), -np.inf, dtype="float32")
+    labels = np.full((len(Q), k), -1, dtype=np.int64)
+    for i, c in enumerate(cand):
+        c = c[c != -1]
+        V, hit = raw.get(c)
+        c, s = c[hit], V[hit] @ Q[i]
+        top = np.argsort(-s, kind="stable")[:k]
+        sims[i, :len(top)], labels[i, :len(top)] = s[top], c[top]
+    return sims, labels
+
+
+def remove(index, labels: Sequence[int], p: Dict[str, Any], raw: Optional[RawVectors] = None):
+    """ラベルで削除する。削除できない種類（HNSW）は残りのベクトルで組み直す（戻り値を使うこと）。"""
+    labels = np.asarray(labels, dtype=np.int64)
+    if not len(labels):
+        return index
+    if p.get("kind") != "hnsw":
+        index.remove_ids(labels)
+        return index
+    keep, V = all_vectors(index, raw)
+    alive = ~np.isin(keep, labels)
+    rebuilt = faiss.clone_index(index)  # 学習済みの射影・量子化器はそのまま使う
+    rebuilt.reset()
+    if alive.any():
+        rebuilt.add_with_ids(V[alive], keep[alive])
+    apply_params(rebuilt, p)
+    logger.info("ann: hnsw を %d 件で組み直しました（削除 %d 件）", int(alive.sum()), len(keep) - int(alive.sum()))
+    return rebuilt
+
+
+def load(index_path: str) -> Tuple[Any, Dict[str, Any]]:
+    """書き込み用に読み込む（構築条件も返す。検索パラメータは反映済み）。"""
+    index = faiss.read_index(index_path)
+    p = read_params(index_path)
+    kind, codec, reduce = kind_of(index), codec_of(index), reduce_of(index)
+    if spec(p) != (kind, codec, reduce):
+        # 構築条件ファイルが無い・古いとき（build_index.py の旧形式など）は中身から読み取る
+        p = {"kind": kind, "codec": codec, "dim": index.d}
+        if reduce:
+            p["reduce"] = reduce
+        if kind.startswith("ivf"):
+            ivf = faiss.extract_index_ivf(index)
+            p.update(nlist=ivf.nlist, nprobe=ivf.nprobe)
+        elif kind == "hnsw":
+            h = _inner(index).hnsw
+            p.update(hnsw_m=ANN_HNSW_M, ef_construction=h.efConstruction, ef_search=h.efSearch)
+        if codec == "pq":
+            inner = _inner(index)
+            pq = faiss.downcast_index(inner.storage).pq if kind == "hnsw" else inner.pq
+            p.update(pq_m=pq.M, pq_nbits=pq.nbits)
+    if kind == "flat" and not isinstance(index, faiss.IndexIDMap):
+        # ラベル無しの IndexFlatIP（位置 = ラベル）は IndexIDMap2 に移し替える
+        flat = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+        if index.ntotal:
+            flat.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype=np.int64))
+        index = flat
+    apply_params(index, p)
+    return index, p
+
+
+def convert(index, p: Dict[str, Any], kind: str = ANN_INDEX, codec: str = ANN_CODEC, reduce: str = DEFAULT_REDUCE,
+            retrain: bool = False, raw: Optional[RawVectors] = None) -> Tuple[Any, Dict[str, Any]]:
+    """種類・持ち方・次元削減が違えば（retrain なら常に）、入っているベクトルで学習し直して作り直す（埋め込みは呼ばない）。"""
+    want = target(kind, codec, reduce)
+    if spec(p) == want and not retrain:
+        return index, p
+    if lossy(p) and raw is None:
+        logger.warning("ann: 元ベクトルが無いので、圧縮・次元削減したベクトルの復元値（近似）で作り直します")
+    labels, V = all_vectors(index, raw)
+    logger.info("ann: %s → %s に作り直します（%d 件）", factory_string(p), "/".join(filter(None, want)), len(labels))
+    return build(V, labels, *want)
+
+
+def save(index, p: Dict[str, Any], index_path: str, raw: Optional[RawVectors] = None) -> None:
+    """インデックスと構築条件（<index>.ann.json）を一時ファイル経由で書き出す。
+    圧縮しているときは元ベクトルも（インデックスより先に）書き出し、圧縮していなければ消す。"""
+    if lossy(p) and raw is not None:
+        raw.write(index_path)
+    elif not lossy(p):
+        RawVectors.drop(index_path)
+    tmp = f"{index_path}.tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, index_path)
+    meta = dict(p, ntotal=int(index.ntotal), factory=factory_string(p), ts=time.time())
+    with open(params_path(index_path) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(params_path(index_path) + ".tmp", params_path(index_path))
+
+
+def _exact_topk(X: np.ndarray, labels: np.ndarray, Q: np.ndarray, k: int, chunk: int = 65536) -> np.ndarray:
+    """元ベクトルでの厳密な上位 k 件のラベル（X は mmap でもよい。行をまとめて読む）。"""
+    best_s = np.full((len(Q), 0), -np.inf, dtype="float32")
+    best_l = np.zeros((len(Q), 0), dtype=np.int64)
+    for s in range(0, len(X), chunk):
+        S = np.concatenate([best_s, Q @ np.asarray(X[s:s + chunk]).T], axis=1)
+        L = np.concatenate([best_l, np.broadcast_to(labels[s:s + chunk], (len(Q), min(chunk, len(X) - s)))], axis=1)
+        top = np.argsort(-S, axis=1, kind="stable")[:, :k]
+        best_s, best_l = np.take_along_axis(S, top, 1), np.take_along_axis(L, top, 1)
+    return best_l
+
+
+def _recall(got: np.ndarray, truth: np.ndarray, k: int) -> float:
+    return float(np.mean([len(np.intersect1d(g[g != -1], t)) / k for g, t in zip(got, truth)]))
+
+
+def report(index_path: str, index, p: Dict[str, Any], raw: Optional[RawVectors] = None, k: int = 10,
+           n_queries: int = ANN_REPORT_QUERIES) -> Dict[str, Any]:
+    """保存したインデックスのサイズと recall@k（圧縮時は並べ直し前後）を求めて表示する。"""
+    labels, X = all_vectors(index, raw)
+    n, d = len(labels), p["dim"]
+    out: Dict[str, Any] = {"factory": factory_string(p), "vectors": n,
+                           "index_mb": round(os.path.getsize(index_path) / 1e6, 1),
+                           "float32_mb": round(n * d * 4 / 1e6, 1)}
+    out["bytes_per_vector"] = round(os.path.getsize(index_path) / max(n, 1), 1)
+    if raw is not None and lossy(p):
+        out["raw_mb"] = round(os.path.getsize(RawVectors.paths(index_path)[0]) / 1e6, 1)
+    if n and n_queries > 0:
+        Q = _queries(X, n_queries, 0.5, np.random.default_rng(0))
+        truth = _exact_topk(X, labels, Q, k)
+        out[f"recall@{k}"] = round(_recall(index.search(Q, k)[1], truth, k), 4)
+        if raw is not None and lossy(p) and ANN_RERANK > 1:
+            out[f"recall@{k}_rerank"] = round(_recall(search(index, Q, k, raw)[1], truth, k), 4)
+    print(f"[ann] {out['factory']}: {n} 件, index={out['index_mb']}MB ({out['bytes_per_vector']} B/件, "
+          f"float32 なら {out['float32_mb']}MB)"
+          + (f", 元ベクトル={out['raw_mb']}MB（ディスク）" if "raw_mb" in out else "")
+          + (f", recall@{k}={out[f'recall@{k}']}" if f"recall@{k}" in out else "")
+          + (f" → 並べ直し後 {out[f'recall@{k}_rerank']}" if f"recall@{k}_rerank" in out else ""))
+    return out
+
+
+# -----------------------------------------------------------------------------
+# ベンチマーク: recall@k（Flat の厳密解との一致率）と 1 クエリずつの遅延
+# -----------------------------------------------------------------------------
+def _queries(X: np.ndarray, n: int, noise: float, rng) -> np.ndarray:
+    # 実クエリが無いときは、文書ベクトルに雑音を足したものを「言い換えた質問」の代わりに使う
+    Q = X[rng.choice(len(X), min(n, len(X)), replace=False)].copy()
+    Q += rng.standard_normal(Q.shape).astype("float32") * (noise / np.sqrt(X.shape[1]))
+    faiss.normalize_L2(Q)
+    return Q
+
+
+def _run(index, Q: np.ndarray, k: int, raw: Optional[RawVectors] = None) -> Tuple[np.ndarray, np.ndarray]:
+    lat = np.empty(len(Q))
+    out = np.empty((len(Q), k), dtype=np.int64)
+    for i in range(len(Q)):
+        t0 = time.perf_counter()
+        _, out[i] = search(index, Q[i:i + 1], k, raw)
+        lat[i] = time.perf_counter() - t0
+    return out, lat
+
+
+def bench(index_path: str, k: int = 10, n_queries: int = 500, kinds: Sequence[str] = KINDS,
+          nprobes: Sequence[int] = (1, 4, 16, 64), ef_searches: Sequence[int] = (16, 32, 64, 128, 256),
+          queries: Optional[str] = None, noise: float = 0.5, codecs: Sequence[str] = ("flat",),
+          reduces: Sequence[str] = ("",)) -> List[Dict[str, Any]]:
+    index, p = load(index_path)
+    labels, X = all_vectors(index, RawVectors.open(index_path))
+    if not len(X):
+        raise ValueError(f"ベクトルがありません: {index_path}")
+    rng = np.random.default_rng(0)
+    Q = np.load(queries).astype("float32") if queries else _queries(X, n_queries, noise, rng)
+    print(f"[bench] vectors={len(X)} dim={X.shape[1]} queries={len(Q)} k={k} (source={factory_string(p)})")
+
+    # 正解は常に元の次元・float32 での厳密な上位 k 件
+    truth = _exact_topk(X, labels, Q, k)
+    rows: List[Dict[str, Any]] = []
+    done = set()
+    for kind, codec, reduce in ((a, c, r) for a in kinds for c in codecs for r in reduces):
+        want = target(kind, codec, reduce)
+        if want in done:
+            continue
+        done.add(want)
+        t0 = time.perf_counter()
+        idx, q = build(X, labels, *want)
+        build_sec = time.perf_counter() - t0
+        if spec(q) != want:
+            print(f"[bench] {'/'.join(filter(None, want))}: 件数・次元が足りないので省略")
+            continue
+        # 圧縮・次元削減したものは元ベクトルでの並べ直しあり（ANN_RERANK 倍）で測る。並べ直し前の recall も出す
+        raw = RawVectors.from_unsorted(labels, X) if lossy(q) and ANN_RERANK > 1 else None
+        if kind.startswith("ivf"):
+            sweep = [("nprobe", v) for v in nprobes if v <= q["nlist"]]
+        elif kind == "hnsw":
+            sweep = [("efSearch", v) for v in ef_searches]
+        else:
+            sweep = [(None, None)]
+        size_mb = len(faiss.serialize_index(idx)) / 1e6
+        for name, v in sweep:
+            if name:
+                faiss.ParameterSpace().set_index_parameter(idx, name, v)
+            got, lat = _run(idx, Q, k, raw)
+            recall = _recall(got, truth, k)
+            row = {"kind": q["kind"], "codec": q["codec"], "reduce": q.get("reduce", ""), "factory": factory_string(q),
+                   "param": f"{name}={v}" if name else "-", f"recall@{k}": round(recall, 4),
+                   "p50_ms": round(float(np.percentile(lat, 50)) * 1e3, 3),
+                   "p95_ms": round(float(np.percentile(lat, 95)) * 1e3, 3),
+                   "build_sec": round(build_sec, 2), "size_mb": round(size_mb, 1)}
+            if raw is not None:
+                row[f"recall@{k}_no_rerank"] = round(_recall(idx.search(Q, k)[1], truth, k), 4)
+            rows.append(row)
+            print(f"[bench] {row['factory']:<30} {row['param']:<12} recall@{k}={recall:.4f} "
+                  + (f"(並べ直し前 {row[f'recall@{k}_no_rerank']:.4f}) " if raw is not None else "")
+                  + f"p50={row['p50_ms']:.3f}ms p95={row['p95_ms']:.3f}ms build={build_sec:.1f}s size={size_mb:.1f}MB")
+    return rows
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="FAISS ANN インデックスの recall / 遅延ベンチマーク")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("bench", help="recall@k（Flat 比）と p50/p95 遅延を種類・パラメータごとに測る")
+    b.add_argument("--index", default="data/db/faiss.index")
+    b.add_argument("--k", type=int, default=10)
+    b.add_argument("--queries", default=None, help="クエリベクトル（.npy, 正規化済み）。省略時は文書ベクトル + 雑音")
+    b.add_argument("--n-queries", type=int, default=500)
+    b.add_argument("--noise", type=float, default=0.5)
+    b.add_argument("--kinds", default=",".join(KINDS))
+    b.add_argument("--codecs", default="flat", help=f"ベクトルの持ち方（{','.join(CODECS)} から複数指定可）")
+    b.add_argument("--reduce", default="none", help="次元削減（none, pca:256, rp:384 など複数指定可）")
+    b.add_argument("--nprobe", default="1,4,16,64")
+    b.add_argument("--ef-search", default="16,32,64,128,256")
+    b.add_argument("--out", default=None, help="結果を JSON で保存")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    rows = bench(args.index, k=args.k, n_queries=args.n_queries, kinds=args.kinds.split(","),
+                 nprobes=[int(x) for x in args.nprobe.split(",")],
+                 ef_searches=[int(x) for x in args.ef_search.split(",")],
+                 queries=args.queries, noise=args.noise, codecs=args.codecs.split(","),
+                 reduces=["" if r == "none" else r for r in args.reduce.split(",")])
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,225 @@
+# bm25_engine.py — 転置インデックス版 BM25（rank_bm25.BM25Okapi 互換スコア + MaxScore top-k）
+
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class InvertedBM25:
+    """BM25Okapi と同じ式・同じ IDF 下限（epsilon * 平均IDF）で採点する転置インデックス。
+
+    - 語は整数 ID（``vocab``）に置き換え、ポスティングは語ごとに doc_id 昇順で
+      ``indptr`` / ``doc_ids`` / ``impacts`` の CSR 形式で持つ。
+    - ``impacts`` には tf と文書長から求めた BM25 寄与（IDF 込み）を前計算しておく。
+    - ``get_scores`` は BM25Okapi.get_scores の置き換え（全文書のスコア配列）。
+    - ``top_k`` は語ごとの最大寄与を上限に使う MaxScore で上位 k 件だけを求める。
+    """
+
+    def __init__(
+        self,
+        corpus: Iterable[Sequence[str]],
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        # 1) 語の整数化とポスティング素材の収集（語 ID は初出順 = BM25Okapi の nd と同じ順）
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        tfs: List[int] = []
+        doc_len: List[int] = []
+        for d, tokens in enumerate(corpus):
+            doc_len.append(len(tokens))
+            for tok, tf in Counter(tokens).items():
+                tid = vocab.get(tok)
+                if tid is None:
+                    tid = vocab[tok] = len(vocab)
+                term_ids.append(tid)
+                doc_ids.append(d)
+                tfs.append(tf)
+
+        self._build(
+            vocab,
+            np.asarray(term_ids, dtype=np.int64),
+            np.asarray(doc_ids, dtype=np.int32),
+            np.asarray(tfs, dtype=np.float64),
+            np.asarray(doc_len, dtype=np.int64),
+        )
+
+    @classmethod
+    def from_token_ids(
+        cls,
+        ids: np.ndarray,
+        offsets: np.ndarray,
+        vocab: Dict[str, int],
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        idf: Optional[np.ndarray] = None,
+        avgdl: Optional[float] = None,
+    ) -> "InvertedBM25":
+        """tokenizer.encode_corpus の (ids, offsets, vocab) から NumPy だけで構築する（大規模コーパス用）。
+
+        idf（語 ID 順）と avgdl を渡すと、このコーパス自身ではなく外部の統計で採点する
+        （segmented_index の差分セグメントを本体と同じ尺度にするため）。
+        """
+        self = cls.__new__(cls)
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+        n_docs, n_terms = len(offsets) - 1, max(len(vocab), 1)
+        doc_len = np.diff(offsets).astype(np.int64)
+        # (文書, 語) を 1 つの整数キーにして数える → 文書昇順・語昇順に並んだ tf が得られる
+        doc_of = np.repeat(np.arange(n_docs, dtype=np.int64), doc_len)
+        keys, tf = np.unique(doc_of * n_terms + np.asarray(ids, dtype=np.int64), return_counts=True)
+        self._build(
+            vocab,
+            keys % n_terms,
+            (keys // n_terms).astype(np.int32),
+            tf.astype(np.float64),
+            doc_len,
+            idf=idf,
+            avgdl=avgdl,
+        )
+        return self
+
+    def _build(self, vocab, term_ids: np.ndarray, doc_ids: np.ndarray, tf: np.ndarray, doc_len: np.ndarray,
+               idf: Optional[np.ndarray] = None, avgdl: Optional[float] = None):
+        self.vocab = vocab
+        self.corpus_size = len(doc_len)
+        self.doc_len = doc_len
+        if avgdl is None:
+            avgdl = float(doc_len.sum()) / self.corpus_size if self.corpus_size else 0.0
+        self.avgdl = avgdl
+
+        # 2) 語 ID → doc_id 昇順に並べ替え（doc_id は収集時点で昇順なので安定ソートで足りる）
+        order = np.argsort(term_ids, kind="stable")
+        n_terms = len(vocab)
+        df = np.bincount(term_ids, minlength=n_terms)
+        self.indptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=self.indptr[1:])
+        self.doc_ids = doc_ids[order]
+        tf = tf[order]
+
+        # 3) IDF（BM25Okapi._calc_idf と同じ計算順で、負の IDF は eps * 平均IDF に置換）
+        self.idf = self._calc_idf(df.tolist()) if idf is None else np.asarray(idf, dtype=np.float64)
+
+        # 4) 寄与の前計算と、語ごとの上限（MaxScore 用）
+        self.impacts = self._impacts(tf, self.idf, self.doc_len[self.doc_ids])
+        self.max_impact = np.zeros(n_terms, dtype=np.float64)
+        if len(self.impacts):
+            nonempty = df > 0
+            self.max_impact[nonempty] = np.maximum.reduceat(self.impacts, self.indptr[:-1][nonempty])
+
+    @classmethod
+    def from_arrays(
+        cls,
+        vocab,
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        impacts: np.ndarray,
+        max_impact: np.ndarray,
+        idf: np.ndarray,
+        doc_len: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+    ) -> "InvertedBM25":
+        """構築済みの配列（スナップショットの mmap など）からそのまま組み立てる。
+
+        vocab は ``get(term) -> Optional[int]`` を持つものなら dict でなくてもよい。
+        """
+        self = cls.__new__(cls)
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+        self.vocab = vocab
+        self.indptr, self.doc_ids, self.impacts = indptr, doc_ids, impacts
+        self.max_impact, self.idf, self.doc_len = max_impact, idf, doc_len
+        self.corpus_size = len(doc_len)
+        self.avgdl = float(np.sum(doc_len)) / self.corpus_size if self.corpus_size else 0.0
+        return self
+
+    # ------------------------------------------------------------------ build
+    def _calc_idf(self, df: List[int]) -> np.ndarray:
+        n = self.corpus_size
+        idf = [math.log(n - f + 0.5) - math.log(f + 0.5) for f in df]
+        if idf:
+            eps = self.epsilon * (sum(idf) / len(idf))
+            idf = [eps if v < 0 else v for v in idf]
+        return np.asarray(idf, dtype=np.float64)
+
+    def _impacts(self, tf: np.ndarray, idf: np.ndarray, dl: np.ndarray) -> np.ndarray:
+        if not len(tf):
+            return np.zeros(0, dtype=np.float64)
+        term_of = np.repeat(np.arange(len(idf)), np.diff(self.indptr))
+        k1, b = self.k1, self.b
+        return idf[term_of] * (tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / self.avgdl)))
+
+    # ------------------------------------------------------------------ query
+    def _postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        s, e = self.indptr[tid], self.indptr[tid + 1]
+        return self.doc_ids[s:e], self.impacts[s:e]
+
+    def get_scores(self, query: Sequence[str]) -> np.ndarray:
+        """BM25Okapi.get_scores と同じ値（クエリ語の重複も同じく加算）を返す。"""
+        score = np.zeros(self.corpus_size, dtype=np.float64)
+        for q in query:
+            tid = self.vocab.get(q)
+            if tid is None:
+                continue
+            d, imp = self._postings(tid)
+            score[d] += imp
+        return score
+
+    def top_k(self, query: Sequence[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """クエリ語を含む文書のうち上位 k 件を (doc_ids, scores) で返す（スコア降順）。
+
+        上限寄与の大きい語から順に加算し、残りの語の上限合計が k 位のスコアを
+        下回った時点で新規文書の受け入れを止め、以降は候補文書だけを二分探索で更新する。
+        """
+        terms: Counter = Counter()
+        for q in query:
+            tid = self.vocab.get(q)
+            if tid is not None:
+                terms[tid] += 1
+        if not terms or k <= 0 or not self.corpus_size:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        plan = sorted(terms.items(), key=lambda x: max(self.max_impact[x[0]] * x[1], 0.0), reverse=True)
+        # 寄与が負になり得る（eps < 0）小さなコーパスでも上限として成り立つよう 0 で下支えする
+        bounds = [max(self.max_impact[tid] * w, 0.0) for tid, w in plan]
+        rest = np.cumsum(bounds[::-1])[::-1].tolist() + [0.0]  # rest[i] = 語 i 以降の上限合計
+
+        # 候補（昇順の doc id）とその累積スコアだけを持つ（コーパス全体の配列は作らない）
+        cand = np.zeros(0, dtype=np.int64)
+        acc = np.zeros(0, dtype=np.float64)
+        accepting = True  # 新規文書を受け入れる間は postings の和集合で累積する
+        theta = 0.0
+        for i, (tid, w) in enumerate(plan):
+            d, imp = self._postings(tid)
+            if accepting:
+                cand, inv = np.unique(np.concatenate([cand, d]), return_inverse=True)
+                acc = np.bincount(inv, weights=np.concatenate([acc, imp * w]), minlength=len(cand))
+                if len(cand) >= k:
+                    theta = float(np.partition(acc, len(cand) - k)[len(cand) - k])
+                    accepting = rest[i + 1] >= theta
+            else:
+                pos = np.searchsorted(d, cand)
+                hit = pos < len(d)
+                hit[hit] = d[pos[hit]] == cand[hit]
+                acc[hit] += imp[pos[hit]] * w
+                theta = float(np.partition(acc, len(cand) - k)[len(cand) - k])
+            if not accepting:
+                # 上限を足しても k 位に届かない候補は落とす
+                keep = acc + rest[i + 1] >= theta
+                cand, acc = cand[keep], acc[keep]
+
+        scores = acc
+        if len(cand) > k:
+            part = np.argpartition(-scores, k - 1)[:k]
+            cand, scores = cand[part], scores[part]
+        order = np.argsort(-scores, kind="stable")
+        return cand[order].astype(np.int64), scores[order]
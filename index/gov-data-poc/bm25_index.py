@@ -1,30 +1,15 @@
 # bm25_index.py
-import json, re, pickle
+import json, pickle
 from pathlib import Path
 from typing import List, Dict, Tuple
 
+from tokenizer import tokenize
+
 DB = Path("data/db")
 TEXTS = DB / "texts.json"
 BM25_PKL = DB / "bm25.pkl"
 BM25_META = DB / "bm25_meta.json"
 
-JA_RE = re.compile(r"[ぁ-んァ-ン一-龥]+")
-
-def ja_bigrams(s: str) -> List[str]:
-    return [s[i:i+2] for i in range(len(s)-1)] if len(s) >= 2 else ([s] if s else [])
-
-def tokenize(text: str) -> List[str]:
-    text = (text or "").lower()
-    toks: List[str] = []
-    pos = 0
-    for m in JA_RE.finditer(text):
-        chunk = text[pos:m.start()]
-        toks += re.findall(r"[a-z0-9]+", chunk)
-        toks += ja_bigrams(m.group())
-        pos = m.end()
-    toks += re.findall(r"[a-z0-9]+", text[pos:])
-    return toks
-
 def load_texts() -> List[Dict]:
     data = json.loads(TEXTS.read_text(encoding="utf-8-sig"))
     if isinstance(data, dict):
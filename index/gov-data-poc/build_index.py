@@ -4,6 +4,10 @@ import os, json, time
 import numpy as np
 import faiss
 
+import ann_index
+import embed_cache
+from embed_client import EmbeddingClient
+
 DATA = Path("data/db")
 TEXTS_JSON = DATA / "texts.json"
 INDEX_PATH = DATA / "faiss.index"
@@ -36,28 +40,30 @@ def read_texts(path: Path):
             })
     return norm
 
-def embed_texts(texts):
+def _encode(texts):
     # OpenAI か SBERT かを自動判定
     if MODEL.startswith("text-embedding-"):
-        from openai import OpenAI
-        client = OpenAI()
-        # 分割して投げる（大きいとき用）
-        BATCH = 256
-        vecs = []
-        for s in range(0, len(texts), BATCH):
-            batch = [t["text"] for t in texts[s:s+BATCH]]
-            r = client.embeddings.create(model=MODEL, input=batch)
-            vecs.extend([d.embedding for d in r.data])
-        arr = np.array(vecs, dtype="float32")
+        # 256 件ずつ並行に投げる（レート制限・再試行は embed_client）
+        arr = EmbeddingClient(MODEL, batch=256).embed(texts)
     else:
-        from sentence_transformers import SentenceTransformer
-        model = SentenceTransformer(MODEL)
-        arr = model.encode([t["text"] for t in texts], show_progress_bar=True)
-        arr = np.asarray(arr, dtype="float32")
+        # 長さでまとめたトークン予算のバッチ（local_encoder）
+        from local_encoder import LocalEncoder
+        enc = LocalEncoder(MODEL)
+        arr = enc.encode(texts)
+        enc.close()
+        print(f"[info] local encode: {enc.last}")
     # cosine用に正規化
     faiss.normalize_L2(arr)
     return arr
 
+def embed_texts(texts):
+    # 埋め込みキャッシュにある本文は再計算しない（無いものだけ _encode に回す。モデルもその時だけ読む）
+    arr = embed_cache.cached(_encode, MODEL)([t["text"] for t in texts])
+    cache = embed_cache.get_cache()
+    if cache is not None:
+        print(f"[info] embed cache: hit={cache.hits} miss={cache.misses}")
+    return arr
+
 def main():
     DATA.mkdir(parents=True, exist_ok=True)
     assert TEXTS_JSON.exists(), f"{TEXTS_JSON} がありません。"
@@ -71,16 +77,21 @@ def main():
     if X.shape[1] != DIM:
         raise ValueError(f"次元不一致: EMBED_DIM={DIM}, 実ベクトル次元={X.shape[1]}")
 
-    index = faiss.IndexFlatIP(DIM)
-    index.add(X)
+    # 種類は ANN_INDEX、持ち方は ANN_CODEC、次元削減は ANN_REDUCE（ラベル = items の位置なので id_map.json は従来どおり配列）
+    labels = np.arange(len(X), dtype=np.int64)
+    index, params = ann_index.build(X, labels)
+    params["embed_model"] = MODEL  # dense_index が検索側の EMBED_MODEL と照合する
+    print(f"[info] ann={ann_index.factory_string(params)}")
 
-    # 書き出し
-    faiss.write_index(index, str(INDEX_PATH))
+    # 書き出し（圧縮・次元削減したときは元ベクトルも faiss.index.raw.npy に）
+    raw = ann_index.RawVectors(labels, X)
+    ann_index.save(index, params, str(INDEX_PATH), raw)
+    ann_index.report(str(INDEX_PATH), index, params, raw)
     ID_MAP.write_text(json.dumps([it["id"] for it in items], ensure_ascii=False, indent=2), encoding="utf-8")
     DOC_MAP.write_text(json.dumps(
         {i: {"title": it["title"], "source_url": it.get("source_url"), "source_path": it.get("source_path")}
          for i, it in enumerate(items)}, ensure_ascii=False, indent=2), encoding="utf-8")
-    META.write_text(json.dumps({"ntotal": int(index.ntotal), "dim": DIM, "ts": time.time()},
+    META.write_text(json.dumps({"ntotal": int(index.ntotal), "dim": DIM, "ann": params, "ts": time.time()},
                                ensure_ascii=False, indent=2), encoding="utf-8")
 
     print(f"[ok] wrote: {INDEX_PATH}")
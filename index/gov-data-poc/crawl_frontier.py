@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# crawl_frontier.py  (crawler.py のディスク上のフロンティア：取得待ちキュー + 既出 URL 集合 + ドメインごとの取得数)
+#
+#   - SQLite 1 ファイル（既定 data/meta/frontier.sqlite）。URL が数十万件あってもメモリには載せない
+#   - 既出集合は URL の sha1 先頭 8 バイト（符号付き int64）を INTEGER PRIMARY KEY にした表（1 件 ≒ 十数バイト）
+#   - 取り出しは priority の小さい順 → 入れた順（同じ優先度なら幅優先）
+#   - 取り出した URL は「取得中」、終わったら（manifest にコミットした後）「済」。checkpoint() で「済」の行を消す。
+#     途中で落ちたら resume() で「取得中」だけを待ちに戻して続きから取れる
+import hashlib, sqlite3, struct
+from pathlib import Path
+from typing import Iterable, Optional, Set, Tuple
+
+PENDING, INFLIGHT, DONE = 0, 1, 2
+
+def url_key(url: str) -> int:
+    return struct.unpack(">q", hashlib.sha1(url.encode("utf-8")).digest()[:8])[0]
+
+class Frontier:
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(str(path), isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS seen (h INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS queue (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL, dom TEXT NOT NULL, depth INTEGER NOT NULL,
+                priority REAL NOT NULL, state INTEGER NOT NULL DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS queue_next ON queue(state, priority, seq);
+            CREATE TABLE IF NOT EXISTS domains (dom TEXT PRIMARY KEY, fetched INTEGER NOT NULL);
+        """)
+
+    def reset(self):
+        """新しいクロール（前回の続きではない）。"""
+        self.conn.executescript("DELETE FROM seen; DELETE FROM queue; DELETE FROM domains;")
+
+    def resume(self) -> int:
+        """前回落ちたときの「取得中」を待ちに戻し、待ち件数を返す。"""
+        self.conn.execute("UPDATE queue SET state = ? WHERE state = ?", (PENDING, INFLIGHT))
+        return self.pending()
+
+    def push_many(self, items: Iterable[Tuple[str, str, int, float]]) -> int:
+        """(url, domain, depth, priority) を既出でなければ追加する。追加した件数を返す。"""
+        n = 0
+        self.conn.execute("BEGIN")
+        try:
+            for url, dom, depth, priority in items:
+                if self.conn.execute("INSERT OR IGNORE INTO seen (h) VALUES (?)", (url_key(url),)).rowcount:
+                    self.conn.execute("INSERT INTO queue (url, dom, depth, priority) VALUES (?, ?, ?, ?)",
+                                      (url, dom, depth, priority))
+                    n += 1
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return n
+
+    def pop(self, busy: Set[str] = frozenset()) -> Optional[Tuple[int, str, int]]:
+        """busy のドメインを除いて、次に取る (seq, url, depth)。無ければ None。"""
+        q = "SELECT seq, url, depth FROM queue WHERE state = ?"
+        args: list = [PENDING]
+        if busy:
+            q += f" AND dom NOT IN ({','.join('?' * len(busy))})"
+            args += list(busy)
+        row = self.conn.execute(q + " ORDER BY priority, seq LIMIT 1", args).fetchone()
+        if row is None: return None
+        self.conn.execute("UPDATE queue SET state = ? WHERE seq = ?", (INFLIGHT, row[0]))
+        return row
+
+    def done(self, seq: int):
+        self.conn.execute("UPDATE queue SET state = ? WHERE seq = ?", (DONE, seq))
+
+    def checkpoint(self):
+        """済の行を消す。"""
+        self.conn.execute("DELETE FROM queue WHERE state = ?", (DONE,))
+
+    def fetched(self, dom: str) -> int:
+        row = self.conn.execute("SELECT fetched FROM domains WHERE dom = ?", (dom,)).fetchone()
+        return row[0] if row else 0
+
+    def count_fetch(self, dom: str):
+        self.conn.execute("INSERT INTO domains (dom, fetched) VALUES (?, 1) "
+                          "ON CONFLICT(dom) DO UPDATE SET fetched = fetched + 1", (dom,))
+
+    def pending(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM queue WHERE state = ?", (PENDING,)).fetchone()[0]
+
+    def stats(self) -> dict:
+        seen = self.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+        return {"seen": seen, "pending": self.pending()}
+
+    def close(self):
+        self.conn.close()
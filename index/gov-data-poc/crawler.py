@@ -1,38 +1,56 @@
 # -*- coding: utf-8 -*-
 # crawler.py  (差分検知 + seed自体も保存 + ディレクトリURL対応 + robots無視オプション)
-import argparse, hashlib, os, time, urllib.parse, json
+#   asyncio で全体 CRAWL_CONCURRENCY 本まで同時に取得する。同じドメインへは CRAWL_PER_DOMAIN 本まで、
+#   速さはドメインごとのトークンバケット（DomainLimiter）で決める（ドメインが違えば待たない）。
+#     - 初速は 1/SLEEP req/s。robots.txt の Crawl-delay / Request-rate があればそれを上限にする
+#     - 速く正常に返るドメインは CRAWL_MAX_RATE まで上げ、遅い・5xx が出るドメインは下げる
+#     - 429 / 503 はそのドメインを Retry-After（無ければ指数バックオフ）だけ止めて、速さを半分にする
+#   --seeds はディスク上のフロンティア（crawl_frontier.py）で --depth 段まで幅優先にたどる。
+#   PDF・最近変わったページを先に取る。manifest（manifest_store.py の SQLite）には 1 URL ずつコミットし、
+#   フロンティアの済の行は CHECKPOINT_SEC ごとに消す（落ちても --resume で続きから）
+#   本文は STREAM_CHUNK ずつ data/raw の一時ファイルに書きながら sha256 を取る（メモリに全体を持たない）。
+#   CRAWL_MAX_BYTES を超えたら途中で打ち切る。内容が変わったときだけ一時ファイルを本来の名前に置き換える
+import argparse, asyncio, calendar, hashlib, os, random, time, urllib.parse
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from typing import Iterable, Set, Tuple, List, Dict, Any
 
-import requests
+import httpx
 from bs4 import BeautifulSoup
 from urllib.robotparser import RobotFileParser
 
+import manifest_store
+from crawl_frontier import Frontier
+from manifest_store import ManifestStore
+
 RAW_DIR  = Path("data/raw")
 META_DIR = Path("data/meta")
-MANIFEST = META_DIR / "manifest.json"
+FRONTIER = META_DIR / "frontier.sqlite"
 
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124 Safari/537.36"
 TIMEOUT = 30
 RETRY = 2
-SLEEP = 1.0
+SLEEP = 1.0   # 同じドメインへの初めのリクエスト間隔（秒）
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = float(os.getenv("CRAWL_BACKOFF_MAX", "120"))
+MAX_RATE = float(os.getenv("CRAWL_MAX_RATE", "4"))       # 1 ドメインあたりの上限（req/s）
+MIN_RATE = float(os.getenv("CRAWL_MIN_RATE", "0.05"))
+SLOW_LATENCY = float(os.getenv("CRAWL_SLOW_LATENCY", "2.0"))  # これより遅い応答は混んでいるとみなす
+CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "16"))
+PER_DOMAIN = int(os.getenv("CRAWL_PER_DOMAIN", "1"))
+MAX_BYTES = int(os.getenv("CRAWL_MAX_BYTES", str(200 << 20)))  # 1 ファイルの上限（超えたら取得を打ち切る）
+STREAM_CHUNK = 1 << 16
 
 # 末尾 / も HTML として扱うため "" を許可
 ALLOW_EXT = {".pdf", ".html", ".htm", ""}
 DISALLOW_QUERY = True
 MAX_PER_DOMAIN_DEFAULT = 50
+DEPTH_DEFAULT = 1      # seed から何段たどるか（1 = seed とそこからのリンク。従来と同じ）
+RECENT_DAYS = float(os.getenv("CRAWL_RECENT_DAYS", "7"))       # この日数内に変わったページは先に取る
+CHECKPOINT_SEC = float(os.getenv("CRAWL_CHECKPOINT_SEC", "30"))
+HTML_EXT = {".html", ".htm", ""}
 
 # ---------- utils ----------
-def read_json(p: Path, default):
-    if not p.exists(): return default
-    return json.loads(p.read_text(encoding="utf-8"))
-
-def write_json(p: Path, obj):
-    p.parent.mkdir(parents=True, exist_ok=True)
-    tmp = p.with_suffix(p.suffix + ".tmp")
-    tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(p)
-
 def norm_url(u: str) -> str:
     u = u.strip()
     if not u: return ""
@@ -48,60 +66,129 @@ def url_ext(u: str) -> str:
 def url_domain(u: str) -> str:
     return urllib.parse.urlsplit(u).netloc.lower()
 
-def requests_sesh() -> requests.Session:
-    s = requests.Session()
-    s.headers.update({
-        "User-Agent": UA,
-        "Accept": "text/html,application/pdf;q=0.9,*/*;q=0.8",
-        "Accept-Language": "ja,en;q=0.8",
-    })
-    return s
-
-def load_robots(base: str) -> RobotFileParser:
-    sp = urllib.parse.urlsplit(base)
-    robots = f"{sp.scheme}://{sp.netloc}/robots.txt"
+def parse_robots(status: int, text: str) -> RobotFileParser:
+    # RobotFileParser.read() と同じ扱い（401/403 は全拒否、それ以外の 4xx/5xx は全許可）
     r = RobotFileParser()
-    try:
-        r.set_url(robots); r.read()
-    except Exception:
-        r.parse(["User-agent: *", "Allow: /"])
+    if status in (401, 403):
+        r.disallow_all = True
+    elif status >= 400 or status == 0:
+        r.allow_all = True
+    else:
+        r.parse(text.splitlines())
     return r
 
-# ---------- fetch & save ----------
-def fetch_with_conditional(s: requests.Session, u: str, old: Dict[str,Any] | None):
-    hdr = {}
-    if old:
-        if old.get("etag"): hdr["If-None-Match"] = old["etag"]
-        if old.get("last_modified"): hdr["If-Modified-Since"] = old["last_modified"]
-    code = 0; headers = {}
-    for i in range(RETRY + 1):
+class TooLarge(Exception):
+    pass
+
+async def stream_to(r: httpx.Response, dest: Path, max_bytes: int = MAX_BYTES) -> str:
+    """本文を dest に書きながら sha256 を取る（Content-Length か実際の大きさが max_bytes を超えたら TooLarge）。"""
+    length = r.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise TooLarge(f"Content-Length {length} > {max_bytes}")
+    h = hashlib.sha256(); n = 0
+    with dest.open("wb") as f:
+        async for chunk in r.aiter_bytes(STREAM_CHUNK):
+            n += len(chunk)
+            if n > max_bytes: raise TooLarge(f"{n} bytes > {max_bytes}")
+            h.update(chunk); f.write(chunk)
+    return h.hexdigest()
+
+def retry_after_seconds(value: str | None) -> float | None:
+    """Retry-After（秒数 or HTTP-date）→ 待つ秒数。"""
+    if not value: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff(attempt: int) -> float:
+    # 指数バックオフ + ジッタ（同じドメインの再試行が同時に来ないように）
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+class DomainLimiter:
+    """1 ドメインぶんの礼儀：同時 per_domain 本まで、開始は rate req/s のトークンバケット（溜めは 1 回ぶん）。
+    rate は応答を見て上下する（正常なら 1.1 倍、遅ければ 1/応答時間 まで、5xx・429 なら 0.5 倍）。"""
+    def __init__(self, per_domain: int = PER_DOMAIN, rate: float = 1.0 / SLEEP, max_rate: float = MAX_RATE):
+        self.sem = asyncio.Semaphore(per_domain)
+        self.max_rate = max_rate
+        self.rate = min(rate, max_rate)
+        self.tokens = 1.0
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.errors = 0
+        self._at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def set_robots(self, rp: RobotFileParser):
+        delay = rp.crawl_delay(UA)
+        rr = rp.request_rate(UA)
+        if rr and rr.requests and rr.seconds:
+            delay = max(delay or 0, rr.seconds / rr.requests)
+        if delay:
+            self.max_rate = min(self.max_rate, 1.0 / float(delay))
+            self.rate = min(self.rate, self.max_rate)
+
+    async def __aenter__(self):
+        await self.sem.acquire()
         try:
-            r = s.get(u, headers=hdr, timeout=TIMEOUT, allow_redirects=True)
-            code = r.status_code
-            if code in (200, 304):
-                return code, (r.content if code == 200 else b""), dict(r.headers)
-        except Exception:
-            code = 0
-        time.sleep(0.5 * (i + 1))
-    return code, b"", headers
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(1.0, self.tokens + (now - self._at) * self.rate)
+                    self._at = now
+                    wait = max(self.paused_until - now, (1.0 - self.tokens) / self.rate)
+                    if wait <= 0:
+                        self.tokens -= 1.0
+                        return
+                    await asyncio.sleep(wait)
+        except BaseException:
+            self.sem.release()
+            raise
+
+    async def __aexit__(self, *exc):
+        self.sem.release()
+
+    def observe(self, status: int, latency: float, retry_after: float | None = None, attempt: int = 0):
+        if status in (429, 503):
+            self.throttled += 1
+            pause = retry_after if retry_after is not None else backoff(attempt)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.rate = max(MIN_RATE, self.rate * 0.5)
+        elif status == 0 or status >= 500:
+            self.errors += 1
+            self.rate = max(MIN_RATE, self.rate * 0.5)
+        elif latency >= SLOW_LATENCY:
+            # 遅い応答には応答時間 1 回ぶんの間隔まで下げる（繰り返し掛けて MIN_RATE まで落とさない）
+            self.rate = max(MIN_RATE, min(self.rate, 1.0 / latency))
+        else:
+            self.rate = min(self.max_rate, self.rate * 1.1)
 
-def save_or_decide(url: str, content: bytes, headers: Dict[str,str], old: Dict[str,Any] | None) -> tuple[bool, Path | None, Dict[str,Any]]:
-    """return: (parse_needed, saved_path, new_meta)"""
-    RAW_DIR.mkdir(parents=True, exist_ok=True)
+# ---------- fetch & save ----------
+def raw_path(url: str) -> Path:
     url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:20]
-    ext = url_ext(url) or ".html"
-    path = RAW_DIR / f"{url_hash}{ext}"
-
-    if content:
-        content_hash = hashlib.sha256(content).hexdigest()
+    return RAW_DIR / f"{url_hash}{url_ext(url) or '.html'}"
+
+def save_or_decide(url: str, download: tuple[Path, str] | None, headers: Dict[str,str], old: Dict[str,Any] | None) -> tuple[bool, Path | None, Dict[str,Any]]:
+    """download: 200 のときの (一時ファイル, sha256)、304 なら None。
+    return: (parse_needed, saved_path, new_meta)"""
+    path = raw_path(url)
+    if download:
+        tmp, content_hash = download
     else:
         content_hash = old.get("content_hash") if old else None
 
-    parse_needed = (not old) or (old.get("content_hash") != content_hash)
+    changed = (not old) or (old.get("content_hash") != content_hash)
+    # まだ parse されていない前回の変更は残す
+    parse_needed = changed or bool(old.get("parse_needed"))
 
-    # 書き込みは「変更があった時だけ」上書き
-    if content and parse_needed:
-        path.write_bytes(content)
+    # 書き込みは「変更があった時だけ」上書き（一時ファイルを置き換える。同じ内容なら捨てる）
+    if download:
+        if changed or not path.exists(): tmp.replace(path)
+        else: tmp.unlink()
 
     meta = {
         "url": url,
@@ -112,14 +199,25 @@ def save_or_decide(url: str, content: bytes, headers: Dict[str,str], old: Dict[s
         "etag": headers.get("ETag"),
         "updated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
         "parse_needed": parse_needed,
+        "changed_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()) if changed else old.get("changed_at"),
         "doc_id": (old or {}).get("doc_id")  # parseで更新される
     }
-    return parse_needed, (path if content and parse_needed else None), meta
+    return parse_needed, (path if download and changed else None), meta
 
 # ---------- crawling ----------
 def absolutize(base: str, link: str) -> str:
     return urllib.parse.urljoin(base, link)
 
+def priority(u: str, depth: int, old: Dict[str,Any] | None) -> float:
+    """小さいほど先に取る。基本は深さ（幅優先）。PDF は 1 段、最近変わったページは 0.5 段早める。"""
+    p = float(depth)
+    if url_ext(u) == ".pdf": p -= 1.0
+    changed = (old or {}).get("changed_at")
+    if changed:
+        age = time.time() - calendar.timegm(time.strptime(changed, "%Y-%m-%dT%H:%M:%SZ"))
+        if age < RECENT_DAYS * 86400: p -= 0.5
+    return p
+
 def extract_links(base_url: str, html: bytes) -> List[str]:
     soup = BeautifulSoup(html, "html.parser")
     out=[]
@@ -130,85 +228,207 @@ def extract_links(base_url: str, html: bytes) -> List[str]:
         if url_ext(u) in ALLOW_EXT: out.append(u)
     return out
 
-def crawl_page_for_assets(s: requests.Session, base_url: str, robots: RobotFileParser, ignore_robots: bool) -> Set[str]:
-    code, html, _ = fetch_with_conditional(s, base_url, None)
-    if code != 200: return set()
-    found=set()
-    for u in extract_links(base_url, html):
-        if (not ignore_robots) and (not robots.can_fetch(UA, u)): continue
-        if url_domain(u) != url_domain(base_url): continue
-        if url_ext(u) in ALLOW_EXT: found.add(u)
-    return found
-
-def crawl_and_record(s: requests.Session, u: str, robots: RobotFileParser, ignore_robots: bool, manifest: Dict[str,Any]):
-    if (not ignore_robots) and (not robots.can_fetch(UA, u)):
-        print(f"[deny] robots.txt blocks: {u}"); return
-
-    old = manifest.get(u)
-    code, data, hdr = fetch_with_conditional(s, u, old)
-    if code in (200, 304):
-        parse_needed, saved, meta = save_or_decide(u, data, hdr, old)
-        manifest[u] = meta
-        print(f"[ok] {u} status={code} parse_needed={parse_needed} file={Path(meta['path']).name}")
-    else:
-        print(f"[skip] {u} code={code}")
-
-def bulk_crawl_from_seeds(seeds: Iterable[str], max_per_domain: int, ignore_robots: bool):
-    s = requests_sesh()
-    META_DIR.mkdir(parents=True, exist_ok=True)
-    manifest = read_json(MANIFEST, {})
-
-    robots_cache: dict[str, RobotFileParser] = {}
-    count_by_domain: dict[str, int] = {}
-    candidate: Set[str] = set()
-
-    seeds = [norm_url(u) for u in seeds if u.strip()]
-    for seed in seeds:
-        dom = url_domain(seed)
-        if dom not in robots_cache: robots_cache[dom] = load_robots(seed)
-        rob = robots_cache[dom]
-
-        print(f"[seed] {seed}")
-
-        # seed自体も候補に入れる（.html/.pdf/末尾/）
-        if url_ext(seed) in ALLOW_EXT: candidate.add(seed)
-
-        try:
-            links = crawl_page_for_assets(s, seed, rob, ignore_robots)
-            print(f"  -> found {len(links)} links on seed")
-        except Exception as e:
-            print(f"[warn] seed fetch failed: {seed} : {e}")
-            links=set()
-
-        for u in links:
-            if url_ext(u) in ALLOW_EXT: candidate.add(u)
-        time.sleep(SLEEP)
-
-    fetched=0
-    for u in sorted(candidate):
+class AsyncCrawler:
+    """取得・robots・manifest 記録をまとめた非同期クローラ（manifest はイベントループのスレッドだけが触る）。"""
+    def __init__(self, manifest: ManifestStore, ignore_robots: bool,
+                 concurrency: int = CONCURRENCY, per_domain: int = PER_DOMAIN, rate: float = 1.0 / SLEEP):
+        self.manifest = manifest
+        self.ignore_robots = ignore_robots
+        self.concurrency = concurrency
+        self.per_domain = per_domain
+        self.rate = rate
+        self._sem = asyncio.Semaphore(concurrency)
+        self.limiters: dict[str, DomainLimiter] = {}
+        self._robots: dict[str, asyncio.Task] = {}
+        self.client: httpx.AsyncClient | None = None
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(
+            headers={
+                "User-Agent": UA,
+                "Accept": "text/html,application/pdf;q=0.9,*/*;q=0.8",
+                "Accept-Language": "ja,en;q=0.8",
+            },
+            timeout=TIMEOUT, follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    def limiter(self, dom: str) -> DomainLimiter:
+        if dom not in self.limiters: self.limiters[dom] = DomainLimiter(self.per_domain, self.rate)
+        return self.limiters[dom]
+
+    async def get(self, u: str, headers: Dict[str,str] | None = None, attempt: int = 0,
+                  dest: Path | None = None) -> tuple[httpx.Response, str | None]:
+        """(応答, sha256)。dest を渡すと 200 の本文は dest に流し込み（r.content は読まない）、sha256 を返す。"""
+        # ドメインの順番待ちは全体の枠を取らずに行う（待っている間も他ドメインは進む）
+        lim = self.limiter(url_domain(u))
+        digest = None
+        async with lim:
+            async with self._sem:
+                t0 = time.monotonic()
+                try:
+                    async with self.client.stream("GET", u, headers=headers) as r:
+                        if dest is not None and r.status_code == 200:
+                            digest = await stream_to(r, dest)
+                        else:
+                            await r.aread()
+                except Exception as e:
+                    # 大きすぎて打ち切ったのはサーバのせいではないので速さは変えない
+                    if not isinstance(e, TooLarge): lim.observe(0, time.monotonic() - t0, attempt=attempt)
+                    raise
+        lim.observe(r.status_code, time.monotonic() - t0, retry_after_seconds(r.headers.get("Retry-After")), attempt)
+        return r, digest
+
+    async def robots(self, u: str) -> RobotFileParser:
         dom = url_domain(u)
-        n = count_by_domain.get(dom, 0)
-        if n >= max_per_domain: continue
-        rob = robots_cache.get(dom) or load_robots(u)
-        crawl_and_record(s, u, rob, ignore_robots, manifest)
-        count_by_domain[dom] = n + 1
-        fetched += 1
-        time.sleep(SLEEP)
+        if dom not in self._robots:
+            self._robots[dom] = asyncio.ensure_future(self._load_robots(u))
+        return await self._robots[dom]
 
-    write_json(MANIFEST, manifest)
-    print(f"[done] fetched={fetched} domains={len(count_by_domain)} manifest={MANIFEST}")
+    async def _load_robots(self, base: str) -> RobotFileParser:
+        sp = urllib.parse.urlsplit(base)
+        try:
+            r, _ = await self.get(f"{sp.scheme}://{sp.netloc}/robots.txt")
+            rp = parse_robots(r.status_code, r.text)
+        except Exception:
+            return parse_robots(0, "")
+        self.limiter(url_domain(base)).set_robots(rp)
+        return rp
+
+    async def allowed(self, u: str) -> bool:
+        return self.ignore_robots or (await self.robots(u)).can_fetch(UA, u)
+
+    async def fetch_with_conditional(self, u: str, old: Dict[str,Any] | None):
+        """(status, 200 なら (一時ファイル, sha256), 応答ヘッダ)。大きすぎるときは TooLarge（再試行しない）。"""
+        hdr = {}
+        if old:
+            if old.get("etag"): hdr["If-None-Match"] = old["etag"]
+            if old.get("last_modified"): hdr["If-Modified-Since"] = old["last_modified"]
+        code = 0; headers = {}
+        RAW_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = RAW_DIR / f".{raw_path(u).name}.part"  # 同じ URL を同時には取らないので名前は固定でよい
+        for i in range(RETRY + 1):
+            try:
+                r, digest = await self.get(u, hdr, attempt=i, dest=tmp)
+                code = r.status_code
+                if code == 200:
+                    # httpx.Headers は大文字小文字を区別しない（save_or_decide の .get("ETag") 等）
+                    return code, (tmp, digest), r.headers
+                tmp.unlink(missing_ok=True)
+                if code == 304:
+                    return code, None, r.headers
+                if code < 500 and code != 429:
+                    break  # 404 などは再試行しても同じ
+            except TooLarge:
+                tmp.unlink(missing_ok=True)
+                raise
+            except Exception:
+                tmp.unlink(missing_ok=True)
+                code = 0
+            # Retry-After はドメインの一時停止（DomainLimiter）で待つので、ここは指数バックオフだけ
+            if i < RETRY: await asyncio.sleep(backoff(i))
+        return code, None, headers
+
+    async def record(self, u: str) -> Path | None:
+        """取得して manifest に記録し、保存済みのファイルのパスを返す（取れなければ None）。
+        本文は読まない（リンクをたどるときだけ呼び出し側が読む）。"""
+        old = self.manifest.get(u)
+        try:
+            code, download, hdr = await self.fetch_with_conditional(u, old)
+        except TooLarge as e:
+            print(f"[skip] {u} too large ({e})"); return None
+        if code in (200, 304):
+            parse_needed, saved, meta = save_or_decide(u, download, hdr, old)
+            self.manifest.put(u, meta)
+            print(f"[ok] {u} status={code} parse_needed={parse_needed} file={Path(meta['path']).name}")
+            return Path(meta["path"])
+        print(f"[skip] {u} code={code}")
+        return None
+
+async def _bulk_crawl(frontier: Frontier, max_per_domain: int, max_depth: int, ignore_robots: bool,
+                      manifest: ManifestStore) -> tuple[int, int]:
+    fetched = 0
+    inflight: dict[str, int] = {}
+    async with AsyncCrawler(manifest, ignore_robots) as c:
+        async def visit(seq: int, u: str, depth: int):
+            nonlocal fetched
+            dom = url_domain(u)
+            try:
+                if not await c.allowed(u):
+                    print(f"[deny] robots.txt blocks: {u}"); return
+                frontier.count_fetch(dom); fetched += 1
+                saved = await c.record(u)
+                if saved is not None and depth < max_depth and url_ext(u) in HTML_EXT and saved.exists():
+                    # 同じドメインのリンクだけ次の段へ（既出はフロンティアが捨てる）。本文はここでだけ読む
+                    links = [l for l in extract_links(u, saved.read_bytes()) if url_domain(l) == dom]
+                    n = frontier.push_many((l, dom, depth + 1, priority(l, depth + 1, manifest.get(l))) for l in links)
+                    if n: print(f"  -> depth={depth + 1} +{n} links from {u}")
+            except Exception as e:
+                print(f"[warn] {u} : {e}")
+            finally:
+                inflight[dom] -= 1
+                frontier.done(seq)
+
+        tasks: set = set()
+        last_ckpt = time.monotonic()
+        while True:
+            # ドメインごとに PER_DOMAIN 本まで、全体で CONCURRENCY 本まで取り出す（空いているドメインを優先）
+            while len(tasks) < c.concurrency:
+                busy = {d for d, n in inflight.items() if n >= c.per_domain}
+                item = frontier.pop(busy)
+                if item is None: break
+                seq, u, depth = item
+                dom = url_domain(u)
+                if frontier.fetched(dom) + inflight.get(dom, 0) >= max_per_domain:
+                    frontier.done(seq); continue
+                inflight[dom] = inflight.get(dom, 0) + 1
+                tasks.add(asyncio.ensure_future(visit(seq, u, depth)))
+            if not tasks: break
+            _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if time.monotonic() - last_ckpt >= CHECKPOINT_SEC:
+                frontier.checkpoint()
+                last_ckpt = time.monotonic()
+                print(f"[checkpoint] fetched={fetched} {frontier.stats()}")
+
+        for dom, lim in sorted(c.limiters.items()):
+            print(f"[rate] {dom} {lim.rate:.2f} req/s (max {lim.max_rate:.2f}) throttled={lim.throttled} errors={lim.errors}")
+    return fetched, len(inflight)
+
+def bulk_crawl_from_seeds(seeds: Iterable[str], max_per_domain: int, ignore_robots: bool,
+                          max_depth: int = DEPTH_DEFAULT, resume: bool = False):
+    manifest = manifest_store.open_store(META_DIR)
+    frontier = Frontier(FRONTIER)
+    if resume:
+        print(f"[resume] {frontier.resume()} URLs pending in {FRONTIER}")
+    else:
+        frontier.reset()
+    # seed自体も候補に入れる（.html/.pdf/末尾/ のみ。リンク先と同じ条件。既出なら無視される）
+    seeds = [u for u in (norm_url(u) for u in seeds) if u and url_ext(u) in ALLOW_EXT]
+    frontier.push_many((u, url_domain(u), 0, priority(u, 0, manifest.get(u))) for u in seeds)
+    try:
+        fetched, domains = asyncio.run(_bulk_crawl(frontier, max_per_domain, max_depth, ignore_robots, manifest))
+    finally:
+        frontier.checkpoint()
+    print(f"[done] fetched={fetched} domains={domains} manifest={manifest.path}({len(manifest)}) frontier={frontier.stats()}")
+    frontier.close(); manifest.close()
+
+async def _crawl_urls(urls: List[str], ignore_robots: bool, manifest: ManifestStore):
+    async with AsyncCrawler(manifest, ignore_robots) as c:
+        async def one(u: str):
+            if not await c.allowed(u):
+                print(f"[deny] robots.txt blocks: {u}"); return
+            await c.record(u)
+        await asyncio.gather(*(one(u) for u in urls))
 
 def crawl_explicit_urls(urls: Iterable[str], ignore_robots: bool):
-    s = requests_sesh()
-    META_DIR.mkdir(parents=True, exist_ok=True)
-    manifest = read_json(MANIFEST, {})
-    for u in urls:
-        u = norm_url(u)
-        if not u: continue
-        rob = load_robots(u)
-        crawl_and_record(s, u, rob, ignore_robots, manifest)
-        time.sleep(SLEEP)
-    write_json(MANIFEST, manifest)
+    manifest = manifest_store.open_store(META_DIR)
+    urls = list(dict.fromkeys(u for u in (norm_url(u) for u in urls) if u))
+    asyncio.run(_crawl_urls(urls, ignore_robots, manifest))
+    manifest.close()
 
 def main():
     ap = argparse.ArgumentParser()
@@ -216,22 +436,27 @@ def main():
     ap.add_argument("--urls", type=str, nargs="*", help="直接ダウンロードするURL群")
     ap.add_argument("--max-per-domain", type=int, default=MAX_PER_DOMAIN_DEFAULT)
     ap.add_argument("--ignore-robots", action="store_true", help="robots.txt を無視して取得（検証用）")
+    ap.add_argument("--depth", type=int, default=DEPTH_DEFAULT, help="seed からたどる段数")
+    ap.add_argument("--resume", action="store_true", help="前回のフロンティアの続きから（--seeds は省略可）")
     args = ap.parse_args()
 
     RAW_DIR.mkdir(parents=True, exist_ok=True)
 
-    if args.seeds:
-        path = Path(args.seeds)
-        if not path.exists(): raise FileNotFoundError(args.seeds)
-        seeds = [ln.strip() for ln in path.read_text(encoding="utf-8").splitlines()
-                 if ln.strip() and not ln.strip().startswith("#")]
-        bulk_crawl_from_seeds(seeds, args.max_per_domain, args.ignore_robots)
+    if args.seeds or args.resume:
+        seeds = []
+        if args.seeds:
+            path = Path(args.seeds)
+            if not path.exists(): raise FileNotFoundError(args.seeds)
+            seeds = [ln.strip() for ln in path.read_text(encoding="utf-8").splitlines()
+                     if ln.strip() and not ln.strip().startswith("#")]
+        bulk_crawl_from_seeds(seeds, args.max_per_domain, args.ignore_robots, args.depth, args.resume)
     elif args.urls:
         crawl_explicit_urls(args.urls, args.ignore_robots)
     else:
         msg = (
             "Usage:\n"
-            "  python crawler.py --seeds seeds.txt [--max-per-domain 50] [--ignore-robots]\n"
+            "  python crawler.py --seeds seeds.txt [--max-per-domain 50] [--depth 1] [--ignore-robots]\n"
+            "  python crawler.py --resume [--seeds seeds.txt]   # 落ちたクロールの続き\n"
             "  or\n"
             "  python crawler.py --urls <url1> <url2> ... [--ignore-robots]\n"
         )
@@ -0,0 +1,235 @@
+# dense_index.py — HybridIndex の密ベクトル（FAISS）脚
+#
+# embed.py / build_index.py が作る data/db/faiss.index と id_map を読み、
+#   - FAISS インデックスは可能なら mmap で開く（IO_FLAG_MMAP。未対応の型は通常読み込み）
+#   - 圧縮したインデックス（ANN_CODEC）は上位候補を faiss.index.raw.npy の元ベクトル（mmap）で並べ直す
+#   - id_map は 3 形式に対応
+#       embed.py       : id_map.npz（chunk_ids と int64 ラベルの配列。ラベルは sha1 由来）
+#                        旧版の {chunk_id: int64 ラベル} の JSON も読める
+#       build_index.py : [id, ...]（ラベル = 配列の位置）
+#     DENSE_ID_MAP が無ければ拡張子を .npz にしたファイルを探す
+#     docs の "id" と突き合わせて「FAISS ラベル ↔ docs の行」の対応表を作る
+#   - クエリの埋め込みは 1 回だけ計算し、LRU キャッシュで同じ質問はエンコーダを呼ばない
+#
+# 埋め込みモデルは EMBED_MODEL（text-embedding-* は OpenAI、それ以外は SBERT）。
+# embed.py / build_index.py は構築に使ったモデルと次元を <faiss.index>.ann.json（embed_model / dim）に残すので、
+# EMBED_MODEL がそれと違うときは密ベクトル脚を使わない（別モデルのクエリで検索すると結果が無意味になる）。
+# 記録の無い古いインデックスはそのまま使い、次元だけクエリごとに確かめる。
+
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+import numpy as np
+import faiss
+
+import ann_index
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DENSE_INDEX = os.getenv("DENSE_INDEX", "./data/db/faiss.index")
+DENSE_ID_MAP = os.getenv("DENSE_ID_MAP", "./data/db/id_map.json")
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+DENSE_TOP_N = int(os.getenv("DENSE_TOP_N", "50"))
+DENSE_QUERY_CACHE = int(os.getenv("DENSE_QUERY_CACHE", "2048"))
+
+
+class QueryEncoder:
+    """クエリ → 正規化済み float32 ベクトル（LRU キャッシュつき）。"""
+
+    def __init__(self, model: str = EMBED_MODEL, cache_size: int = DENSE_QUERY_CACHE):
+        self.model = model
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._fn = None
+        self.hits = 0
+        self.misses = 0
+
+    def _encoder(self):
+        if self._fn is None:
+            if self.model.startswith("text-embedding-"):
+                from openai import OpenAI
+                client = OpenAI()
+
+                def _fn(texts: List[str]) -> np.ndarray:
+                    r = client.embeddings.create(model=self.model, input=texts)
+                    return np.asarray([d.embedding for d in r.data], dtype="float32")
+            else:
+                from sentence_transformers import SentenceTransformer
+                st = SentenceTransformer(self.model)
+
+                def _fn(texts: List[str]) -> np.ndarray:
+                    return np.asarray(st.encode(texts, normalize_embeddings=True), dtype="float32")
+            self._fn = _fn
+        return self._fn
+
+    def encode(self, queries: Sequence[str]) -> np.ndarray:
+        """キャッシュに無いクエリだけまとめてエンコードする（戻り値は queries と同じ順）。"""
+        out: List[Optional[np.ndarray]] = [None] * len(queries)
+        todo: Dict[str, List[int]] = {}
+        with self._lock:
+            for i, q in enumerate(queries):
+                v = self._cache.get(q)
+                if v is None:
+                    todo.setdefault(q, []).append(i)
+                else:
+                    self._cache.move_to_end(q)
+                    out[i] = v
+            self.hits += len(queries) - sum(len(v) for v in todo.values())
+            self.misses += len(todo)
+        if todo:
+            keys = list(todo)
+            X = self._encoder()(keys)
+            X /= np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+            with self._lock:
+                for q, v in zip(keys, X):
+                    for i in todo[q]:
+                        out[i] = v
+                    if self.cache_size > 0:
+                        self._cache[q] = v
+                        self._cache.move_to_end(q)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return np.vstack(out).astype("float32", copy=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"model": self.model, "size": len(self._cache), "maxsize": self.cache_size,
+                    "hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / total) if total else 0.0}
+
+
+def read_faiss(path: str):
+    try:
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # mmap 非対応の型（IDMap の中身が Flat 以外など）は通常読み込み
+        index = faiss.read_index(path)
+    # IVF の nprobe / HNSW の efSearch は構築時に保存した値（ann_index）
+    ann_index.apply_params(index, ann_index.read_params(path))
+    return index
+
+
+def read_id_map(path: str) -> Tuple[List[str], np.ndarray]:
+    """id_map を (docs の id, FAISS ラベル) の組にして返す（どの形式でも）。"""
+    if path.endswith(".npz"):
+        with np.load(path) as z:
+            return z["chunk_ids"].tolist(), z["labels"].astype(np.int64)
+    with open(path, "r", encoding="utf-8-sig") as f:
+        raw = json.load(f)
+    if isinstance(raw, dict):
+        return [str(k) for k in raw], np.fromiter(raw.values(), dtype=np.int64, count=len(raw))
+    return [str(k) for k in raw], np.arange(len(raw), dtype=np.int64)
+
+
+class DenseLeg:
+    """FAISS インデックス + ラベル ↔ 行の対応。行は HybridIndex.docs の添字。"""
+
+    def __init__(self, index, ids: List[str], labels: np.ndarray, docs: Sequence[Dict[str, Any]],
+                 encoder: QueryEncoder, raw: Optional[ann_index.RawVectors] = None, dim: Optional[int] = None):
+        self.index = index
+        self.encoder = encoder
+        self.raw = raw
+        self.dim = int(dim or index.d)  # クエリの次元（次元削減しているときは削減前）
+        by_id = dict(zip(ids, labels.tolist()))
+        n = len(docs)
+        # ラベルは負にもなる（embed.py は sha1 を符号付き int64 にしている）ので、有無は別に持つ
+        self.row_label = np.zeros(n, dtype=np.int64)
+        self.has_vec = np.zeros(n, dtype=bool)
+        for i in range(n):
+            lab = by_id.get(str(docs[i].get("id")))
+            if lab is not None:
+                self.row_label[i] = lab
+                self.has_vec[i] = True
+        rows = np.flatnonzero(self.has_vec)
+        order = np.argsort(self.row_label[rows], kind="stable")
+        self._labels_sorted = self.row_label[rows][order]
+        self._rows_sorted = rows[order]
+        self.coverage = len(rows)
+        if self.coverage < n:
+            logger.warning("dense: FAISS に無い文書があります（%d / %d 件のみ対応）", self.coverage, n)
+
+    def rows_of(self, labels: np.ndarray) -> np.ndarray:
+        """FAISS ラベル → 行（対応が無ければ -1）"""
+        out = np.full(len(labels), -1, dtype=np.int64)
+        if not len(self._labels_sorted):
+            return out
+        pos = np.searchsorted(self._labels_sorted, labels).clip(max=len(self._labels_sorted) - 1)
+        hit = self._labels_sorted[pos] == labels
+        out[hit] = self._rows_sorted[pos[hit]]
+        return out
+
+    def search(self, Q: np.ndarray, n: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """クエリ行列 Q（正規化済み）ごとの上位 n 件 (行, 内積)。"""
+        if Q.shape[1] != self.dim:
+            raise ValueError(f"クエリの次元 {Q.shape[1]} がインデックスの次元 {self.dim} と違います"
+                             f"（EMBED_MODEL={self.encoder.model}）")
+        sims, labels = ann_index.search(self.index, Q, n, self.raw)
+        out = []
+        for s, lab in zip(sims, labels):
+            rows = self.rows_of(lab)
+            keep = (lab != -1) & (rows >= 0)  # -1 は faiss の「結果なし」
+            out.append((rows[keep], s[keep].astype(float)))
+        return out
+
+    def similarity(self, qv: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """指定行との内積（ベクトルが無い・復元できない行は 0。本体より後ろの差分セグメントの行も 0）。"""
+        sim = np.zeros(len(rows), dtype=float)
+        labels = np.zeros(len(rows), dtype=np.int64)
+        has = rows < len(self.row_label)
+        labels[has] = self.row_label[rows[has]]
+        has[has] = self.has_vec[rows[has]]
+        if not has.any():
+            return sim
+        if self.raw is not None:
+            V, _ = self.raw.get(labels[has])
+        else:
+            try:
+                V = self.index.reconstruct_batch(labels[has])
+            except RuntimeError:
+                return sim
+        sim[has] = V @ qv
+        return sim
+
+
+# プロセス内で FAISS インデックスとエンコーダを共有する（ファイルが更新された時だけ読み直す）
+_SHARED: Dict[str, Any] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def load_dense_leg(docs: Sequence[Dict[str, Any]]) -> Optional[DenseLeg]:
+    """DENSE_INDEX / DENSE_ID_MAP から docs 用の DenseLeg を作る。ファイルが無い・モデルが違うときは None。"""
+    id_map = DENSE_ID_MAP
+    if not os.path.exists(id_map):
+        id_map = os.path.splitext(DENSE_ID_MAP)[0] + ".npz"
+    if not (os.path.exists(DENSE_INDEX) and os.path.exists(id_map)):
+        logger.warning("dense: %s または %s がありません（TF-IDF で検索します）", DENSE_INDEX, DENSE_ID_MAP)
+        return None
+    with _SHARED_LOCK:
+        key = (DENSE_INDEX, os.path.getmtime(DENSE_INDEX), id_map, os.path.getmtime(id_map))
+        if _SHARED.get("key") != key:
+            params = ann_index.read_params(DENSE_INDEX)
+            _SHARED["index"] = read_faiss(DENSE_INDEX)
+            _SHARED["id_map"] = read_id_map(id_map)
+            _SHARED["raw"] = (ann_index.RawVectors.open(DENSE_INDEX) if ann_index.lossy(params) else None)
+            _SHARED["params"] = params
+            _SHARED["key"] = key
+            logger.info("dense: loaded %s ntotal=%d model=%s", DENSE_INDEX, _SHARED["index"].ntotal,
+                        params.get("embed_model", "?"))
+        built_with = _SHARED["params"].get("embed_model")
+        if built_with and built_with != EMBED_MODEL:
+            logger.warning("dense: %s は %s で作られていますが EMBED_MODEL=%s です（TF-IDF で検索します）",
+                           DENSE_INDEX, built_with, EMBED_MODEL)
+            return None
+        if "encoder" not in _SHARED:
+            _SHARED["encoder"] = QueryEncoder()
+        ids, labels = _SHARED["id_map"]
+        return DenseLeg(_SHARED["index"], ids, labels, docs, _SHARED["encoder"], raw=_SHARED["raw"],
+                        dim=_SHARED["params"].get("dim"))
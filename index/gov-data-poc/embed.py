@@ -1,21 +1,33 @@
 # -*- coding: utf-8 -*-
 # embed.py  (差分更新：旧チャンクremove→新チャンクadd／OpenAI or ローカル)
+#   インデックスの種類は ANN_INDEX（flat / ivf_flat / ivf_pq / hnsw）、持ち方は ANN_CODEC（flat / fp16 / int8 / pq）、
+#   次元削減は ANN_REDUCE（pca / rp）+ ANN_REDUCE_DIM。圧縮・削減したときは元ベクトルを faiss.index.raw.npy に残す（ann_index.py）
+#   python embed.py bench     … 今の faiss.index で種類ごとの recall@k と p50/p95 遅延を測る
+#   python embed.py --retrain … 入っているベクトルで IVF / PQ を学習し直す（件数が大きく増えたとき）
 from __future__ import annotations
-import os, json, hashlib, struct
+import os, sys, json, hashlib, struct
 from pathlib import Path
 from typing import List, Dict
 import numpy as np
 import faiss
 
+import ann_index
+import embed_cache
+import manifest_store
+from embed_client import EmbeddingClient
+
 BASE = Path(__file__).resolve().parent
 DB_DIR     = BASE / "data" / "db"
 PARSED_DIR = BASE / "data" / "parsed"
+META_DIR   = BASE / "data" / "meta"
 OUT_INDEX  = DB_DIR / "faiss.index"
 OUT_JSONL  = DB_DIR / "texts.json"
-ID_MAP     = DB_DIR / "id_map.json"   # chunk_id -> int64
-DOC_MAP    = DB_DIR / "doc_map.json"  # doc_id   -> [chunk_id,...]
+ID_MAP     = DB_DIR / "id_map.npz"   # chunk_id -> int64 と doc_id -> [chunk_id,...] を配列で持つ
+OLD_ID_MAP  = DB_DIR / "id_map.json"  # 旧形式（あれば初回に読み込んで npz に移す）
+OLD_DOC_MAP = DB_DIR / "doc_map.json"
 
 EMBEDDING_MODEL = "text-embedding-3-small"
+LOCAL_MODEL     = "sentence-transformers/all-MiniLM-L6-v2"
 OPENAI_API_KEY  = os.getenv("OPENAI_API_KEY", "")
 BATCH = 128
 
@@ -24,27 +36,53 @@ def read_json(p: Path, default):
     if not p.exists(): return default
     return json.loads(p.read_text(encoding="utf-8"))
 
-def write_json(p: Path, obj):
-    p.parent.mkdir(parents=True, exist_ok=True)
-    tmp = p.with_suffix(p.suffix + ".tmp")
-    tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(p)
-
 def str_to_i64(s: str) -> int:
     h = hashlib.sha1(s.encode("utf-8")).digest()
     return struct.unpack(">q", h[:8])[0]  # 符号ありint64（Overflow対策）
 
-def load_index(dim: int) -> faiss.IndexIDMap2:
+def load_maps() -> tuple[dict, dict]:
+    """(id_map, doc_map)。npz が無ければ旧 JSON から読む。"""
+    if not ID_MAP.exists():
+        return read_json(OLD_ID_MAP, {}), read_json(OLD_DOC_MAP, {})
+    with np.load(ID_MAP) as z:
+        cids, labels = z["chunk_ids"].tolist(), z["labels"].tolist()
+        doc_ids, chunk_doc = z["doc_ids"].tolist(), z["chunk_doc"]
+    id_map = dict(zip(cids, labels))
+    doc_map: dict = {d: [] for d in doc_ids}
+    for i in np.flatnonzero(chunk_doc >= 0):
+        doc_map[doc_ids[chunk_doc[i]]].append(cids[i])
+    return id_map, doc_map
+
+def save_maps(id_map: dict, doc_map: dict):
+    """chunk_id / ラベル / 所属 doc の添字を 1 つの npz に書く（JSON の整形・解析をしない）。"""
+    doc_ids = list(doc_map)
+    doc_of = {c: i for i, d in enumerate(doc_ids) for c in doc_map[d]}
+    cids = list(id_map)
+    tmp = ID_MAP.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f,
+                 chunk_ids=np.array(cids, dtype=str),
+                 labels=np.fromiter(id_map.values(), dtype=np.int64, count=len(id_map)),
+                 doc_ids=np.array(doc_ids, dtype=str),
+                 chunk_doc=np.fromiter((doc_of.get(c, -1) for c in cids), dtype=np.int32, count=len(cids)))
+    tmp.replace(ID_MAP)
+    # 旧 JSON を残すと dense_index が古い対応表を読むので消す
+    for p in (OLD_ID_MAP, OLD_DOC_MAP):
+        if p.exists(): p.unlink()
+
+def load_index(dim: int, retrain: bool = False):
+    """(index, 構築条件, 元ベクトル)。無い・次元や埋め込みモデルが違うときは (None, None, None)（追加分で学習してから作る）。
+    ANN_INDEX / ANN_CODEC と違うとき・retrain のときは、入っているベクトルで作り直す。"""
     if OUT_INDEX.exists():
-        idx = faiss.read_index(str(OUT_INDEX))
-        if idx.d != dim:
-            base = faiss.IndexFlatIP(dim)
-            return faiss.IndexIDMap2(base)
-        if not isinstance(idx, faiss.IndexIDMap2):
-            idx = faiss.IndexIDMap2(idx)
-        return idx
-    base = faiss.IndexFlatIP(dim)
-    return faiss.IndexIDMap2(base)
+        idx, params = ann_index.load(str(OUT_INDEX))
+        if idx.d == dim and params.get("embed_model", embedder_model()) == embedder_model():
+            raw = ann_index.RawVectors.open(str(OUT_INDEX))
+            want = ann_index.target()
+            if raw is None and not ann_index.lossy(params) and ann_index.lossy(dict(codec=want[1], reduce=want[2])):
+                raw = ann_index.RawVectors.of_index(idx)  # これから圧縮・次元削減するので、今の正確な値を残す
+            idx, params = ann_index.convert(idx, params, retrain=retrain, raw=raw)
+            return idx, params, raw
+    return None, None, None
 
 def jsonl_rows(p: Path) -> list[dict]:
     rows=[]
@@ -57,109 +95,157 @@ def jsonl_rows(p: Path) -> list[dict]:
 
 # -------- embedders --------
 def _embed_openai(texts: List[str]) -> np.ndarray:
-    from openai import OpenAI
+    # BATCH 件ずつ EMBED_CONCURRENCY 本並行に投げる（EMBED_RPM / EMBED_TPM を守り、429・5xx は再試行）
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY が未設定です。")
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    vecs=[]
-    for i in range(0, len(texts), BATCH):
-        part = texts[i:i+BATCH]
-        res = client.embeddings.create(model=EMBEDDING_MODEL, input=part)
-        vecs.extend([d.embedding for d in res.data])
-    arr = np.asarray(vecs, dtype="float32"); faiss.normalize_L2(arr); return arr
+    client = EmbeddingClient(EMBEDDING_MODEL, api_key=OPENAI_API_KEY, batch=BATCH)
+    arr = client.embed(texts)
+    print(f"[embed] embeddings API：requests={client.stats['requests']} retries={client.stats['retries']}")
+    faiss.normalize_L2(arr); return arr
 
 def _embed_local_builder():
-    from sentence_transformers import SentenceTransformer
-    model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-    dim = int(model.get_sentence_embedding_dimension())
+    # 長さの近いチャンクをトークン予算（EMBED_TOKEN_BUDGET）ぶんずつまとめて encode（EMBED_LOCAL_PROCS で複数プロセス）
+    from local_encoder import LocalEncoder
+    enc = LocalEncoder(LOCAL_MODEL)
     def _fn(texts: List[str]) -> np.ndarray:
-        vecs=[]
-        for i in range(0, len(texts), BATCH):
-            part = texts[i:i+BATCH]
-            X = model.encode(part, normalize_embeddings=True)
-            vecs.append(np.asarray(X, dtype="float32"))
-        arr = np.vstack(vecs) if vecs else np.zeros((0, dim), dtype="float32")
+        arr = enc.encode(texts)
+        print(f"[embed] local：{enc.last}")
         faiss.normalize_L2(arr); return arr
-    return _fn, dim
+    return _fn, enc.dim
+
+def embedder_model() -> str:
+    """choose_embedder が使うモデル名（faiss.index の構築条件に残し、dense_index がクエリ側と照合する）。"""
+    return EMBEDDING_MODEL if OPENAI_API_KEY else LOCAL_MODEL
 
 def choose_embedder():
-    if OPENAI_API_KEY: return _embed_openai, 1536
-    try: return _embed_local_builder()
+    # 同じ本文（chunk_id が変わっただけのものも含む）は埋め込みキャッシュから返す
+    if OPENAI_API_KEY: return embed_cache.cached(_embed_openai, EMBEDDING_MODEL), 1536
+    try: fn, dim = _embed_local_builder()
     except Exception: raise RuntimeError("埋め込み手段がありません。")
+    return embed_cache.cached(fn, LOCAL_MODEL), dim
+
+# -------- 差分（pipeline.py からも使う） --------
+def iter_parsed_docs(skip=None):
+    """parsed/*.json を 1 件ずつ読む（全部を同時には持たない）。skip(doc_id) が真の文書はファイルを開かない。"""
+    paths = sorted(PARSED_DIR.glob("*.json"))
+    if paths:
+        for p in paths:
+            if skip is None or not skip(p.stem): yield read_json(p, {})
+        return
+    # フォールバック：JSONLからdoc_id/chunk_idを再構築（最低限）
+    rows = jsonl_rows(OUT_JSONL)
+    # 疑似doc構築（doc_idごとに束ねる）
+    by_doc: Dict[str, list[dict]] = {}
+    for r in rows:
+        by_doc.setdefault(r.get("doc_id","unknown"), []).append({"chunk_id": r["id"], "text": r["text"]})
+    for d, lst in by_doc.items():
+        yield {"doc_id": d, "chunks": lst}
+
+def diff_doc(doc: dict, id_map: dict, doc_map: dict) -> tuple[list[int], list[dict]]:
+    """1 文書ぶんの差分。doc_map を最新にし、消えたチャンクを id_map から外して (削除ラベル, 追加チャンク) を返す。
+    追加チャンクの id_map は埋め込み後に呼び出し側で入れる。"""
+    doc_id = doc.get("doc_id")
+    new_chunk_ids = {c["chunk_id"] for c in doc.get("chunks", [])}
+    old_chunk_ids = set(doc_map.get(doc_id, []))
+
+    to_remove = list(old_chunk_ids - new_chunk_ids)
+    to_add    = [c for c in doc.get("chunks", []) if c["chunk_id"] not in old_chunk_ids]
+
+    # remove
+    rm = [id_map[cid] for cid in to_remove if cid in id_map]
+    for cid in to_remove: id_map.pop(cid, None)
+
+    # doc_mapを最新化
+    doc_map[doc_id] = list(new_chunk_ids)
+    if to_remove or to_add:
+        print(f"[embed] doc={doc_id} add={len(to_add)} remove={len(to_remove)}")
+    return rm, to_add
+
+def drop_doc(doc_id: str, id_map: dict, doc_map: dict) -> list[int]:
+    """文書を丸ごと外し、削除するラベルを返す。"""
+    rm = [id_map[cid] for cid in doc_map.get(doc_id, []) if cid in id_map]
+    for cid in doc_map.get(doc_id, []):
+        id_map.pop(cid, None)
+    doc_map.pop(doc_id, None)
+    print(f"[embed] doc={doc_id} removed(all)")
+    return rm
 
 # -------- main --------
-def main():
+def main(retrain: bool = False):
     DB_DIR.mkdir(parents=True, exist_ok=True)
+    if not any(PARSED_DIR.glob("*.json")) and not OUT_JSONL.exists():
+        print("[embed] 入力データがありません。parse.py を先に実行してください。"); return
 
-    # 1) 現在のdoc（parsed）をロード
-    parsed_docs=[]
-    for p in sorted(PARSED_DIR.glob("*.json")):
-        parsed_docs.append(read_json(p, {}))
-    if not parsed_docs:
-        # フォールバック：JSONLからdoc_id/chunk_idを再構築（最低限）
-        rows = jsonl_rows(OUT_JSONL)
-        if not rows:
-            print("[embed] 入力データがありません。parse.py を先に実行してください。"); return
-        # 疑似doc構築（doc_idごとに束ねる）
-        by_doc: Dict[str, list[dict]] = {}
-        for r in rows:
-            by_doc.setdefault(r.get("doc_id","unknown"), []).append({"chunk_id": r["id"], "text": r["text"]})
-        for d, lst in by_doc.items():
-            parsed_docs.append({"doc_id": d, "chunks": lst})
-
-    # 2) 既存メタとindex
-    id_map  = read_json(ID_MAP, {})
-    doc_map = read_json(DOC_MAP, {})
+    # 1) 既存メタとindex
+    id_map, doc_map = load_maps()
     embed_fn, dim = choose_embedder()
-    index = load_index(dim)
-
-    # 3) 差分適用
+    index, params, raw = load_index(dim, retrain=retrain)
+    if index is None:
+        # 作り直し（初回・埋め込みモデルや次元が違う）：旧 map を残すと変わっていないチャンクが差分に出ない
+        id_map, doc_map = {}, {}
+
+    # 2) 現在のdoc（parsed）を 1 件ずつ読む。manifest で今の content_hash まで埋め込み済みの文書は読まない
+    #    （index を作り直すときは全部読む）
+    store = manifest_store.open_store(META_DIR)
+    skip = (lambda d: d in doc_map and store.is_embedded(d)) if index is not None else None
+    parsed_docs = iter_parsed_docs(skip)
+
+    # 3) 差分適用（remove / add / 埋め込みは貯めておき、最後にまとめて反映：
+    #    remove_ids・IVF の学習・HNSW の組み直し・埋め込み API 呼び出しを 1 回にする）
+    rm_all: list[int] = []
+    add_chunks: list[dict] = []
     current_doc_ids = set()
+    embedded: list[tuple[str, str | None]] = []
     for doc in parsed_docs:
-        doc_id = doc.get("doc_id"); current_doc_ids.add(doc_id)
-        new_chunk_ids = {c["chunk_id"] for c in doc.get("chunks", [])}
-        old_chunk_ids = set(doc_map.get(doc_id, []))
-
-        to_remove = list(old_chunk_ids - new_chunk_ids)
-        to_add    = [c for c in doc.get("chunks", []) if c["chunk_id"] not in old_chunk_ids]
-
-        # remove
-        if to_remove:
-            rm_ids = [id_map[cid] for cid in to_remove if cid in id_map]
-            if rm_ids:
-                index.remove_ids(np.array(rm_ids, dtype=np.int64))
-            for cid in to_remove: id_map.pop(cid, None)
-
-        # add
-        if to_add:
-            texts = [c["text"] for c in to_add]
-            vecs  = embed_fn(texts)
-            add_ids=[str_to_i64(c["chunk_id"]) for c in to_add]
-            for cid, iid in zip([c["chunk_id"] for c in to_add], add_ids):
-                id_map[cid] = iid
-            index.add_with_ids(vecs, np.array(add_ids, dtype=np.int64))
-
-        # doc_mapを最新化
-        doc_map[doc_id] = list(new_chunk_ids)
-        if to_remove or to_add:
-            print(f"[embed] doc={doc_id} add={len(to_add)} remove={len(to_remove)}")
-
-    # 4) 既存indexにあって、parsed側から消えたdocは丸ごと削除
-    vanished_docs = set(doc_map.keys()) - current_doc_ids
-    for doc_id in vanished_docs:
-        rm_ids = [id_map[cid] for cid in doc_map.get(doc_id, []) if cid in id_map]
-        if rm_ids:
-            index.remove_ids(np.array(rm_ids, dtype=np.int64))
-        for cid in doc_map.get(doc_id, []):
-            id_map.pop(cid, None)
-        doc_map.pop(doc_id, None)
-        print(f"[embed] doc={doc_id} removed(all)")
-
-    # 5) 保存
-    faiss.write_index(index, str(OUT_INDEX))
-    write_json(ID_MAP, id_map)
-    write_json(DOC_MAP, doc_map)
+        current_doc_ids.add(doc.get("doc_id"))
+        embedded.append((doc.get("doc_id"), doc.get("content_hash")))
+        rm, to_add = diff_doc(doc, id_map, doc_map)
+        rm_all.extend(rm); add_chunks.extend(to_add)
+
+    # 4) 既存indexにあって、parsed側から消えたdocは丸ごと削除（読み飛ばした文書は parsed が残っている）
+    for doc_id in [d for d in doc_map if d not in current_doc_ids and not (PARSED_DIR / f"{d}.json").exists()]:
+        rm_all.extend(drop_doc(doc_id, id_map, doc_map))
+
+    # 5) まとめて反映（同じチャンクが別 doc に移った場合に備えて remove → add の順）
+    if add_chunks:
+        X = np.asarray(embed_fn([c["text"] for c in add_chunks]), dtype="float32")
+    else:
+        X = np.zeros((0, dim), dtype="float32")
+    add_labels = np.array([str_to_i64(c["chunk_id"]) for c in add_chunks], dtype=np.int64)
+    id_map.update(zip((c["chunk_id"] for c in add_chunks), add_labels.tolist()))
+    if index is None:
+        index, params = ann_index.build(X, add_labels)
+        raw = ann_index.RawVectors.from_unsorted(add_labels, X)
+    else:
+        index = ann_index.remove(index, rm_all, params, raw)
+        if len(X):
+            index.add_with_ids(X, add_labels)
+        if raw is not None and (rm_all or len(X)):
+            raw = raw.updated(rm_all, add_labels, X)
+
+    # 6) 保存（保存できてから manifest に埋め込み済みを記録する）
+    save_all(index, params, raw, id_map, doc_map, model=embedder_model(), dim=dim)
+    print(f"[embed] 読んだ文書={len(current_doc_ids)} 埋め込み済みとして記録={store.mark_embedded(embedded)}")
+    store.close()
+
+def save_all(index, params, raw, id_map: dict, doc_map: dict, model: str | None = None, dim: int | None = None):
+    # 埋め込みモデルと次元（次元削減する前）を <faiss.index>.ann.json に残す（検索側の EMBED_MODEL と照合する）
+    params = dict(params, embed_model=model or embedder_model())
+    if dim: params["dim"] = int(dim)
+    if params.get("trained_on") and index.ntotal > 10 * params["trained_on"]:
+        print(f"[embed] 学習時の {params['trained_on']} 件に比べて {index.ntotal} 件と大きく増えました。"
+              f"python embed.py --retrain で学習し直してください。")
+    ann_index.save(index, params, str(OUT_INDEX), raw)
+    ann_index.report(str(OUT_INDEX), index, params, raw)
+    save_maps(id_map, doc_map)
     print(f"[embed] 完了：ntotal={index.ntotal}, docs={len(doc_map)}")
+    cache = embed_cache.get_cache()
+    if cache is not None:
+        st = cache.stats()
+        print(f"[embed] 埋め込みキャッシュ：hit={st['hits']} miss={st['misses']} ({st['rows']} 件, {st['bytes'] / 1e6:.1f}MB)")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["bench"]:
+        ann_index.main(["bench", "--index", str(OUT_INDEX)] + sys.argv[2:])
+    else:
+        main(retrain="--retrain" in sys.argv[1:])
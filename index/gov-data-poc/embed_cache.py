@@ -0,0 +1,150 @@
+# embed_cache.py — 埋め込みベクトルの永続キャッシュ（embed.py / build_index.py 共通）
+#
+# キーは sha256(モデル名 + 正規化した本文)。chunk_id や texts.json の並びが変わっても本文が同じなら
+# OpenAI / SentenceTransformer を呼ばずに済む。値は float32 のバイト列を SQLite 1 ファイルに置き、
+# 合計サイズが EMBED_CACHE_MAX_BYTES を超えたら最終アクセスの古い順に消す（result_cache と同じ方式）。
+#
+#   EMBED_CACHE            : キャッシュファイル（空にすると無効）
+#   EMBED_CACHE_MAX_BYTES  : 容量上限（既定 2GB ≒ 1536 次元で 35 万件）
+
+import os
+import re
+import time
+import sqlite3
+import threading
+import hashlib
+import logging
+import unicodedata
+from typing import Callable, Dict, List, Optional, Sequence
+
+from dotenv import load_dotenv
+
+import numpy as np
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EMBED_CACHE = os.getenv("EMBED_CACHE", "./data/db/embed_cache.sqlite")
+EMBED_CACHE_MAX_BYTES = int(os.getenv("EMBED_CACHE_MAX_BYTES", str(2 << 30)))
+
+_WS_RUN = re.compile(r"\s+")
+_SQL_VARS = 500  # 1 回の IN (...) に渡すキーの数
+
+
+def normalize_text(text: str) -> str:
+    """キー用の正規化（NFKC・連続空白を 1 個に・前後の空白を除く）。埋め込みに渡す本文は変えない。"""
+    return _WS_RUN.sub(" ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+def cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """sha256(モデル + 本文) → float32 ベクトル。SQLite（WAL）なので複数プロセスから同時に使える。"""
+
+    def __init__(self, path: str, max_bytes: int = EMBED_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        # pipeline.py の embed スレッドからも使うので、接続はスレッドをまたいで共有し _lock で順番に使う
+        self.conn = sqlite3.connect(path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            " k BLOB PRIMARY KEY, dim INTEGER NOT NULL, v BLOB NOT NULL,"
+            " size INTEGER NOT NULL, accessed REAL NOT NULL) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS vectors_accessed ON vectors(accessed)")
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        found: Dict[bytes, np.ndarray] = {}
+        uniq = list(dict.fromkeys(keys))
+        for s in range(0, len(uniq), _SQL_VARS):
+            part = uniq[s:s + _SQL_VARS]
+            q = f"SELECT k, v FROM vectors WHERE k IN ({','.join('?' * len(part))})"
+            for k, v in self.conn.execute(q, part):
+                found[bytes(k)] = np.frombuffer(v, dtype="float32")
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE vectors SET accessed = ? WHERE k = ?", [(now, k) for k in found])
+        return found
+
+    def put_many(self, keys: Sequence[bytes], X: np.ndarray):
+        X = np.ascontiguousarray(X, dtype="float32")
+        now = time.time()
+        rows = [(k, X.shape[1], X[i].tobytes(), X.shape[1] * 4, now) for i, k in enumerate(keys)]
+        self.conn.execute("BEGIN")
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO vectors (k, dim, v, size, accessed) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self.conn.execute("COMMIT")
+        self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM vectors").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 上限の 90% まで、最終アクセスが古い順に削除
+        excess = total - int(self.max_bytes * 0.9)
+        cut = self.conn.execute(
+            "SELECT accessed FROM (SELECT accessed, SUM(size) OVER (ORDER BY accessed) AS acc FROM vectors)"
+            " WHERE acc >= ? ORDER BY accessed LIMIT 1",
+            (excess,),
+        ).fetchone()
+        if cut is not None:
+            n = self.conn.execute("DELETE FROM vectors WHERE accessed <= ?", (cut[0],)).rowcount
+            logger.info("embed cache: %d 件を追い出しました（上限 %d bytes）", n, self.max_bytes)
+
+    def embed(self, texts: Sequence[str], model: str, fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """キャッシュに無い本文だけ fn でまとめて埋め込み、texts と同じ順の行列を返す。"""
+        keys = [cache_key(model, t) for t in texts]
+        with self._lock:
+            found = self.get_many(keys)
+        todo: Dict[bytes, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in todo:
+                todo[k] = t
+        self.hits += len(texts) - sum(1 for k in keys if k in todo)
+        self.misses += sum(1 for k in keys if k in todo)
+        if todo:
+            X = np.asarray(fn(list(todo.values())), dtype="float32")
+            with self._lock:
+                self.put_many(list(todo), X)
+            found.update(zip(todo, X))
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+        return np.vstack([found[k] for k in keys])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM vectors").fetchone()
+        return {"rows": rows, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+
+_CACHE: Optional[EmbeddingCache] = None
+
+
+def get_cache() -> Optional[EmbeddingCache]:
+    """EMBED_CACHE のキャッシュ（無効なら None）。"""
+    global _CACHE
+    if _CACHE is None and EMBED_CACHE:
+        _CACHE = EmbeddingCache(EMBED_CACHE)
+    return _CACHE
+
+
+def cached(fn: Callable[[List[str]], np.ndarray], model: str) -> Callable[[List[str]], np.ndarray]:
+    """fn(texts) と同じ形で、キャッシュを先に見る関数を返す（キャッシュ無効なら fn のまま）。"""
+    cache = get_cache()
+    if cache is None:
+        return fn
+
+    def _fn(texts: List[str]) -> np.ndarray:
+        return cache.embed(texts, model, fn)
+    return _fn
@@ -0,0 +1,180 @@
+# embed_client.py — OpenAI 互換 /embeddings の非同期クライアント（embed.py / build_index.py 共通）
+#
+#   - BATCH 件ずつに分けたリクエストを EMBED_CONCURRENCY 本まで同時に投げる（結果は入力と同じ順）
+#   - 1 分あたりのリクエスト数（EMBED_RPM）とトークン数（EMBED_TPM）をトークンバケットで守る
+#   - 429 / 5xx / 通信エラーは指数バックオフ + ジッタで再試行（Retry-After があればそれに従う）
+#
+# 接続先は OPENAI_BASE_URL（既定は OpenAI）。fake_embed_server.py を立てればオフラインで試せる:
+#   python fake_embed_server.py --port 8088
+#   OPENAI_BASE_URL=http://127.0.0.1:8088/v1 OPENAI_API_KEY=dummy python embed_client.py bench --n 20000
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+from typing import Any, Dict, List, Optional, Sequence
+
+from dotenv import load_dotenv
+
+import numpy as np
+import httpx
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "128"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_RPM = float(os.getenv("EMBED_RPM", "3000"))
+EMBED_TPM = float(os.getenv("EMBED_TPM", "1000000"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "0.5"))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "30"))
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "60"))
+
+
+def estimate_tokens(text: str) -> int:
+    # tiktoken を使わない概算（日本語は 1 文字 ≒ 1 トークン ≒ 3 バイト。英語では多めに見積もる側）
+    return max(1, len(text.encode("utf-8")) // 3)
+
+
+class RateLimiter:
+    """1 分あたりのリクエスト数とトークン数のトークンバケット（最大 1 分ぶん貯まる）。"""
+
+    def __init__(self, rpm: float = EMBED_RPM, tpm: float = EMBED_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._req = rpm
+        self._tok = tpm
+        self._at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        dt = now - self._at
+        self._at = now
+        self._req = min(self.rpm, self._req + dt * self.rpm / 60.0)
+        self._tok = min(self.tpm, self._tok + dt * self.tpm / 60.0)
+
+    async def acquire(self, tokens: int):
+        # 1 回で tpm を超えるバッチは満タンになるのを待って通す
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._req >= 1 and self._tok >= tokens:
+                    self._req -= 1
+                    self._tok -= tokens
+                    return
+                wait = max((1 - self._req) * 60.0 / self.rpm, (tokens - self._tok) * 60.0 / self.tpm)
+                await asyncio.sleep(max(wait, 0.001))
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    # 秒数のみ対応（HTTP-date 形式なら無視してバックオフに任せる）
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class RetryableError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class EmbeddingClient:
+    """texts → float32 行列（texts と同じ順）。正規化はしない（呼び出し側で normalize_L2）。"""
+
+    def __init__(self, model: str, api_key: Optional[str] = None, base_url: str = OPENAI_BASE_URL,
+                 batch: int = EMBED_BATCH, concurrency: int = EMBED_CONCURRENCY,
+                 rpm: float = EMBED_RPM, tpm: float = EMBED_TPM, max_retries: int = EMBED_MAX_RETRIES):
+        self.model = model
+        self.api_key = api_key if api_key is not None else os.getenv("OPENAI_API_KEY", "")
+        self.url = base_url.rstrip("/") + "/embeddings"
+        self.batch = batch
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.stats: Dict[str, int] = {"requests": 0, "retries": 0, "tokens": 0}
+
+    async def _post(self, client: httpx.AsyncClient, limiter: RateLimiter, texts: List[str]) -> np.ndarray:
+        tokens = sum(estimate_tokens(t) for t in texts)
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire(tokens)
+            try:
+                r = await client.post(self.url, json={"model": self.model, "input": texts})
+                if r.status_code == 429 or r.status_code >= 500:
+                    raise RetryableError(f"HTTP {r.status_code}", _retry_after(r.headers.get("retry-after")))
+                if r.status_code >= 400:
+                    raise RuntimeError(f"embeddings API エラー: HTTP {r.status_code} {r.text[:200]}")
+                body = r.json()
+                data = sorted(body["data"], key=lambda d: d["index"])
+                self.stats["requests"] += 1
+                self.stats["tokens"] += int((body.get("usage") or {}).get("total_tokens", tokens))
+                return np.asarray([d["embedding"] for d in data], dtype="float32")
+            except (RetryableError, httpx.TransportError) as e:
+                if attempt >= self.max_retries:
+                    raise RuntimeError(f"embeddings API が {self.max_retries} 回の再試行でも失敗しました: {e}") from e
+                # full jitter（同時に失敗したリクエストが同じ瞬間に再送しないように）
+                delay = random.uniform(0, min(EMBED_BACKOFF_MAX, EMBED_BACKOFF_BASE * 2 ** attempt))
+                if isinstance(e, RetryableError) and e.retry_after is not None:
+                    delay = max(delay, e.retry_after)
+                self.stats["retries"] += 1
+                logger.warning("embeddings: %s → %.2f 秒後に再試行（%d/%d）", e, delay, attempt + 1, self.max_retries)
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    async def embed_async(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+        limiter = RateLimiter(self.rpm, self.tpm)
+        sem = asyncio.Semaphore(self.concurrency)
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(headers=headers, timeout=EMBED_TIMEOUT, limits=limits) as client:
+            async def one(batch: List[str]) -> np.ndarray:
+                async with sem:
+                    return await self._post(client, limiter, batch)
+            parts = await asyncio.gather(*(one(texts[s:s + self.batch]) for s in range(0, len(texts), self.batch)))
+        return np.vstack(parts)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return asyncio.run(self.embed_async(texts))
+
+
+# -------- ベンチマーク --------
+def bench(argv: List[str]) -> Dict[str, Any]:
+    ap = argparse.ArgumentParser(prog="embed_client.py bench")
+    ap.add_argument("--n", type=int, default=5000, help="埋め込む文の数")
+    ap.add_argument("--chars", type=int, default=600, help="1 文の文字数")
+    ap.add_argument("--model", default="text-embedding-3-small")
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, EMBED_CONCURRENCY])
+    args = ap.parse_args(argv)
+    rng = random.Random(0)
+    texts = ["".join(rng.choice("行政手続申請届出書類窓口期限あいうえお") for _ in range(args.chars)) + f"#{i}"
+             for i in range(args.n)]
+    out: Dict[str, Any] = {}
+    for c in args.concurrency:
+        cl = EmbeddingClient(args.model, concurrency=c)
+        t0 = time.perf_counter()
+        X = cl.embed(texts)
+        sec = time.perf_counter() - t0
+        out[c] = {"sec": round(sec, 3), "per_sec": round(len(texts) / sec, 1), "shape": list(X.shape), **cl.stats}
+        print(f"[bench] concurrency={c}: {sec:.2f}s ({len(texts) / sec:.0f} 件/秒) "
+              f"requests={cl.stats['requests']} retries={cl.stats['retries']}")
+    return out
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if sys.argv[1:2] != ["bench"]:
+        sys.exit("usage: python embed_client.py bench [--n N] [--chars C] [--concurrency 1 4 8]")
+    bench(sys.argv[2:])
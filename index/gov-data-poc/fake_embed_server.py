@@ -0,0 +1,80 @@
+# fake_embed_server.py — オフライン用の OpenAI 互換 /v1/embeddings（ベンチマーク・動作確認用）
+#
+# 同じ文には毎回同じ単位ベクトルを返す（sha256 を種にした乱数）。遅延・エラー・レート制限を真似できる:
+#   FAKE_EMBED_DIM         : 次元（既定 1536 = text-embedding-3-small）
+#   FAKE_EMBED_LATENCY     : 1 リクエストの固定遅延（秒）
+#   FAKE_EMBED_PER_ITEM    : 1 件あたりの追加遅延（秒）
+#   FAKE_EMBED_ERROR_RATE  : この割合で 500 を返す
+#   FAKE_EMBED_RPM         : 1 分あたりのリクエスト上限（超えたら 429 + Retry-After。0 で無制限）
+#
+#   python fake_embed_server.py --port 8088
+#   OPENAI_BASE_URL=http://127.0.0.1:8088/v1 OPENAI_API_KEY=dummy python embed.py
+
+import os
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from collections import deque
+from typing import List, Union
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+import numpy as np
+
+FAKE_EMBED_DIM = int(os.getenv("FAKE_EMBED_DIM", "1536"))
+FAKE_EMBED_LATENCY = float(os.getenv("FAKE_EMBED_LATENCY", "0.2"))
+FAKE_EMBED_PER_ITEM = float(os.getenv("FAKE_EMBED_PER_ITEM", "0.001"))
+FAKE_EMBED_ERROR_RATE = float(os.getenv("FAKE_EMBED_ERROR_RATE", "0"))
+FAKE_EMBED_RPM = int(os.getenv("FAKE_EMBED_RPM", "0"))
+
+app = FastAPI(title="fake embeddings")
+_recent: deque = deque()
+
+
+class EmbeddingRequest(BaseModel):
+    model: str = "text-embedding-3-small"
+    input: Union[str, List[str]]
+
+
+def fake_vector(text: str, dim: int = FAKE_EMBED_DIM) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim).astype("float32")
+    v /= np.linalg.norm(v)
+    return v.tolist()
+
+
+@app.post("/v1/embeddings")
+async def embeddings(req: EmbeddingRequest):
+    texts = [req.input] if isinstance(req.input, str) else req.input
+    now = time.monotonic()
+    if FAKE_EMBED_RPM > 0:
+        while _recent and now - _recent[0] > 60:
+            _recent.popleft()
+        if len(_recent) >= FAKE_EMBED_RPM:
+            retry = max(0.0, 60 - (now - _recent[0]))
+            return JSONResponse({"error": {"message": "rate limited", "type": "rate_limit"}},
+                                status_code=429, headers={"Retry-After": f"{retry:.2f}"})
+        _recent.append(now)
+    await asyncio.sleep(FAKE_EMBED_LATENCY + FAKE_EMBED_PER_ITEM * len(texts))
+    if FAKE_EMBED_ERROR_RATE and random.random() < FAKE_EMBED_ERROR_RATE:
+        return JSONResponse({"error": {"message": "fake server error", "type": "server_error"}}, status_code=500)
+    tokens = sum(len(t) for t in texts)
+    return {
+        "object": "list",
+        "model": req.model,
+        "data": [{"object": "embedding", "index": i, "embedding": fake_vector(t)} for i, t in enumerate(texts)],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8088)
+    args = ap.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,346 @@
+# hybrid_index.py — BM25 + TF-IDF のハイブリッド検索インデックス（qa_service / index_snapshot 共用）
+
+import os
+import json
+import uuid
+import logging
+from typing import List, Dict, Any, Callable, Optional
+
+from dotenv import load_dotenv
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from rank_bm25 import BM25Okapi
+
+from bm25_engine import InvertedBM25
+from tokenizer import tokenize, tokenize_query, encode_corpus
+
+# =============================================================================
+# 環境変数
+# =============================================================================
+load_dotenv()
+MIN_SCORE = float(os.getenv("MIN_SCORE", "0.0"))
+TOP_K_DEFAULT = int(os.getenv("TOP_K_DEFAULT", "5"))
+# BM25 の実装: inverted（転置インデックス, 既定） / rank_bm25（従来の BM25Okapi）
+BM25_ENGINE = os.getenv("BM25_ENGINE", "inverted").lower()
+# 検索モード: full（全文書で正規化, 既定） / candidates（BM25 上位候補だけを採点）
+SEARCH_MODE = os.getenv("SEARCH_MODE", "full").lower()
+SEARCH_MODE_PATTERN = "^(full|candidates)$"
+# search_many で一度に密行列化するセル数の上限（クエリ数 × 文書数, float64 換算で約 128MB）
+SEARCH_BATCH_CELLS = int(os.getenv("SEARCH_BATCH_CELLS", str(1 << 24)))
+# ベクトル側の脚: tfidf（文字 n-gram, 既定） / dense（embed.py の FAISS。BM25 上位と FAISS 上位の候補を融合）
+VECTOR_LEG = os.getenv("VECTOR_LEG", "tfidf").lower()
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# データ読み込み & インデックス作成（BM25 + TF-IDF）
+# =============================================================================
+def load_texts(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        logger.warning("texts.json が見つかりません: %s", path)
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    # 期待スキーマ:
+    # { "source_path": "...", "title": "...", "id": "...", "text": "...", "source_url": "..." }
+    return data
+
+def top_n_desc(a: np.ndarray, n: int) -> np.ndarray:
+    """a の上位 n 件の添字を降順で返す（argpartition で全体ソートを避ける）"""
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if n >= len(a):
+        return np.argsort(-a, kind="stable")
+    part = np.argpartition(-a, n - 1)[:n]
+    return part[np.argsort(-a[part], kind="stable")]
+
+# 正規化
+def norm(a: np.ndarray):
+    if np.ptp(a) > 0:
+        return (a - a.min()) / (a.max() - a.min())
+    return np.zeros_like(a)
+
+def norm_rows(a: np.ndarray) -> np.ndarray:
+    """norm の行ごと版（search_many 用）"""
+    lo = a.min(axis=1, keepdims=True)
+    rng = a.max(axis=1, keepdims=True) - lo
+    return np.divide(a - lo, rng, out=np.zeros_like(a), where=rng > 0)
+
+class HybridIndex:
+    # 削除済み（tombstone）行のマスク。通常の索引は None（segmented_index.SegmentedView が設定する）
+    dead: Optional[np.ndarray] = None
+
+    def __init__(self, docs: List[Dict[str, Any]], progress: Optional[Callable[[str], None]] = None):
+        # progress: 構築の段階名（"bm25" / "tfidf"）を受け取るコールバック（/admin/reindex の進捗表示用）
+        self.docs = docs
+        self.corpus = [d.get("text", "") for d in docs]
+        logger.info("docs=%d", len(self.docs))
+
+        if progress:
+            progress("bm25")
+        if BM25_ENGINE == "rank_bm25":
+            self.bm25 = BM25Okapi([tokenize(t) for t in self.corpus])
+        else:
+            # get_scores は BM25Okapi と同じ値を返す（全文書走査なしでポスティングだけ加算）
+            ids, offsets, vocab = encode_corpus(self.corpus)
+            self.bm25 = InvertedBM25.from_token_ids(ids, offsets, vocab)
+
+        if progress:
+            progress("tfidf")
+        self.vectorizer = TfidfVectorizer(analyzer="char", ngram_range=(2, 3))
+        self.tfidf = self.vectorizer.fit_transform(self.corpus)
+
+        # 世代 ID（スナップショットから開いた場合はその世代を引き継ぐ）
+        self.generation = uuid.uuid4().hex
+        self.snapshot_path: Optional[str] = None
+
+    def _score_bm25(self, q: str) -> np.ndarray:
+        toks = tokenize_query(q)
+        return np.asarray(self.bm25.get_scores(toks), dtype=float)
+
+    def _bm25_candidates(self, q: str, n: int):
+        toks = tokenize_query(q)
+        if isinstance(self.bm25, InvertedBM25):
+            return self.bm25.top_k(toks, n)
+        s = np.asarray(self.bm25.get_scores(toks), dtype=float)
+        idx = top_n_desc(s, n)
+        idx = idx[s[idx] > 0]
+        return idx, s[idx]
+
+    def _score_vec(self, q: str, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        qv = self.vectorizer.transform([q])
+        mat = self.tfidf if rows is None else self._tfidf_rows(rows)
+        sim = cosine_similarity(qv, mat)[0]
+        return np.asarray(sim, dtype=float)
+
+    def _tfidf_rows(self, rows: np.ndarray) -> sp.csr_matrix:
+        return self.tfidf[rows]
+
+    # -------------------------------------------------------------------------
+    # 密ベクトル（FAISS）脚（VECTOR_LEG=dense のとき。読めなければ TF-IDF のまま）
+    # -------------------------------------------------------------------------
+    def _dense_leg(self):
+        if VECTOR_LEG != "dense":
+            return None
+        if "_dense" not in self.__dict__:
+            from dense_index import load_dense_leg
+            try:
+                self._dense = load_dense_leg(self.docs)
+            except Exception:
+                logger.exception("dense: FAISS の読み込みに失敗しました（TF-IDF で検索します）")
+                self._dense = None
+        return self._dense
+
+    def dense_info(self) -> Optional[Dict[str, Any]]:
+        leg = self._dense_leg()
+        if leg is None:
+            return None
+        return {"ntotal": int(leg.index.ntotal), "coverage": leg.coverage, "query_cache": leg.encoder.stats()}
+
+    def _search_dense(self, leg, queries: List[str]):
+        """クエリを埋め込んで FAISS 上位を引く → (Q, [(行, 内積), ...])。失敗したら None（TF-IDF で検索する）。"""
+        from dense_index import DENSE_TOP_N
+        try:
+            Q = leg.encoder.encode(queries)
+            return Q, leg.search(Q, DENSE_TOP_N)
+        except Exception:
+            logger.exception("dense: クエリの埋め込み・FAISS 検索に失敗しました（TF-IDF で検索します）")
+            return None
+
+    def _fuse_dense(self, q, qv, dense_rows, top_k, bm25_top_n, w_bm25, w_vec, min_score):
+        """BM25 上位 ∪ FAISS 上位を候補に、BM25 と内積を融合して上位 top_k 件を選ぶ。"""
+        cand_b, _ = self._bm25_candidates(q, bm25_top_n)
+        if self.dead is not None:
+            dense_rows = dense_rows[~self.dead[dense_rows]]
+        cand = np.union1d(cand_b, dense_rows).astype(np.int64)
+        if not len(cand):
+            return []
+        s_bm25 = self._score_bm25(q)[cand]
+        s_vec = self._dense_leg().similarity(qv, cand)
+        return self._select_candidates(cand, s_bm25, s_vec, top_k, w_bm25, w_vec, min_score)
+
+    def search(
+        self,
+        q: str,
+        top_k: int = TOP_K_DEFAULT,
+        bm25_top_n: int = 50,
+        w_bm25: float = 0.55,
+        w_vec: float = 0.45,
+        min_score: float = MIN_SCORE,
+        mode: str = SEARCH_MODE,
+    ) -> List[Dict[str, Any]]:
+        if not self.docs:
+            return []
+
+        leg = self._dense_leg()
+        dense = self._search_dense(leg, [q]) if leg is not None else None
+        if dense is not None:
+            Q, hits = dense
+            rows, _ = hits[0]
+            selected = self._fuse_dense(q, Q[0], rows, top_k, bm25_top_n, w_bm25, w_vec, min_score)
+        elif mode == "candidates":
+            # BM25 上位 bm25_top_n 件だけを採点（コストはコーパスサイズでなく候補数に比例）
+            cand, s_bm25 = self._bm25_candidates(q, bm25_top_n)
+            if not len(cand):
+                return []
+            s_vec = self._score_vec(q, rows=cand)
+            selected = self._select_candidates(cand, s_bm25, s_vec, top_k, w_bm25, w_vec, min_score)
+        else:
+            s_bm25 = self._score_bm25(q)
+            s_vec = self._score_vec(q)
+
+            s_bm25_n = norm(s_bm25)
+            s_vec_n = norm(s_vec)
+            mix = w_bm25 * s_bm25_n + w_vec * s_vec_n
+
+            # BM25上位から候補抽出（削除済みの行は除く）
+            order = np.argsort(s_bm25)[::-1]
+            if self.dead is not None:
+                order = order[~self.dead[order]]
+            top_n_idx = order[:bm25_top_n]
+            selected = [(i, mix[i]) for i in top_n_idx if mix[i] >= float(min_score)]
+            selected.sort(key=lambda x: x[1], reverse=True)
+            selected = selected[:top_k]
+
+        return self._format(selected)
+
+    @staticmethod
+    def _select_candidates(cand, s_bm25, s_vec, top_k, w_bm25, w_vec, min_score):
+        # 全文書での最小値はほぼ 0 なので、候補内の正規化も 0 を下限にして full に近づける
+        def norm0(a: np.ndarray):
+            return norm(np.append(a, 0.0))[:-1]
+
+        mix = w_bm25 * norm0(s_bm25) + w_vec * norm0(s_vec)
+        keep = np.flatnonzero(mix >= float(min_score))
+        keep = keep[top_n_desc(mix[keep], top_k)]
+        return [(int(cand[i]), mix[i]) for i in keep]
+
+    def _format(self, selected) -> List[Dict[str, Any]]:
+        results: List[Dict[str, Any]] = []
+        for idx, score in selected:
+            d = self.docs[idx]
+            results.append({
+                "score": float(score),
+                "title": d.get("title"),
+                "id": d.get("id"),
+                "text": d.get("text"),
+                "source_path": d.get("source_path"),
+                "source_url": d.get("source_url"),
+            })
+        return results
+
+    # -------------------------------------------------------------------------
+    # 複数クエリの一括検索
+    # -------------------------------------------------------------------------
+    def _bm25_matrix(self) -> sp.csr_matrix:
+        """語 × 文書の寄与行列（InvertedBM25 のポスティングをそのまま CSR として使う）"""
+        mat = getattr(self, "_bm25_mat", None)
+        if mat is None:
+            bm = self.bm25
+            mat = sp.csr_matrix(
+                (bm.impacts, bm.doc_ids, bm.indptr),
+                shape=(len(bm.indptr) - 1, bm.corpus_size), copy=False,
+            )
+            self._bm25_mat = mat
+        return mat
+
+    def _score_bm25_many(self, queries: List[str]) -> sp.csr_matrix:
+        """クエリ × 文書の BM25 スコア（疎行列）。クエリ語の重複は回数分の重みになる。"""
+        if not isinstance(self.bm25, InvertedBM25):
+            return sp.csr_matrix(np.vstack([self._score_bm25(q) for q in queries]))
+        rows, cols, vals = [], [], []
+        for i, q in enumerate(queries):
+            for tok in tokenize_query(q):
+                tid = self.bm25.vocab.get(tok)
+                if tid is not None:
+                    rows.append(i); cols.append(tid); vals.append(1.0)
+        qm = sp.csr_matrix((vals, (rows, cols)), shape=(len(queries), len(self.bm25.indptr) - 1))
+        return (qm @ self._bm25_matrix()).tocsr()
+
+    def _score_vec_many(self, queries: List[str]) -> sp.csr_matrix:
+        """クエリ × 文書のコサイン類似度（疎行列）。self.tfidf の各行は L2 正規化済み。"""
+        qv = normalize(self.vectorizer.transform(queries))
+        return (qv @ self.tfidf.T).tocsr()
+
+    def search_many(
+        self,
+        queries: List[str],
+        top_k: int = TOP_K_DEFAULT,
+        bm25_top_n: int = 50,
+        w_bm25: float = 0.55,
+        w_vec: float = 0.45,
+        min_score: float = MIN_SCORE,
+        mode: str = SEARCH_MODE,
+    ) -> List[List[Dict[str, Any]]]:
+        """search をクエリ群に対してまとめて実行する（戻り値は queries と同じ順のリスト）。
+
+        transform・BM25・コサインは疎行列 × 疎行列の積 1 回ずつで計算し、上位選択も
+        行列単位の argpartition で行う。BM25 同点の境界で拾う文書だけは search と異なり得る。
+        """
+        if not self.docs or not queries:
+            return [[] for _ in queries]
+        leg = self._dense_leg()
+        dense = self._search_dense(leg, list(queries)) if leg is not None else None
+        if dense is not None:
+            # 埋め込みと FAISS 検索はまとめて 1 回、融合はクエリごと
+            Q, hits = dense
+            return [
+                self._format(self._fuse_dense(q, qv, rows, top_k, bm25_top_n, w_bm25, w_vec, min_score))
+                for q, qv, (rows, _) in zip(queries, Q, hits)
+            ]
+        n_docs = len(self.docs)
+        step = max(1, SEARCH_BATCH_CELLS // n_docs) if mode != "candidates" else max(1, len(queries))
+        out: List[List[Dict[str, Any]]] = []
+        for s in range(0, len(queries), step):
+            part = list(queries[s:s + step])
+            S_bm25 = self._score_bm25_many(part)
+            if mode == "candidates":
+                out.extend(self._search_many_candidates(part, S_bm25, top_k, bm25_top_n, w_bm25, w_vec, min_score))
+            else:
+                out.extend(self._search_many_full(part, S_bm25, top_k, bm25_top_n, w_bm25, w_vec, min_score))
+        return out
+
+    def _search_many_full(self, queries, S_bm25, top_k, bm25_top_n, w_bm25, w_vec, min_score):
+        B = S_bm25.toarray()
+        V = self._score_vec_many(queries).toarray()
+        mix = w_bm25 * norm_rows(B) + w_vec * norm_rows(V)
+
+        # BM25上位 n 件（行ごと）→ 融合スコアで上位 top_k 件
+        n = min(bm25_top_n, B.shape[1])
+        if self.dead is not None:
+            B[:, self.dead] = -np.inf
+            mix[:, self.dead] = -np.inf
+        if n < B.shape[1]:
+            top = np.argpartition(-B, n - 1, axis=1)[:, :n]
+        else:
+            top = np.broadcast_to(np.arange(n), B.shape)
+        cm = np.take_along_axis(mix, top, axis=1)
+        cm[cm < float(min_score)] = -np.inf
+        sel = np.argsort(-cm, axis=1, kind="stable")[:, :top_k]
+        idx = np.take_along_axis(top, sel, axis=1)
+        sc = np.take_along_axis(cm, sel, axis=1)
+        return [
+            self._format([(int(i), s) for i, s in zip(idx[r], sc[r]) if s != -np.inf])
+            for r in range(len(queries))
+        ]
+
+    def _search_many_candidates(self, queries, S_bm25, top_k, bm25_top_n, w_bm25, w_vec, min_score):
+        qv = normalize(self.vectorizer.transform(queries))
+        out = []
+        for r in range(len(queries)):
+            lo, hi = S_bm25.indptr[r], S_bm25.indptr[r + 1]
+            docs, scores = S_bm25.indices[lo:hi], S_bm25.data[lo:hi]
+            if not len(docs):
+                out.append([])
+                continue
+            keep = top_n_desc(scores, bm25_top_n)
+            cand, s_bm25 = docs[keep], scores[keep]
+            s_vec = (qv[r] @ self._tfidf_rows(cand).T).toarray()[0]
+            out.append(self._format(
+                self._select_candidates(cand, s_bm25, s_vec, top_k, w_bm25, w_vec, min_score)
+            ))
+        return out
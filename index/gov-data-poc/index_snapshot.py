@@ -0,0 +1,366 @@
+# index_snapshot.py — HybridIndex の fit 済み状態をディスクへ書き出し、mmap で即時に開く
+#
+# 使い方:
+#   python index_snapshot.py                     # TEXTS_JSON -> INDEX_SNAPSHOT を作成
+#   python index_snapshot.py --texts x.json --out data/db/hybrid_snapshot
+#
+# 形式（ディレクトリ 1 つ）:
+#   meta.json                          形式バージョン・世代・パラメータ・元 texts.json の情報
+#   bm25_*.npy                         ポスティング（indptr/doc_ids/impacts）・IDF・文書長
+#   tfidf_*.npy                        CSR 行列（data/indices/indptr）・IDF
+#   {bm25,tfidf}_terms.bin / *_off.npy 語彙（UTF-8 バイト順に並べた文字列表）と元の語 ID
+#   docs.bin / docs_off.npy            文書 1 件 = JSON 1 本（検索結果の表示用に遅延デコード）
+# すべて np.load(mmap_mode="r") で開くので、起動時間はコーパスサイズにほぼ依存しない。
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from bm25_engine import InvertedBM25
+from hybrid_index import HybridIndex, load_texts
+from tokenizer import TOKENIZER_VERSION
+
+SNAPSHOT_FORMAT = 1
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# mmap 上の読み取り専用コンテナ
+# =============================================================================
+def _load(d: Path, name: str) -> np.ndarray:
+    return np.load(d / f"{name}.npy", mmap_mode="r")
+
+def _load_blob(p: Path) -> np.ndarray:
+    if p.stat().st_size == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(p, dtype=np.uint8, mode="r")
+
+class StringTable:
+    """UTF-8 バイト順に並べた文字列表。get(term) で元の ID を二分探索で引く（dict の代わり）。"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, ids: np.ndarray):
+        self.blob, self.offsets, self.ids = blob, offsets, ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _key(self, i: int) -> bytes:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def get(self, term: str, default: Optional[int] = None) -> Optional[int]:
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.ids) and self._key(lo) == key:
+            return int(self.ids[lo])
+        return default
+
+    def __getitem__(self, term: str) -> int:
+        v = self.get(term)
+        if v is None:
+            raise KeyError(term)
+        return v
+
+    def __contains__(self, term: str) -> bool:
+        return self.get(term) is not None
+
+class LazyDocs:
+    """docs.bin の JSON を添字アクセス時にだけデコードする読み取り専用シーケンス。"""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob, self.offsets = blob, offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes())
+
+class SnapshotVectorizer:
+    """fit 済み TfidfVectorizer の transform 相当（語彙は StringTable、IDF は mmap 配列）。"""
+
+    def __init__(self, params: Dict[str, Any], vocab: StringTable, idf: np.ndarray):
+        self.params = params
+        self.vocab = vocab
+        self.idf = idf
+        self._analyze = TfidfVectorizer(
+            analyzer=params["analyzer"],
+            ngram_range=tuple(params["ngram_range"]),
+            lowercase=params["lowercase"],
+        ).build_analyzer()
+
+    def transform(self, texts: Iterable[str]) -> sp.csr_matrix:
+        indptr, indices, data = [0], [], []
+        for t in texts:
+            counts: Dict[int, int] = {}
+            for g, c in Counter(self._analyze(t)).items():
+                col = self.vocab.get(g)
+                if col is not None:
+                    counts[col] = c
+            cols = sorted(counts)
+            indices.extend(cols)
+            data.extend(counts[c] for c in cols)
+            indptr.append(len(indices))
+        X = sp.csr_matrix(
+            (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32), np.asarray(indptr)),
+            shape=(len(indptr) - 1, len(self.idf)),
+        )
+        if self.params.get("sublinear_tf"):
+            np.log(X.data, X.data)
+            X.data += 1
+        X.data *= self.idf[X.indices]
+        if self.params.get("norm"):
+            X = normalize(X, norm=self.params["norm"], copy=False)
+        return X
+
+
+# =============================================================================
+# 書き出し
+# =============================================================================
+def _write_strings(d: Path, name: str, vocab: Dict[str, int]):
+    items = sorted(((t.encode("utf-8"), i) for t, i in vocab.items()), key=lambda x: x[0])
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(k) for k, _ in items], out=offsets[1:])
+    (d / f"{name}.bin").write_bytes(b"".join(k for k, _ in items))
+    np.save(d / f"{name}_off.npy", offsets)
+    np.save(d / f"{name}_ids.npy", np.asarray([i for _, i in items], dtype=np.int64))
+
+def _write_docs(d: Path, docs: Sequence[Dict[str, Any]]):
+    offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+    with (d / "docs.bin").open("wb") as f:
+        for i, doc in enumerate(docs):
+            b = json.dumps(doc, ensure_ascii=False).encode("utf-8")
+            f.write(b)
+            offsets[i + 1] = offsets[i] + len(b)
+    np.save(d / "docs_off.npy", offsets)
+
+def _source_info(texts_json: Optional[str]) -> Dict[str, Any]:
+    if not texts_json or not os.path.exists(texts_json):
+        return {"path": texts_json}
+    st = os.stat(texts_json)
+    return {"path": os.path.abspath(texts_json), "mtime": st.st_mtime, "size": st.st_size}
+
+def write_snapshot(index: HybridIndex, out_dir: str, texts_json: Optional[str] = None,
+                   extra_meta: Optional[Dict[str, Any]] = None) -> Path:
+    """index を out_dir に書き出す。別ディレクトリに書いてから rename で差し替える。
+
+    extra_meta は meta.json に上書きで足す（セグメントの圧縮: 元の texts.json の情報と操作ログの位置）。
+    """
+    if not isinstance(index.bm25, InvertedBM25):
+        raise ValueError("スナップショットは BM25_ENGINE=inverted のインデックスのみ対応です")
+    out = Path(out_dir)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_name(f"{out.name}.tmp-{os.getpid()}")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir()
+
+    bm = index.bm25
+    _write_strings(tmp, "bm25_terms", bm.vocab)
+    for name in ("indptr", "doc_ids", "impacts", "max_impact", "idf", "doc_len"):
+        np.save(tmp / f"bm25_{name}.npy", np.asarray(getattr(bm, name)))
+
+    vec = index.vectorizer
+    _write_strings(tmp, "tfidf_terms", vec.vocabulary_)
+    tfidf = index.tfidf.tocsr()
+    np.save(tmp / "tfidf_idf.npy", np.asarray(vec.idf_, dtype=np.float64))
+    np.save(tmp / "tfidf_data.npy", tfidf.data)
+    np.save(tmp / "tfidf_indices.npy", tfidf.indices)
+    np.save(tmp / "tfidf_indptr.npy", tfidf.indptr)
+
+    _write_docs(tmp, index.docs)
+
+    meta = {
+        "format": SNAPSHOT_FORMAT,
+        "generation": index.generation,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "n_docs": len(index.docs),
+        "tokenizer": TOKENIZER_VERSION,
+        "source": _source_info(texts_json),
+        "bm25": {"k1": bm.k1, "b": bm.b, "epsilon": bm.epsilon},
+        "tfidf": {
+            "analyzer": vec.analyzer,
+            "ngram_range": list(vec.ngram_range),
+            "lowercase": vec.lowercase,
+            "norm": vec.norm,
+            "sublinear_tf": vec.sublinear_tf,
+            "shape": list(tfidf.shape),
+        },
+    }
+    meta.update(extra_meta or {})
+    (tmp / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    # 差し替え（既に mmap している読み手は旧ファイルをそのまま使い続けられる）
+    old = out.with_name(f"{out.name}.old-{os.getpid()}")
+    if out.exists():
+        out.rename(old)
+    tmp.rename(out)
+    if old.exists():
+        shutil.rmtree(old, ignore_errors=True)
+    return out
+
+
+# =============================================================================
+# 読み込み
+# =============================================================================
+def read_meta(snapshot_dir: str) -> Optional[Dict[str, Any]]:
+    p = Path(snapshot_dir) / "meta.json"
+    if not p.exists():
+        return None
+    meta = json.loads(p.read_text(encoding="utf-8"))
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        logger.warning("スナップショット形式が異なります（%s）: %s", meta.get("format"), snapshot_dir)
+        return None
+    if meta.get("tokenizer") != TOKENIZER_VERSION:
+        logger.warning("トークナイザの版が異なります（%s）: %s", meta.get("tokenizer"), snapshot_dir)
+        return None
+    return meta
+
+def load_snapshot(snapshot_dir: str) -> HybridIndex:
+    d = Path(snapshot_dir)
+    meta = read_meta(snapshot_dir)
+    if meta is None:
+        raise FileNotFoundError(f"スナップショットがありません: {snapshot_dir}")
+
+    def strings(name: str) -> StringTable:
+        return StringTable(_load_blob(d / f"{name}.bin"), _load(d, f"{name}_off"), _load(d, f"{name}_ids"))
+
+    p = meta["bm25"]
+    bm25 = InvertedBM25.from_arrays(
+        strings("bm25_terms"),
+        *(_load(d, f"bm25_{n}") for n in ("indptr", "doc_ids", "impacts", "max_impact", "idf", "doc_len")),
+        k1=p["k1"], b=p["b"], epsilon=p["epsilon"],
+    )
+    t = meta["tfidf"]
+    tfidf = sp.csr_matrix(
+        (_load(d, "tfidf_data"), _load(d, "tfidf_indices"), _load(d, "tfidf_indptr")),
+        shape=tuple(t["shape"]), copy=False,
+    )
+
+    index = HybridIndex.__new__(HybridIndex)
+    index.docs = LazyDocs(_load_blob(d / "docs.bin"), _load(d, "docs_off"))
+    index.corpus = None  # 本文は docs から必要な分だけ読む
+    index.bm25 = bm25
+    index.vectorizer = SnapshotVectorizer(t, strings("tfidf_terms"), _load(d, "tfidf_idf"))
+    index.tfidf = tfidf
+    index.generation = meta["generation"]
+    index.snapshot_path = str(d)
+    return index
+
+def current_snapshot(snapshot_dir: str) -> str:
+    """/admin/reindex で差し替えた世代があればそのディレクトリ（<snapshot_dir>.current が指す先）を返す。"""
+    p = Path(f"{snapshot_dir}.current")
+    if p.exists():
+        target = p.read_text(encoding="utf-8").strip()
+        if target and read_meta(target) is not None:
+            return target
+        logger.warning("%s の指すスナップショットが読めません: %s", p, target)
+    return snapshot_dir
+
+def set_current_snapshot(snapshot_dir: str, target: str):
+    p = Path(f"{snapshot_dir}.current")
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(f"{p.name}.tmp-{os.getpid()}")
+    tmp.write_text(str(target), encoding="utf-8")
+    os.replace(tmp, p)
+
+def reindex_status_path(snapshot_dir: str) -> Path:
+    return Path(f"{snapshot_dir}.reindex.json")
+
+def read_reindex_status(snapshot_dir: str) -> Optional[Dict[str, Any]]:
+    """/admin/reindex の状態（<snapshot_dir>.reindex.json。全ワーカー・再起動後も同じものを見る）。"""
+    p = reindex_status_path(snapshot_dir)
+    try:
+        return json.loads(p.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def write_reindex_status(snapshot_dir: str, status: Dict[str, Any]):
+    p = reindex_status_path(snapshot_dir)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(f"{p.name}.tmp-{os.getpid()}")
+    tmp.write_text(json.dumps(status, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, p)
+
+def prune_versions(snapshot_dir: str, keep: int, protect: Iterable[Optional[str]] = ()):
+    """版付きスナップショット <snapshot_dir>.* を新しい順に keep 個だけ残す（protect に挙げたもの・
+    /admin/reindex のロールバック先は必ず残す）。"""
+    root = Path(snapshot_dir)
+    protect = list(protect) + [(read_reindex_status(snapshot_dir) or {}).get("previous")]
+    versions = sorted(
+        (p for p in root.parent.glob(f"{root.name}.*") if p.is_dir() and read_meta(str(p)) is not None),
+        key=lambda p: p.name, reverse=True,
+    )
+    protect = {os.path.abspath(k) for k in protect if k}
+    for p in versions[keep:]:
+        if os.path.abspath(p) not in protect:
+            shutil.rmtree(p, ignore_errors=True)
+
+def is_stale(meta: Dict[str, Any], texts_json: str) -> bool:
+    src = meta.get("source") or {}
+    cur = _source_info(texts_json)
+    return "mtime" in cur and (src.get("mtime"), src.get("size")) != (cur["mtime"], cur["size"])
+
+def open_index(texts_json: str, snapshot_dir: Optional[str]) -> HybridIndex:
+    """スナップショットがあれば mmap で開き、無ければ（または texts.json より古ければ）texts.json から構築する。"""
+    if snapshot_dir:
+        snapshot_dir = current_snapshot(snapshot_dir)
+        meta = read_meta(snapshot_dir)
+        if meta is not None and is_stale(meta, texts_json):
+            # 古いコーパスで答えないように、ヒープ上に作り直す（serve.py は起動前に ensure_snapshot で書き直す）
+            logger.warning("スナップショットが texts.json より古いため使いません: %s", snapshot_dir)
+        elif meta is not None:
+            t0 = time.perf_counter()
+            index = load_snapshot(snapshot_dir)
+            logger.info("snapshot loaded: %s docs=%d (%.1f ms)",
+                        snapshot_dir, len(index.docs), (time.perf_counter() - t0) * 1000)
+            return index
+    return HybridIndex(load_texts(texts_json))
+
+
+# =============================================================================
+# CLI
+# =============================================================================
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="HybridIndex のスナップショットを作成する")
+    ap.add_argument("--texts", default=os.getenv("TEXTS_JSON", "./data/db/texts.json"))
+    ap.add_argument("--out", default=os.getenv("INDEX_SNAPSHOT", "./data/db/hybrid_snapshot"))
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    docs = load_texts(args.texts)
+    if not docs:
+        print(f"[snapshot] 文書がありません: {args.texts}")
+        sys.exit(1)
+    t0 = time.perf_counter()
+    index = HybridIndex(docs)
+    t1 = time.perf_counter()
+    out = write_snapshot(index, args.out, texts_json=args.texts)
+    t2 = time.perf_counter()
+    print(f"[snapshot] docs={len(docs)} build={t1 - t0:.2f}s write={t2 - t1:.2f}s -> {out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 # ingest_from_urls.py
-import os, re, json, sys, time
+#   本文は一時ファイルに 64KB ずつ書きながら sha256 を取る（大きな PDF でもメモリに全体を持たない）。
+#   INGEST_MAX_BYTES を超えたら途中で打ち切る。overwrite でも content_hash が同じなら書き換えない
+import os, re, json, sys, time, tempfile
 from pathlib import Path
 from typing import List, Dict
 import hashlib
@@ -10,6 +12,8 @@ from urllib.parse import urlparse
 from pdfminer.high_level import extract_text as pdf_extract
 
 USER_AGENT = os.getenv("USER_AGENT", "gov-data-poc/1.0")
+MAX_BYTES = int(os.getenv("INGEST_MAX_BYTES", str(200 << 20)))
+STREAM_CHUNK = 1 << 16
 DB = Path("data/db")
 TEXTS = DB / "texts.json"
 
@@ -27,10 +31,21 @@ def url_to_id(u: str) -> str:
     host = urlparse(u).netloc.replace("www.","").replace(".","-")
     return f"{host}-{h}"
 
-def fetch(u: str) -> bytes:
-    resp = requests.get(u, headers={"User-Agent": USER_AGENT}, timeout=30)
-    resp.raise_for_status()
-    return resp.content
+def fetch(u: str, dest: Path) -> str:
+    """u の本文を dest に書き、sha256 を返す（MAX_BYTES を超えたら ValueError）。"""
+    with requests.get(u, headers={"User-Agent": USER_AGENT}, timeout=30, stream=True) as resp:
+        resp.raise_for_status()
+        length = resp.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > MAX_BYTES:
+            raise ValueError(f"too large: Content-Length {length} > {MAX_BYTES}")
+        h = hashlib.sha256(); n = 0
+        with dest.open("wb") as f:
+            for chunk in resp.iter_content(STREAM_CHUNK):
+                n += len(chunk)
+                if n > MAX_BYTES:
+                    raise ValueError(f"too large: {n} bytes > {MAX_BYTES}")
+                h.update(chunk); f.write(chunk)
+    return h.hexdigest()
 
 def html_to_text(b: bytes) -> (str, str):
     soup = BeautifulSoup(b, "html.parser")
@@ -40,12 +55,9 @@ def html_to_text(b: bytes) -> (str, str):
     text = normalize_ws(soup.get_text(" "))
     return title, text
 
-def pdf_to_text(b: bytes) -> (str, str):
-    # 一時ファイルに書いてpdfminerで抽出
-    tmp = Path("tmp_ingest.pdf")
-    tmp.write_bytes(b)
-    text = normalize_ws(pdf_extract(str(tmp)))
-    tmp.unlink(missing_ok=True)
+def pdf_to_text(path: Path) -> (str, str):
+    # ダウンロードした一時ファイルをそのまま pdfminer で読む
+    text = normalize_ws(pdf_extract(str(path)))
     return "", text
 
 def ingest(urls: List[str], mode: str):
@@ -57,25 +69,34 @@ def ingest(urls: List[str], mode: str):
     for u in urls:
         u = u.strip()
         if not u: continue
+        fd, name = tempfile.mkstemp(prefix="ingest-", suffix=".part", dir=DB)
+        os.close(fd)
+        tmp = Path(name)
         try:
-            b = fetch(u)
-            if u.lower().endswith(".pdf") or b[:4] == b"%PDF":
-                title, text = pdf_to_text(b)
+            rid = url_to_id(u)
+            if mode == "append" and rid in by_id:
+                # 既存あり→スキップ（取得もしない）
+                continue
+            content_hash = fetch(u, tmp)
+            if mode == "overwrite" and by_id.get(rid, {}).get("content_hash") == content_hash:
+                print(f"[same] {u}")
+                continue
+            with tmp.open("rb") as f:
+                head = f.read(4)
+            if u.lower().endswith(".pdf") or head == b"%PDF":
+                title, text = pdf_to_text(tmp)
             else:
-                title, text = html_to_text(b)
+                title, text = html_to_text(tmp.read_bytes())
             if not title:
                 title = u
-            rid = url_to_id(u)
             rec = {
                 "id": rid,
                 "title": title,
                 "text": text,
                 "source_url": u,
-                "source_path": "web"
+                "source_path": "web",
+                "content_hash": content_hash
             }
-            if mode == "append" and rid in by_id:
-                # 既存あり→スキップ
-                continue
             if mode == "overwrite" and rid in by_id:
                 # 上書き
                 for i, r in enumerate(out):
@@ -88,6 +109,8 @@ def ingest(urls: List[str], mode: str):
             print(f"[ok] {u}")
         except Exception as e:
             print(f"[ng] {u} -> {e}")
+        finally:
+            tmp.unlink(missing_ok=True)
 
     TEXTS.write_text(json.dumps(out, ensure_ascii=False, indent=2), encoding="utf-8")
     print(f"wrote: {TEXTS} (records={len(out)})")
@@ -0,0 +1,179 @@
+# local_encoder.py — SentenceTransformer の CPU 埋め込みを長さでまとめて速くする（embed.py / build_index.py 共通）
+#
+#   - 先に全文をトークナイズして長さ（max_seq_length で打ち切り）を測り、長い順に並べる
+#   - 「件数 × バッチ内の最長」が EMBED_TOKEN_BUDGET を超えない所でバッチを切る
+#     （短いチャンクは大きなバッチ、長いチャンクは小さなバッチ。パディングがほぼ無くなる）
+#   - EMBED_LOCAL_PROCS > 1 ならバッチを spawn したプロセスに配る（各プロセスがモデルを 1 回だけ読む）
+#   - 結果は入力と同じ順に戻し、L2 正規化して返す
+#
+#   python local_encoder.py bench --model sentence-transformers/all-MiniLM-L6-v2 --n 2000
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+from dotenv import load_dotenv
+
+import numpy as np
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EMBED_TOKEN_BUDGET = int(os.getenv("EMBED_TOKEN_BUDGET", "8192"))  # 1 バッチのパディング込みトークン数
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "256"))
+EMBED_LOCAL_PROCS = int(os.getenv("EMBED_LOCAL_PROCS", "1"))
+
+
+def plan_batches(lengths: Sequence[int], token_budget: int = EMBED_TOKEN_BUDGET,
+                 max_batch: int = EMBED_MAX_BATCH) -> List[np.ndarray]:
+    """長い順に並べ、件数 × 先頭（= 最長）の長さが token_budget 以内になるように区切った添字の列。"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind="stable")
+    out: List[np.ndarray] = []
+    s = 0
+    while s < len(order):
+        longest = max(1, int(lengths[order[s]]))
+        n = max(1, min(max_batch, token_budget // longest))
+        out.append(order[s:s + n])
+        s += n
+    return out
+
+
+def padding_ratio(lengths: Sequence[int], batches: Sequence[np.ndarray]) -> float:
+    """実トークン数 / パディング込みトークン数（1.0 で無駄なし）。"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    padded = sum(int(lengths[b].max()) * len(b) for b in batches if len(b))
+    return float(lengths.sum()) / padded if padded else 1.0
+
+
+# -------- 子プロセス側 --------
+_WORKER_MODEL = None
+
+
+def _worker_init(model_name: str, threads: int):
+    global _WORKER_MODEL
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(max(1, threads))
+    _WORKER_MODEL = SentenceTransformer(model_name, device="cpu")
+
+
+def _worker_encode(texts: List[str]) -> np.ndarray:
+    return _encode_batch(_WORKER_MODEL, texts)
+
+
+def _encode_batch(model, texts: List[str]) -> np.ndarray:
+    X = model.encode(texts, batch_size=len(texts), normalize_embeddings=True,
+                     convert_to_numpy=True, show_progress_bar=False)
+    return np.asarray(X, dtype="float32")
+
+
+class LocalEncoder:
+    """texts → 正規化済み float32 行列（texts と同じ順）。"""
+
+    def __init__(self, model_name: str, token_budget: int = EMBED_TOKEN_BUDGET,
+                 max_batch: int = EMBED_MAX_BATCH, procs: int = EMBED_LOCAL_PROCS, model=None):
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(model_name, device="cpu")
+        self.model_name = model_name
+        self.model = model
+        self.dim = int(model.get_sentence_embedding_dimension())
+        self.token_budget = token_budget
+        self.max_batch = max_batch
+        self.procs = procs
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.last: Dict[str, Any] = {}
+
+    def lengths(self, texts: Sequence[str]) -> np.ndarray:
+        """トークン数（特殊トークン込み・max_seq_length で打ち切り）。トークナイザが無ければ文字数。"""
+        limit = int(getattr(self.model, "max_seq_length", 0) or 512)
+        tok = getattr(self.model, "tokenizer", None)
+        if tok is None:
+            return np.minimum([len(t) for t in texts], limit).astype(np.int64)
+        ids = tok(list(texts), add_special_tokens=True, truncation=True, max_length=limit)["input_ids"]
+        return np.fromiter((len(x) for x in ids), dtype=np.int64, count=len(ids))
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            threads = max(1, (os.cpu_count() or 1) // self.procs)
+            self._pool = ProcessPoolExecutor(self.procs, mp_context=mp.get_context("spawn"),
+                                             initializer=_worker_init, initargs=(self.model_name, threads))
+        return self._pool
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        if not texts:
+            return out
+        t0 = time.perf_counter()
+        lengths = self.lengths(texts)
+        batches = plan_batches(lengths, self.token_budget, self.max_batch)
+        parts = [[texts[i] for i in b] for b in batches]
+        if self.procs > 1 and len(batches) > 1:
+            results = self._executor().map(_worker_encode, parts)
+        else:
+            results = (_encode_batch(self.model, p) for p in parts)
+        for b, X in zip(batches, results):
+            out[b] = X
+        self.last = {"texts": len(texts), "batches": len(batches), "procs": self.procs,
+                     "padding_ratio": round(padding_ratio(lengths, batches), 3),
+                     "sec": round(time.perf_counter() - t0, 3)}
+        logger.info("local encode: %s", self.last)
+        return out
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+# -------- ベンチマーク --------
+def bench(argv: List[str]) -> Dict[str, Any]:
+    """固定 128 件・入力順（従来）と、長さバケット + トークン予算（+ 複数プロセス）を比べる。"""
+    ap = argparse.ArgumentParser(prog="local_encoder.py bench")
+    ap.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    ap.add_argument("--n", type=int, default=2000)
+    ap.add_argument("--procs", type=int, nargs="+", default=[1])
+    ap.add_argument("--texts", help="texts.json（JSONL）の本文を使う（無ければ長さがばらばらの合成文）")
+    args = ap.parse_args(argv)
+    if args.texts:
+        import json
+        with open(args.texts, "r", encoding="utf-8") as f:
+            texts = [json.loads(ln)["text"] for ln in f if ln.strip()][:args.n]
+    else:
+        rng = random.Random(0)
+        words = "行政 手続 申請 届出 書類 窓口 期限 交付 住民 証明".split()
+        texts = [" ".join(rng.choice(words) for _ in range(int(rng.paretovariate(1.2) * 20))) for _ in range(args.n)]
+
+    enc = LocalEncoder(args.model, procs=1)
+    out: Dict[str, Any] = {}
+    t0 = time.perf_counter()
+    for s in range(0, len(texts), 128):
+        _encode_batch(enc.model, texts[s:s + 128])
+    out["fixed128"] = round(time.perf_counter() - t0, 3)
+    print(f"[bench] 固定 128 件: {out['fixed128']:.2f}s ({len(texts) / out['fixed128']:.0f} 件/秒)")
+    for p in args.procs:
+        enc.procs = p
+        enc.encode(texts[:8 * 128])  # 子プロセスの起動・モデル読み込みを計測から外す
+        t0 = time.perf_counter()
+        enc.encode(texts)
+        sec = time.perf_counter() - t0
+        out[f"bucketed_p{p}"] = round(sec, 3)
+        print(f"[bench] バケット procs={p}: {sec:.2f}s ({len(texts) / sec:.0f} 件/秒) "
+              f"batches={enc.last['batches']} padding_ratio={enc.last['padding_ratio']}")
+        enc.close()
+    return out
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if sys.argv[1:2] != ["bench"]:
+        sys.exit("usage: python local_encoder.py bench [--model M] [--n N] [--procs 1 4] [--texts data/db/texts.json]")
+    bench(sys.argv[2:])
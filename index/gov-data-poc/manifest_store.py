@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# manifest_store.py  (url 毎の状態 = manifest を SQLite 1 ファイルに置く。crawler.py / parse.py / embed.py / pipeline.py 共通)
+#
+#   - 既定は data/meta/manifest.sqlite（WAL）。読み書きは 1 URL ずつ、書いたらすぐコミット（途中で落ちても消えない）
+#   - url は主キー、parse_needed（立っている行だけの部分索引）と doc_id に索引があるので、全件を読まずに引ける
+#   - upsert は渡した項目だけ書き換える（crawler の記録で parse / embed 側の項目を消さない）
+#   - 初回に data/meta/manifest.json があれば 1 トランザクションで取り込み、manifest.json.migrated に改名する
+#   - embedded_hash は embed 側が「この content_hash まで埋め込み済み」を覚える欄（parsed を読み直さずに済む）
+import json, sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+# manifest.json の項目と同じ名前。ここに無い項目は extra（JSON）に入れて、読むときに戻す
+COLUMNS = ("path", "content_hash", "content_type", "last_modified", "etag", "updated_at",
+           "parse_needed", "changed_at", "doc_id", "embedded_hash")
+
+class ManifestStore:
+    def __init__(self, path: Path, legacy_json: Optional[Path] = None):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(str(path), timeout=30.0, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS manifest (
+                url TEXT PRIMARY KEY, {", ".join(c + (" INTEGER NOT NULL DEFAULT 0" if c == "parse_needed" else " TEXT") for c in COLUMNS)},
+                extra TEXT);
+            CREATE INDEX IF NOT EXISTS manifest_parse_needed ON manifest(parse_needed) WHERE parse_needed = 1;
+            CREATE INDEX IF NOT EXISTS manifest_doc_id ON manifest(doc_id);
+        """)
+        if legacy_json is not None and legacy_json.exists():
+            self.migrate(legacy_json)
+
+    # -------- 移行 --------
+    def migrate(self, legacy_json: Path) -> int:
+        """manifest.json を取り込む（既に同じ url があれば JSON 側で上書き）。取り込んだ件数を返す。"""
+        data = json.loads(legacy_json.read_text(encoding="utf-8"))
+        self.conn.execute("BEGIN")
+        try:
+            for url, meta in data.items():
+                self._upsert(url, meta)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        legacy_json.replace(legacy_json.with_name(legacy_json.name + ".migrated"))
+        print(f"[manifest] {legacy_json} から {len(data)} 件を {self.path} に移しました")
+        return len(data)
+
+    # -------- 読み書き --------
+    def _row(self, row) -> Dict[str, Any]:
+        url, *vals, extra = row
+        meta = {"url": url, **(json.loads(extra) if extra else {})}
+        meta.update((c, v) for c, v in zip(COLUMNS, vals) if v is not None)
+        meta["parse_needed"] = bool(meta.get("parse_needed"))
+        return meta
+
+    def _select(self, where: str, args: tuple = ()):
+        return self.conn.execute(f"SELECT url, {', '.join(COLUMNS)}, extra FROM manifest {where}", args)
+
+    def _upsert(self, url: str, meta: Dict[str, Any]):
+        cols = [c for c in COLUMNS if c in meta]
+        vals = [int(bool(meta[c])) if c == "parse_needed" else meta[c] for c in cols]
+        rest = {k: v for k, v in meta.items() if k not in COLUMNS and k != "url"}
+        if rest:
+            cols.append("extra"); vals.append(json.dumps(rest, ensure_ascii=False))
+        sets = ", ".join(f"{c} = excluded.{c}" for c in cols) or "url = url"
+        self.conn.execute(f"INSERT INTO manifest (url{''.join(', ' + c for c in cols)}) "
+                          f"VALUES ({', '.join('?' * (len(cols) + 1))}) ON CONFLICT(url) DO UPDATE SET {sets}",
+                          [url, *vals])
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        row = self._select("WHERE url = ?", (url,)).fetchone()
+        return self._row(row) if row else None
+
+    def put(self, url: str, meta: Dict[str, Any]):
+        """url の行を upsert する（meta に無い項目は前の値のまま）。1 件ずつコミットする。"""
+        self._upsert(url, meta)
+
+    def by_doc_id(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        row = self._select("WHERE doc_id = ? LIMIT 1", (doc_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def needs_parse(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """parse_needed が立っている (url, meta)。部分索引だけを見る。"""
+        rows = self._select("WHERE parse_needed = 1 ORDER BY url").fetchall()
+        for row in rows:
+            yield row[0], self._row(row)
+
+    def mark_parsed(self, docs: Iterable[Tuple[str, str]]) -> int:
+        """(url, doc_id) の parse_needed を下げ、doc_id を最新にする（texts.json を書き終えてから 1 回で）。"""
+        n = 0
+        self.conn.execute("BEGIN")
+        try:
+            for url, doc_id in docs:
+                n += self.conn.execute("UPDATE manifest SET parse_needed = 0, doc_id = ? WHERE url = ?",
+                                       (doc_id, url)).rowcount
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return n
+
+    def is_embedded(self, doc_id: str, content_hash: Optional[str] = None) -> bool:
+        """doc_id の今の content_hash（省略時は manifest の値）まで埋め込み済みか。"""
+        row = self.conn.execute("SELECT content_hash, embedded_hash FROM manifest WHERE doc_id = ? LIMIT 1",
+                                (doc_id,)).fetchone()
+        if row is None or row[1] is None: return False
+        return row[1] == (content_hash if content_hash is not None else row[0])
+
+    def mark_embedded(self, docs: Iterable[Tuple[str, Optional[str]]]) -> int:
+        """(doc_id, 埋め込んだ content_hash) をまとめて記録する（manifest に無い doc_id は無視）。"""
+        n = 0
+        self.conn.execute("BEGIN")
+        try:
+            for doc_id, content_hash in docs:
+                n += self.conn.execute("UPDATE manifest SET embedded_hash = ? WHERE doc_id = ?",
+                                       (content_hash, doc_id)).rowcount
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return n
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM manifest").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+def open_store(meta_dir: Path) -> ManifestStore:
+    """meta_dir/manifest.sqlite を開く（meta_dir/manifest.json があれば取り込む）。"""
+    return ManifestStore(meta_dir / "manifest.sqlite", legacy_json=meta_dir / "manifest.json")
@@ -1,21 +1,30 @@
 # -*- coding: utf-8 -*-
 # parse.py  (差分パース：manifestのparse_neededだけ更新／fallbackはraw全量)
-import os, json, re, hashlib
+import os, json, re, hashlib, zlib
 from pathlib import Path
 from datetime import datetime, UTC
 from bs4 import BeautifulSoup
 
+import manifest_store
+from manifest_store import ManifestStore
+
 BASE = Path(__file__).resolve().parent
 RAW_DIR     = BASE / "data" / "raw"
 PARSED_DIR  = BASE / "data" / "parsed"
 DB_DIR      = BASE / "data" / "db"
 META_DIR    = BASE / "data" / "meta"
 OUT_JSONL   = DB_DIR / "texts.json"        # JSON Lines（1行=1チャンク）
-MANIFEST    = META_DIR / "manifest.json"   # url毎の状態
+MANIFEST    = META_DIR / "manifest.sqlite" # url毎の状態（manifest_store.py）
 
 ALLOW_EXT = {".html", ".htm", ".pdf"}
-CHUNK_SIZE = 900
-CHUNK_OVERLAP = 150
+CHUNK_SIZE = 900      # 本文の最大長（これを超える前に必ず切る）
+CHUNK_MIN = 400       # これより短いところでは切らない
+CHUNK_OVERLAP = 150   # 直前チャンク末尾の重なり
+CDC_WINDOW = 48       # 切れ目判定に使う直前の文字数
+CDC_DIVISOR = 6       # 文末のおよそ 1/6 を切れ目にする
+
+# 切れ目の候補（文末・改行）
+_BOUNDARY = re.compile(r"[。！？!?]|\n|\.(?=\s)")
 
 # -------- utils --------
 def read_json(p: Path, default):
@@ -28,20 +37,6 @@ def write_json(p: Path, obj):
     tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
     tmp.replace(p)
 
-def load_jsonl(p: Path) -> list[dict]:
-    if not p.exists(): return []
-    rows=[]
-    with p.open("r", encoding="utf-8") as f:
-        for ln in f:
-            ln=ln.strip()
-            if ln: rows.append(json.loads(ln))
-    return rows
-
-def save_jsonl(p: Path, rows: list[dict]):
-    DB_DIR.mkdir(parents=True, exist_ok=True)
-    with p.open("w", encoding="utf-8") as f:
-        for r in rows: f.write(json.dumps(r, ensure_ascii=False) + "\n")
-
 def sha256_text(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
@@ -50,13 +45,41 @@ def norm_ws(s: str) -> str:
     s = re.sub(r"\s*\n\s*", "\n", s)
     return s.strip()
 
+def chunk_bounds(text: str, size=CHUNK_SIZE, min_size=CHUNK_MIN) -> list[tuple[int,int]]:
+    """内容で決まる切れ目（content-defined chunking）。
+    文末・改行のうち、直前 CDC_WINDOW 文字のハッシュが条件を満たす所で切る。切れ目は前後の本文だけで
+    決まるので、途中の段落を直しても、その前後以外のチャンクは同じ位置・同じ本文のまま残る。
+    size を超えそうなら min_size 以上の最後の候補で、それも無ければ size ちょうどで切る。"""
+    cuts=[]; start=0; last=None
+    def force(p):
+        nonlocal start, last
+        while p-start > size:
+            cut = last if last is not None else start+size
+            cuts.append(cut); start=cut; last=None
+    for m in _BOUNDARY.finditer(text):
+        p=m.end()
+        force(p)
+        if p-start < min_size: continue
+        if zlib.crc32(text[p-CDC_WINDOW:p].encode("utf-8")) % CDC_DIVISOR == 0:
+            cuts.append(p); start=p; last=None
+        else:
+            last=p
+    force(len(text))
+    edges=[0]+cuts+[len(text)]
+    return [(a,b) for a,b in zip(edges, edges[1:]) if text[a:b].strip()]
+
 def chunk_text(text: str, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
-    out=[]; n=len(text); i=0
-    while i<n:
-        j=min(i+size, n)
-        out.append(text[i:j])
-        if j==n: break
-        i=max(0, j-overlap)
+    # 2 個目以降は直前の末尾 overlap 文字を頭に付ける（切れ目自体は chunk_bounds で決まる）
+    return [text[max(0, a-overlap) if a else 0:b] for a,b in chunk_bounds(text, size)]
+
+def chunk_ids(url: str, chunks: list[str]) -> list[str]:
+    """chunk_id = URL + 本文ハッシュ + 同じ本文の出現番号。
+    文書内の位置（何番目か）や content_hash には依らないので、変わっていないチャンクは ID も変わらない。"""
+    seen: dict[str,int] = {}; out=[]
+    for c in chunks:
+        h = sha256_text(c)
+        k = seen.get(h, 0); seen[h] = k+1
+        out.append(sha256_text(f"{url}|{h}|{k}"))
     return out
 
 # -------- extractors --------
@@ -85,88 +108,121 @@ def pdf_to_text(path: Path) -> tuple[str,str]:
     except Exception:
         return "", path.stem
 
-# -------- main --------
-def main():
-    PARSED_DIR.mkdir(parents=True, exist_ok=True)
-    DB_DIR.mkdir(parents=True, exist_ok=True)
-    META_DIR.mkdir(parents=True, exist_ok=True)
-
-    manifest = read_json(MANIFEST, {})
+# -------- 1 文書ずつ（pipeline.py からも使う） --------
+def find_targets(manifest: ManifestStore) -> list[tuple[str, Path, dict]]:
     targets: list[tuple[str, Path, dict]] = []
-
-    if manifest:
-        # 差分：parse_needed=True のみ対象
-        for url, meta in manifest.items():
-            if meta.get("parse_needed"):
-                p = Path(meta["path"])
-                if p.exists(): targets.append((url, p, meta))
-        if not targets:
-            print("[parse] 差分なし。処理をスキップします。")
-            return
+    if len(manifest):
+        # 差分：parse_needed=True のみ対象（索引で引く）
+        for url, meta in manifest.needs_parse():
+            p = Path(meta["path"])
+            if p.exists(): targets.append((url, p, meta))
     else:
         # フォールバック：raw 全量
         for p in RAW_DIR.iterdir():
             if p.is_file() and p.suffix.lower() in ALLOW_EXT:
                 targets.append((f"file://{p.name}", p, {"content_hash": sha256_text(p.read_bytes().hex()[:4096])}))
-        if not targets:
-            print("[parse] 対象がありません。まず crawler を実行してください。")
-            return
-
-    rows = load_jsonl(OUT_JSONL)
-    now = datetime.now(UTC).isoformat(timespec="seconds").replace("+00:00","Z")
-
-    for url, raw_path, meta in targets:
-        ext = raw_path.suffix.lower()
-        if ext in (".html",".htm"):
-            text, title = html_to_text(raw_path)
-        elif ext == ".pdf":
-            text, title = pdf_to_text(raw_path)
-        else:
-            print(f"[parse] skip (ext): {raw_path.name}")
-            continue
-
-        content_hash = meta.get("content_hash") or sha256_text(raw_path.read_bytes().hex()[:4096])
-        # doc_id は URL + content_hash で決定（変更があれば doc_id も変わる）
-        doc_id = sha256_text(f"{url}|{content_hash}")
-        old_doc_id = meta.get("doc_id")
-
-        # 旧parsedの掃除（doc_idが変わった場合）
-        if old_doc_id and old_doc_id != doc_id:
-            old_p = PARSED_DIR / f"{old_doc_id}.json"
-            if old_p.exists():
-                try: old_p.unlink()
-                except Exception: pass
-
-        chunks = chunk_text(text)
-        doc_json = {
-            "doc_id": doc_id, "url": url, "content_hash": content_hash, "title": title,
-            "chunks": [
-                {"chunk_index": i, "chunk_id": sha256_text(doc_id + f"#{i}:" + sha256_text(c)), "text": c}
-                for i, c in enumerate(chunks)
-            ]
-        }
-        (PARSED_DIR / f"{doc_id}.json").write_text(json.dumps(doc_json, ensure_ascii=False, indent=2), encoding="utf-8")
-
-        # texts.json(JSONL) 差し替え：旧doc行を削除 → 新行を追加
-        before = len(rows)
-        rows = [r for r in rows if r.get("doc_id") not in {old_doc_id, doc_id}]
-        removed = before - len(rows)
-        for c in doc_json["chunks"]:
-            rows.append({
-                "id": c["chunk_id"], "doc_id": doc_id, "source_path": str(raw_path), "source_url": url,
-                "title": title, "ext": ext.lstrip("."), "chars": len(c["text"]), "text": c["text"], "created_at": now
-            })
-
-        # manifest 更新（parse_needed を下げ、doc_id を最新へ）
-        if url.startswith("http"):
-            manifest[url]["parse_needed"] = False
-            manifest[url]["doc_id"] = doc_id
-
-        print(f"[parse] {raw_path.name} -> chunks={len(chunks)} replace_rows: -{removed} +{len(doc_json['chunks'])}")
-
-    save_jsonl(OUT_JSONL, rows)
-    if manifest: write_json(MANIFEST, manifest)
-    print(f"[parse] 完了：texts.json を差分更新しました。")
+    return targets
+
+def parse_one(url: str, raw_path: Path, meta: dict, now: str) -> dict | None:
+    """1 文書を抽出・チャンク化して parsed/<doc_id>.json を書く（manifest は texts.json を書いた後に呼び出し側が更新する）。
+    戻り値は {"doc": parsed の中身, "rows": texts.json の行, "drop": texts.json から消す doc_id}（対象外なら None）。"""
+    ext = raw_path.suffix.lower()
+    if ext in (".html",".htm"):
+        text, title = html_to_text(raw_path)
+    elif ext == ".pdf":
+        text, title = pdf_to_text(raw_path)
+    else:
+        print(f"[parse] skip (ext): {raw_path.name}")
+        return None
+
+    content_hash = meta.get("content_hash") or sha256_text(raw_path.read_bytes().hex()[:4096])
+    # doc_id は URL だけで決定（本文が変わっても同じ doc_id のまま、チャンク単位で差し替える）
+    doc_id = sha256_text(url)
+    old_doc_id = meta.get("doc_id")
+
+    # 旧parsedの掃除（doc_idが変わった場合）
+    if old_doc_id and old_doc_id != doc_id:
+        old_p = PARSED_DIR / f"{old_doc_id}.json"
+        if old_p.exists():
+            try: old_p.unlink()
+            except Exception: pass
+
+    chunks = chunk_text(text)
+    old_ids = set()
+    old_p = PARSED_DIR / f"{doc_id}.json"
+    if old_p.exists():
+        old_ids = {c.get("chunk_id") for c in read_json(old_p, {}).get("chunks", [])}
+    doc_json = {
+        "doc_id": doc_id, "url": url, "content_hash": content_hash, "title": title,
+        "chunks": [
+            {"chunk_index": i, "chunk_id": cid, "text": c}
+            for i, (cid, c) in enumerate(zip(chunk_ids(url, chunks), chunks))
+        ]
+    }
+    changed = sum(1 for c in doc_json["chunks"] if c["chunk_id"] not in old_ids)
+    (PARSED_DIR / f"{doc_id}.json").write_text(json.dumps(doc_json, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    rows = [{
+        "id": c["chunk_id"], "doc_id": doc_id, "source_path": str(raw_path), "source_url": url,
+        "title": title, "ext": ext.lstrip("."), "chars": len(c["text"]), "text": c["text"], "created_at": now
+    } for c in doc_json["chunks"]]
+
+    print(f"[parse] {raw_path.name} -> chunks={len(chunks)} (changed={changed})")
+    return {"doc": doc_json, "rows": rows, "drop": {old_doc_id, doc_id} - {None}}
+
+def merge_jsonl(p: Path, drop: set, new_rows: Path) -> tuple[int, int]:
+    """texts.json(JSONL) 差し替え：drop の doc 行を除いて new_rows を足す（1 行ずつ流すので全体を持たない）。"""
+    DB_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_suffix(p.suffix + ".tmp")
+    removed = added = 0
+    with tmp.open("w", encoding="utf-8") as out:
+        if p.exists():
+            with p.open("r", encoding="utf-8") as f:
+                for ln in f:
+                    if not ln.strip(): continue
+                    if json.loads(ln).get("doc_id") in drop:
+                        removed += 1; continue
+                    out.write(ln if ln.endswith("\n") else ln + "\n")
+        with new_rows.open("r", encoding="utf-8") as f:
+            for ln in f:
+                out.write(ln); added += 1
+    tmp.replace(p)
+    new_rows.unlink()
+    return removed, added
+
+def now_iso() -> str:
+    return datetime.now(UTC).isoformat(timespec="seconds").replace("+00:00","Z")
+
+# -------- main --------
+def main():
+    PARSED_DIR.mkdir(parents=True, exist_ok=True)
+    DB_DIR.mkdir(parents=True, exist_ok=True)
+    META_DIR.mkdir(parents=True, exist_ok=True)
+
+    manifest = manifest_store.open_store(META_DIR)
+    targets = find_targets(manifest)
+    if not targets:
+        print("[parse] 差分なし。処理をスキップします。" if len(manifest) else "[parse] 対象がありません。まず crawler を実行してください。")
+        return
+
+    # 新しい行は一時ファイルに書き、最後に texts.json と 1 行ずつ突き合わせる
+    now = now_iso()
+    new_rows = OUT_JSONL.with_suffix(".new.tmp")
+    drop: set = set()
+    parsed: list[tuple[str, str]] = []
+    with new_rows.open("w", encoding="utf-8") as f:
+        for url, raw_path, meta in targets:
+            res = parse_one(url, raw_path, meta, now)
+            if res is None: continue
+            drop |= res["drop"]
+            if url.startswith("http"): parsed.append((url, res["doc"]["doc_id"]))
+            for r in res["rows"]: f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+    removed, added = merge_jsonl(OUT_JSONL, drop, new_rows)
+    # manifest 更新（parse_needed を下げ、doc_id を最新へ）。途中で落ちたら次回また parse される
+    manifest.mark_parsed(parsed)
+    manifest.close()
+    print(f"[parse] 完了：texts.json を差分更新しました（-{removed} +{added}）。")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# pipeline.py  (parse → chunk → embed → index を 1 文書ずつ流す。parse.py + embed.py を続けて実行するのと同じ結果)
+#
+#   [parse スレッド] manifest の parse_needed を 1 件ずつ抽出・チャンク化 → 文書キュー（PIPELINE_QUEUE 件まで）
+#                    続けて、parse 済みでまだ埋め込んでいない parsed/*.json（embed.py が読む文書）も流す
+#   [embed スレッド] 文書ごとに差分を取り、追加チャンクを PIPELINE_EMBED_BATCH 件たまるごとに埋め込む → ベクトルキュー
+#   [メイン]         ベクトルを受け取りしだい FAISS に追加（未作成なら ANN_TRAIN_SAMPLE 件たまった所で学習して作る）
+#
+# キューに上限があるので、コーパスが大きくなってもメモリは「キュー + インデックス本体 + id_map」で頭打ちになり、
+# 埋め込み（API 待ち・torch）は次の文書のパースと重なる。texts.json は 1 行ずつ流して差し替える。
+# 削除はラベルを貯めて最後に 1 回だけ反映する（同じ文書で消すチャンクと足すチャンクのラベルは重ならない）。
+#   python pipeline.py
+import os, sys, json, time, queue, tempfile, threading
+from pathlib import Path
+
+import numpy as np
+
+import ann_index
+import embed
+import manifest_store
+import parse
+
+PIPELINE_QUEUE = int(os.getenv("PIPELINE_QUEUE", "16"))
+PIPELINE_EMBED_BATCH = int(os.getenv("PIPELINE_EMBED_BATCH", "1024"))
+
+_END = object()
+
+
+class _Failed:
+    def __init__(self, e: BaseException): self.e = e
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    # 下流が落ちたときに上流が put で固まらないように、stop を見ながら待つ
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5); return
+        except queue.Full:
+            pass
+
+
+def _parse_stage(targets, backlog: list, parsed: list, new_rows: Path, docs_q: queue.Queue, drop: set,
+                 stop: threading.Event):
+    try:
+        now = parse.now_iso()
+        sent: set = set()
+        with new_rows.open("w", encoding="utf-8") as f:
+            for url, raw_path, meta in targets:
+                if stop.is_set(): return
+                res = parse.parse_one(url, raw_path, meta, now)
+                if res is None: continue
+                drop |= res["drop"]
+                if url.startswith("http"): parsed.append((url, res["doc"]["doc_id"]))
+                for r in res["rows"]: f.write(json.dumps(r, ensure_ascii=False) + "\n")
+                sent.add(res["doc"]["doc_id"])
+                _put(docs_q, res["doc"], stop)
+        # 前回 parse だけ済んで埋め込めなかった文書（parse.py だけ実行した・埋め込みで落ちた等）
+        for doc_id in backlog:
+            if stop.is_set(): return
+            p = parse.PARSED_DIR / f"{doc_id}.json"
+            if doc_id in sent or not p.exists(): continue  # 今回 parse した・parse_one が消した
+            _put(docs_q, embed.read_json(p, {}), stop)
+        _put(docs_q, _END, stop)
+    except BaseException as e:
+        _put(docs_q, _Failed(e), stop)
+
+
+def _embed_stage(docs_q: queue.Queue, vec_q: queue.Queue, embed_fn, id_map: dict, doc_map: dict,
+                 rm_all: list, embedded: list, stop: threading.Event):
+    pending: list[dict] = []
+
+    def flush():
+        if not pending: return
+        X = np.asarray(embed_fn([c["text"] for c in pending]), dtype="float32")
+        labels = np.array([embed.str_to_i64(c["chunk_id"]) for c in pending], dtype=np.int64)
+        id_map.update(zip((c["chunk_id"] for c in pending), labels.tolist()))
+        pending.clear()
+        _put(vec_q, (labels, X), stop)
+
+    try:
+        while not stop.is_set():
+            try:
+                doc = docs_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if isinstance(doc, _Failed):
+                _put(vec_q, doc, stop); return
+            if doc is _END: break
+            rm, to_add = embed.diff_doc(doc, id_map, doc_map)
+            rm_all.extend(rm); pending.extend(to_add)
+            embedded.append((doc["doc_id"], doc.get("content_hash")))
+            if len(pending) >= PIPELINE_EMBED_BATCH: flush()
+        flush()
+        _put(vec_q, _END, stop)
+    except BaseException as e:
+        _put(vec_q, _Failed(e), stop)
+
+
+class _Spill:
+    """元ベクトル（圧縮インデックス用）を一時ファイルに追記しておき、最後に mmap で読む。"""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.f = tempfile.NamedTemporaryFile(prefix="pipeline-raw-", suffix=".f32", dir=embed.DB_DIR, delete=False)
+        self.labels: list[np.ndarray] = []
+
+    def add(self, labels: np.ndarray, X: np.ndarray):
+        self.f.write(np.ascontiguousarray(X, dtype="float32").tobytes()); self.labels.append(labels)
+
+    def arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        self.f.close()
+        ids = np.concatenate(self.labels) if self.labels else np.zeros(0, dtype=np.int64)
+        if not len(ids): return ids, np.zeros((0, self.dim), dtype="float32")
+        return ids, np.memmap(self.f.name, dtype="float32", mode="r", shape=(len(ids), self.dim))
+
+    def close(self):
+        self.f.close()
+        try: os.unlink(self.f.name)
+        except OSError: pass
+
+
+def main(retrain: bool = False):
+    for d in (parse.PARSED_DIR, parse.DB_DIR, parse.META_DIR): d.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    manifest = manifest_store.open_store(parse.META_DIR)
+    targets = parse.find_targets(manifest)
+    id_map, doc_map = embed.load_maps()
+    embed_fn, dim = embed.choose_embedder()
+    index, params, raw = embed.load_index(dim, retrain=retrain)
+    if index is None:
+        # 作り直すときは旧 map を捨てる（残すと変わっていないチャンクを diff_doc が出さない）
+        id_map, doc_map = {}, {}
+    # embed.py と同じく、今の content_hash まで埋め込み済みの文書以外は全部埋め込む（index を作り直すときは全部）。
+    # manifest（SQLite）はこのスレッドで引いておき、parse スレッドには doc_id だけ渡す
+    backlog = [p.stem for p in sorted(parse.PARSED_DIR.glob("*.json"))
+               if index is None or p.stem not in doc_map or not manifest.is_embedded(p.stem)]
+    if not targets and not backlog:
+        print("[pipeline] 差分なし。処理をスキップします。"); manifest.close(); return
+
+    docs_q: queue.Queue = queue.Queue(PIPELINE_QUEUE)
+    vec_q: queue.Queue = queue.Queue(max(2, PIPELINE_QUEUE // 4))
+    stop = threading.Event()
+    new_rows = parse.OUT_JSONL.with_suffix(".new.tmp")
+    drop: set = set()
+    rm_all: list[int] = []
+    parsed: list[tuple[str, str]] = []
+    embedded: list[tuple[str, str | None]] = []
+    threads = [
+        threading.Thread(target=_parse_stage, args=(targets, backlog, parsed, new_rows, docs_q, drop, stop), name="parse", daemon=True),
+        threading.Thread(target=_embed_stage, args=(docs_q, vec_q, embed_fn, id_map, doc_map, rm_all, embedded, stop), name="embed", daemon=True),
+    ]
+    for t in threads: t.start()
+
+    # 作成前は学習用にためる（ANN_TRAIN_SAMPLE 件 or 最後まで）。圧縮インデックスは元ベクトルを一時ファイルへ
+    buf: list[tuple[np.ndarray, np.ndarray]] = []
+    spill = _Spill(dim) if raw is not None else None
+    added = 0
+    try:
+        while True:
+            item = vec_q.get()
+            if isinstance(item, _Failed): raise item.e
+            if item is _END: break
+            labels, X = item
+            added += len(labels)
+            if index is None:
+                buf.append(item)
+                if sum(len(b[0]) for b in buf) < ann_index.ANN_TRAIN_SAMPLE: continue
+                labels = np.concatenate([b[0] for b in buf]); X = np.vstack([b[1] for b in buf]); buf.clear()
+                index, params = ann_index.build(X, labels)
+                if ann_index.lossy(params):
+                    spill = _Spill(dim)
+                    raw = ann_index.RawVectors(np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype="float32"))
+            elif len(labels):
+                index.add_with_ids(X, labels)
+            if spill is not None: spill.add(labels, X)
+        if index is None:
+            # 学習件数に届かないまま終わった（初回の小さなコーパス）
+            labels = np.concatenate([b[0] for b in buf]) if buf else np.zeros(0, dtype=np.int64)
+            X = np.vstack([b[1] for b in buf]) if buf else np.zeros((0, dim), dtype="float32")
+            index, params = ann_index.build(X, labels)
+            raw = ann_index.RawVectors.from_unsorted(labels, X)
+        for t in threads: t.join()
+
+        # parsed から消えた文書（旧 doc_id の parsed は parse_one が消している）
+        for doc_id in [d for d in doc_map if not (parse.PARSED_DIR / f"{d}.json").exists()]:
+            rm_all.extend(embed.drop_doc(doc_id, id_map, doc_map))
+
+        # 削除はまとめて 1 回。HNSW の組み直しは削除後の元ベクトルから
+        if spill is not None:
+            ids, V = spill.arrays()
+            raw = raw.updated(rm_all, ids, V)
+        elif raw is not None and rm_all:
+            raw = raw.updated(rm_all, np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype="float32"))
+        index = ann_index.remove(index, rm_all, params, raw)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        if spill is not None: spill.close()
+
+    removed, appended = parse.merge_jsonl(parse.OUT_JSONL, drop, new_rows)
+    embed.save_all(index, params, raw, id_map, doc_map, model=embed.embedder_model(), dim=dim)
+    # manifest は texts.json・インデックスを書き終えてから更新する（途中で落ちたら次回やり直し）
+    manifest.mark_parsed(parsed)
+    manifest.mark_embedded(embedded)
+    manifest.close()
+    print(f"[pipeline] 完了：docs={len(targets)} 未埋め込み={len(backlog)} 追加={added} 削除={len(rm_all)} "
+          f"texts.json -{removed} +{appended}（{time.perf_counter() - t0:.1f}s）")
+
+
+if __name__ == "__main__":
+    main(retrain="--retrain" in sys.argv[1:])
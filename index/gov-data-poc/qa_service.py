@@ -3,9 +3,9 @@
 import os
 import io
 import csv
-import json
 import time
 import logging
+import threading
 from typing import List, Dict, Any, Optional, Union
 
 from fastapi import FastAPI, UploadFile, File, Query, Header, HTTPException, Body
@@ -16,10 +16,11 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from rank_bm25 import BM25Okapi
+from hybrid_index import MIN_SCORE, TOP_K_DEFAULT, SEARCH_MODE, SEARCH_MODE_PATTERN, VECTOR_LEG
+from index_snapshot import open_index
+from result_cache import ResultCache, SharedResultCache, make_key
+from segmented_index import LiveIndex
+from reindex import Reindexer
 
 # =============================================================================
 # 環境変数
@@ -33,8 +34,16 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 LOG_DIR = os.getenv("LOG_DIR", "./logs")
 
 TEXTS_JSON = os.getenv("TEXTS_JSON", "./data/db/texts.json")
-MIN_SCORE = float(os.getenv("MIN_SCORE", "0.0"))
-TOP_K_DEFAULT = int(os.getenv("TOP_K_DEFAULT", "5"))
+# fit 済みインデックスのスナップショット（index_snapshot.py で作成。無ければ texts.json から構築）
+INDEX_SNAPSHOT = os.getenv("INDEX_SNAPSHOT", "./data/db/hybrid_snapshot")
+# /search・/ask の結果キャッシュ（件数上限 0 で無効、TTL 秒 0 で無期限）
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
+# 全ワーカー共有の結果キャッシュ（SQLite ファイル。例: /dev/shm/gov-data-poc-cache.sqlite。空で無効）
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "")
+SHARED_CACHE_MAX_MB = int(os.getenv("SHARED_CACHE_MAX_MB", "64"))
+# /admin/docs の追加・削除を記録する操作ログ（起動時に再生し、ワーカー間の同期にも使う。空で記録しない）
+INDEX_OPLOG = os.getenv("INDEX_OPLOG", "./data/db/doc_ops.jsonl")
 
 # =============================================================================
 # ロガー
@@ -50,96 +59,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# =============================================================================
-# データ読み込み & インデックス作成（BM25 + TF-IDF）
-# =============================================================================
-def load_texts(path: str) -> List[Dict[str, Any]]:
-    if not os.path.exists(path):
-        logger.warning("texts.json が見つかりません: %s", path)
-        return []
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    # 期待スキーマ:
-    # { "source_path": "...", "title": "...", "id": "...", "text": "...", "source_url": "..." }
-    return data
-
-def tokenize_for_bm25(text: str) -> List[str]:
-    # 形態素解析なしの簡易トークナイザ（空白区切り + 2文字N-gram）
-    text = text.strip()
-    chunks: List[str] = []
-    for tok in text.split():
-        chunks.append(tok)
-        for i in range(len(tok) - 1):
-            chunks.append(tok[i:i+2])
-    if not chunks and text:
-        chunks = list(text)
-    return chunks
-
-class HybridIndex:
-    def __init__(self, docs: List[Dict[str, Any]]):
-        self.docs = docs
-        self.corpus = [d.get("text", "") for d in docs]
-        logger.info("docs=%d", len(self.docs))
-
-        tokenized = [tokenize_for_bm25(t) for t in self.corpus]
-        self.bm25 = BM25Okapi(tokenized)
-
-        self.vectorizer = TfidfVectorizer(analyzer="char", ngram_range=(2, 3))
-        self.tfidf = self.vectorizer.fit_transform(self.corpus)
-
-    def _score_bm25(self, q: str) -> np.ndarray:
-        toks = tokenize_for_bm25(q)
-        return np.asarray(self.bm25.get_scores(toks), dtype=float)
-
-    def _score_vec(self, q: str) -> np.ndarray:
-        qv = self.vectorizer.transform([q])
-        sim = cosine_similarity(qv, self.tfidf)[0]
-        return np.asarray(sim, dtype=float)
-
-    def search(
-        self,
-        q: str,
-        top_k: int = TOP_K_DEFAULT,
-        bm25_top_n: int = 50,
-        w_bm25: float = 0.55,
-        w_vec: float = 0.45,
-        min_score: float = MIN_SCORE,
-    ) -> List[Dict[str, Any]]:
-        if not self.docs:
-            return []
-
-        s_bm25 = self._score_bm25(q)
-        s_vec = self._score_vec(q)
-
-        # 正規化
-        def norm(a: np.ndarray):
-            if np.ptp(a) > 0:
-                return (a - a.min()) / (a.max() - a.min())
-            return np.zeros_like(a)
-
-        s_bm25_n = norm(s_bm25)
-        s_vec_n = norm(s_vec)
-        mix = w_bm25 * s_bm25_n + w_vec * s_vec_n
-
-        # BM25上位から候補抽出
-        top_n_idx = np.argsort(s_bm25)[::-1][:bm25_top_n]
-        selected = [(i, mix[i]) for i in top_n_idx if mix[i] >= float(min_score)]
-        selected.sort(key=lambda x: x[1], reverse=True)
-        selected = selected[:top_k]
-
-        results: List[Dict[str, Any]] = []
-        for idx, score in selected:
-            d = self.docs[idx]
-            results.append({
-                "score": float(score),
-                "title": d.get("title"),
-                "id": d.get("id"),
-                "text": d.get("text"),
-                "source_path": d.get("source_path"),
-                "source_url": d.get("source_url"),
-            })
-        return results
-
 # =============================================================================
 # FastAPI
 # =============================================================================
@@ -163,9 +82,34 @@ def root():
         return RedirectResponse(url="/static/index.html", status_code=302)
     return JSONResponse({"ok": True, "message": "UI not bundled. Use the API."})
 
-# インデックス初期化
-DOCS = load_texts(TEXTS_JSON)
-INDEX = HybridIndex(DOCS)
+# インデックス初期化（スナップショットがあれば mmap で開く。無ければ texts.json から構築）
+# 検索は LIVE.current（その時点の不変ビュー）に対して行う。/admin/docs の変更は差分セグメントで即時反映
+LIVE = LiveIndex(open_index(TEXTS_JSON, INDEX_SNAPSHOT), oplog_path=INDEX_OPLOG, snapshot_dir=INDEX_SNAPSHOT)
+# /admin/reindex: texts.json から新しい世代を裏で作って差し替える（旧世代は検索を続け、ロールバック可）
+REINDEXER = Reindexer(LIVE, TEXTS_JSON, INDEX_SNAPSHOT)
+# VECTOR_LEG=dense なら FAISS と id_map をここで読む（serve.py では fork 前の親で 1 回だけ）
+LIVE.current.dense_info()
+RESULT_CACHE = ResultCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+SHARED_CACHE = (
+    SharedResultCache(SHARED_CACHE_PATH, max_bytes=SHARED_CACHE_MAX_MB << 20, ttl=RESULT_CACHE_TTL)
+    if SHARED_CACHE_PATH else None
+)
+
+def cached_search(q: str, **params) -> List[Dict[str, Any]]:
+    """LIVE.current.search の結果をキャッシュ経由で返す（プロセス内 → ホスト共有 → 検索の順。キーに世代を含む）"""
+    index = LIVE.current
+    key = make_key(q, **params)
+    hits = RESULT_CACHE.get(index.generation, key)
+    if hits is not None:
+        return hits
+    if SHARED_CACHE is not None:
+        hits = SHARED_CACHE.get(index.generation, key)
+    if hits is None:
+        hits = index.search(q, **params)
+        if SHARED_CACHE is not None:
+            SHARED_CACHE.put(index.generation, key, hits)
+    RESULT_CACHE.put(index.generation, key, hits)
+    return hits
 
 # 共通: API Key チェック
 def assert_token(x_api_key: Optional[str]):
@@ -189,11 +133,19 @@ class AskResponse(BaseModel):
 def health(x_api_key: Optional[str] = Header(None)):
     # health は無認証でもOK。必要なら次行を有効化。
     # assert_token(x_api_key)
+    index = LIVE.current
     return {
         "ok": True,
-        "index_exists": len(DOCS) > 0,
+        "index_exists": len(index.docs) > 0,
         "texts_exists": os.path.exists(TEXTS_JSON),
         "bm25_exists": True,
+        "snapshot": index.snapshot_path,
+        "index_generation": index.generation,
+        "segments": LIVE.stats(),
+        "vector_leg": VECTOR_LEG,
+        "dense": index.dense_info(),
+        "result_cache": RESULT_CACHE.stats(),
+        "shared_cache": SHARED_CACHE.stats() if SHARED_CACHE is not None else None,
         "min_score": MIN_SCORE,
         "top_k_default": TOP_K_DEFAULT,
     }
@@ -206,11 +158,13 @@ def search(
     w_bm25: float = Query(0.55, ge=0.0, le=1.0),
     w_vec: float = Query(0.45, ge=0.0, le=1.0),
     min_score: float = Query(MIN_SCORE, ge=0.0, le=1.0),
+    mode: str = Query(SEARCH_MODE, pattern=SEARCH_MODE_PATTERN),
     x_api_key: Optional[str] = Header(None),
 ):
     assert_token(x_api_key)
-    res = INDEX.search(
-        q, top_k=top_k, bm25_top_n=bm25_top_n, w_bm25=w_bm25, w_vec=w_vec, min_score=min_score
+    res = cached_search(
+        q, top_k=top_k, bm25_top_n=bm25_top_n, w_bm25=w_bm25, w_vec=w_vec, min_score=min_score,
+        mode=mode,
     )
     return {"ok": True, "results": res}
 
@@ -222,11 +176,13 @@ def ask(
     w_bm25: float = Query(0.55, ge=0.0, le=1.0),
     w_vec: float = Query(0.45, ge=0.0, le=1.0),
     min_score: float = Query(MIN_SCORE, ge=0.0, le=1.0),
+    mode: str = Query(SEARCH_MODE, pattern=SEARCH_MODE_PATTERN),
     x_api_key: Optional[str] = Header(None),
 ):
     assert_token(x_api_key)
-    hits = INDEX.search(
-        q, top_k=top_k, bm25_top_n=bm25_top_n, w_bm25=w_bm25, w_vec=w_vec, min_score=min_score
+    hits = cached_search(
+        q, top_k=top_k, bm25_top_n=bm25_top_n, w_bm25=w_bm25, w_vec=w_vec, min_score=min_score,
+        mode=mode,
     )
     answer = hits[0]["text"] if hits else ""
     return {"ok": True, "answer": answer, "results": hits}
@@ -240,6 +196,7 @@ async def batch_ask(
     w_bm25: float = Query(0.55, ge=0.0, le=1.0),
     w_vec: float = Query(0.45, ge=0.0, le=1.0),
     min_score: float = Query(MIN_SCORE, ge=0.0, le=1.0),
+    mode: str = Query(SEARCH_MODE, pattern=SEARCH_MODE_PATTERN),
     x_api_key: Optional[str] = Header(None),
 ):
     assert_token(x_api_key)
@@ -262,15 +219,20 @@ async def batch_ask(
     if not q_key:
         raise HTTPException(status_code=400, detail="CSV に 'q' 列が必要です")
 
+    # 質問を先に集めて search_many で一括検索（行列演算 1 回でまとめて採点）
+    questions = [(row.get(q_key) or "").strip() for row in reader]
+    asked = [q for q in questions if q]
+    answers = iter(LIVE.current.search_many(
+        asked, top_k=top_k, bm25_top_n=bm25_top_n, w_bm25=w_bm25, w_vec=w_vec, min_score=min_score,
+        mode=mode,
+    ))
+
     out_rows = []
-    for row in reader:
-        q = (row.get(q_key) or "").strip()
+    for q in questions:
         if not q:
             out_rows.append({"q": "", "answer": "", "sources": ""})
             continue
-        hits = INDEX.search(
-            q, top_k=top_k, bm25_top_n=bm25_top_n, w_bm25=w_bm25, w_vec=w_vec, min_score=min_score
-        )
+        hits = next(answers)
         ans = hits[0]["text"] if hits else ""
         srcs = "; ".join([h.get("source_url") or h.get("source_path") or "" for h in hits])
         out_rows.append({"q": q, "answer": ans, "sources": srcs})
@@ -287,6 +249,66 @@ async def batch_ask(
         f.write(content)
     return FileResponse(tmp_path, filename="answers.csv", media_type="text/csv")
 
+# ----------------------- 文書の追加・削除（再構築なしで即時反映） -----------------
+class DocIn(BaseModel):
+    id: str
+    text: str
+    title: Optional[str] = None
+    source_path: Optional[str] = None
+    source_url: Optional[str] = None
+
+class AdminDocsIn(BaseModel):
+    docs: List[DocIn] = []
+    delete: List[str] = []
+
+@app.post("/admin/docs")
+def admin_docs(payload: AdminDocsIn = Body(...), x_api_key: Optional[str] = Header(None)):
+    """文書を追加・置換（同じ id）・削除する。差分セグメントに入るので数秒以内に検索対象になる。"""
+    assert_token(x_api_key)
+    if payload.delete:
+        LIVE.delete_docs(payload.delete)
+    if payload.docs:
+        LIVE.add_docs([d.model_dump() for d in payload.docs])
+    return {"ok": True, "added": len(payload.docs), "deleted": len(payload.delete), "segments": LIVE.stats()}
+
+@app.delete("/admin/docs/{doc_id}")
+def admin_delete_doc(doc_id: str, x_api_key: Optional[str] = Header(None)):
+    assert_token(x_api_key)
+    LIVE.delete_docs([doc_id])
+    return {"ok": True, "deleted": 1, "segments": LIVE.stats()}
+
+@app.post("/admin/merge")
+def admin_merge(full: bool = Query(False, description="本体ごと作り直す（tombstone を消し統計も更新）"),
+                x_api_key: Optional[str] = Header(None)):
+    """差分セグメントのマージをバックグラウンドで開始する（進み具合は /health の segments）。"""
+    assert_token(x_api_key)
+    threading.Thread(target=LIVE.merge, kwargs={"full": full}, name="segment-merge-manual", daemon=True).start()
+    return {"ok": True, "segments": LIVE.stats()}
+
+# ----------------------- 再構築（バックグラウンド + 原子的な差し替え） ----------
+@app.post("/admin/reindex", status_code=202)
+def admin_reindex(x_api_key: Optional[str] = Header(None)):
+    """texts.json から再構築を開始する。進捗・所要時間は GET /admin/reindex（開始したワーカーが保持）。"""
+    assert_token(x_api_key)
+    if not REINDEXER.start():
+        raise HTTPException(status_code=409, detail="reindex already running")
+    return {"ok": True, "reindex": REINDEXER.status()}
+
+@app.get("/admin/reindex")
+def admin_reindex_status(x_api_key: Optional[str] = Header(None)):
+    assert_token(x_api_key)
+    return {"ok": True, "reindex": REINDEXER.status(), "index_generation": LIVE.current.generation}
+
+@app.post("/admin/reindex/rollback")
+def admin_reindex_rollback(x_api_key: Optional[str] = Header(None)):
+    """直前の世代に戻す。"""
+    assert_token(x_api_key)
+    try:
+        res = REINDEXER.rollback()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"ok": True, **res}
+
 # ----------------------- UI フィードバック（入力ゆるく） ----------------------
 class FeedbackIn(BaseModel):
     q: Optional[str] = ""
@@ -0,0 +1,234 @@
+# reindex.py — /admin/reindex: texts.json から新しい世代をバックグラウンドで作り、原子的に差し替える
+#
+# 1) 別プロセス（spawn）で HybridIndex を構築し、版付きのスナップショット <INDEX_SNAPSHOT>.<時刻> に書き出す
+#    （検索ワーカーの GIL・メモリを取らない。段階ごとの進捗はキューで親に送る）
+# 2) 親がそれを mmap で開いて簡単な検索で確かめ、LiveIndex.swap_base で差し替える
+#    （操作ログ経由なので全ワーカーが切り替わる。/admin/docs の変更は新しい本体の上に適用し直す）
+# 3) <INDEX_SNAPSHOT>.current を新しい世代に向ける（再起動後もこの世代から開く）
+#
+# 状態（進捗・結果・直前の世代のスナップショット）は <INDEX_SNAPSHOT>.reindex.json に書くので、
+# どのワーカーに問い合わせても・再起動後も同じ状態が見える。rollback() はそこに記録した直前の世代を
+# 操作ログ経由で全ワーカーに戻す。古い版は REINDEX_KEEP 世代だけ残して消す（直前の世代は残す）。
+# INDEX_SNAPSHOT が空（スナップショットなし）のときは同じプロセスのスレッドで構築して差し替える
+# （状態はプロセス内だけ。戻す先のスナップショットが無いのでロールバックはできない）。
+
+import os
+import time
+import queue
+import shutil
+import logging
+import threading
+import multiprocessing as mp
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from hybrid_index import HybridIndex, load_texts
+from index_snapshot import (load_snapshot, prune_versions, read_meta, read_reindex_status, set_current_snapshot,
+                            write_reindex_status, write_snapshot)
+from segmented_index import LiveIndex
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+REINDEX_KEEP = int(os.getenv("REINDEX_KEEP", "3"))
+REINDEX_TIMEOUT = float(os.getenv("REINDEX_TIMEOUT", "3600"))
+
+
+def build_snapshot(texts_json: str, out_dir: str, q) -> None:
+    """子プロセス側: texts.json → HybridIndex → スナップショット。進捗は (種類, 値, 時刻) で q に送る。"""
+    def report(stage: str):
+        q.put(("stage", stage, time.time()))
+
+    try:
+        report("load")
+        docs = load_texts(texts_json)
+        if not docs:
+            raise ValueError(f"文書がありません: {texts_json}")
+        index = HybridIndex(docs, progress=report)
+        report("write")
+        write_snapshot(index, out_dir, texts_json=texts_json)
+        q.put(("done", {"n_docs": len(docs), "generation": index.generation}, time.time()))
+    except Exception as e:
+        q.put(("error", f"{type(e).__name__}: {e}", time.time()))
+
+
+class Reindexer:
+    """再構築を 1 本ずつ走らせ、状態（進捗・所要時間・結果）を保持する。"""
+
+    def __init__(self, live: LiveIndex, texts_json: str, snapshot_dir: str, keep: int = REINDEX_KEEP):
+        self.live = live
+        self.texts_json = texts_json
+        self.snapshot_dir = snapshot_dir
+        self.keep = keep
+        self._lock = threading.RLock()
+        self._thread: Optional[threading.Thread] = None
+        self._status: Dict[str, Any] = {"state": "idle"}
+
+    def _load(self) -> Dict[str, Any]:
+        """いまの状態（スナップショットがあればファイルから。他のワーカーが走らせたものも見える）。"""
+        if self.snapshot_dir:
+            st = read_reindex_status(self.snapshot_dir)
+            if st is not None:
+                return st
+        with self._lock:
+            return dict(self._status)
+
+    def _save(self):
+        """self._status をファイルに書く（self._lock を持って呼ぶ）。"""
+        if self.snapshot_dir:
+            write_reindex_status(self.snapshot_dir, self._status)
+
+    def _running(self, st: Dict[str, Any]) -> bool:
+        # 実行中のまま落ちたワーカーの記録は REINDEX_TIMEOUT を過ぎたら無視する
+        return st.get("state") == "running" and time.time() - st.get("started_at", 0) < REINDEX_TIMEOUT
+
+    def status(self) -> Dict[str, Any]:
+        st = self._load()
+        st["stages"] = [dict(s) for s in st.get("stages", [])]
+        if self._running(st) and st["stages"]:
+            cur = st["stages"][-1]
+            cur["sec"] = round(time.time() - cur["started_at"], 3)
+            st["elapsed_sec"] = round(time.time() - st["started_at"], 3)
+        st["can_rollback"] = bool(st.get("previous")) and not self._running(st)
+        return st
+
+    # ------------------------------------------------------------------ 構築
+    def start(self) -> bool:
+        """構築を開始する（既に実行中なら False）。"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            prev = self._load()
+            if self._running(prev):
+                return False  # 他のワーカーが実行中
+            # ロールバック先は成功するまで前の記録のものを引き継ぐ
+            self._status = {"state": "running", "started_at": time.time(), "stages": [],
+                            "texts_json": self.texts_json, "previous": prev.get("previous")}
+            self._save()
+            self._thread = threading.Thread(target=self._run, name="reindex", daemon=True)
+            self._thread.start()
+        return True
+
+    def _stage(self, name: str, at: Optional[float] = None):
+        at = time.time() if at is None else at
+        with self._lock:
+            stages: List[Dict[str, Any]] = self._status["stages"]
+            if stages:
+                stages[-1]["sec"] = round(at - stages[-1]["started_at"], 3)
+            stages.append({"stage": name, "started_at": at})
+            self._status["stage"] = name
+            self._save()
+
+    def _finish(self, state: str, **info):
+        now = time.time()
+        with self._lock:
+            stages = self._status["stages"]
+            if stages and "sec" not in stages[-1]:
+                stages[-1]["sec"] = round(now - stages[-1]["started_at"], 3)
+            self._status.update(info, state=state, finished_at=now,
+                                total_sec=round(now - self._status["started_at"], 3))
+            self._status.pop("stage", None)
+            self._save()
+
+    def _run(self):
+        try:
+            if self.snapshot_dir:
+                out = f"{self.snapshot_dir}.{time.strftime('%Y%m%d-%H%M%S')}"
+                info = self._build_in_subprocess(out)
+                self._stage("open")
+                index = load_snapshot(out)
+            else:
+                out = None
+                self._stage("load")
+                docs = load_texts(self.texts_json)
+                if not docs:
+                    raise ValueError(f"文書がありません: {self.texts_json}")
+                index = HybridIndex(docs, progress=self._stage)
+                info = {"n_docs": len(docs), "generation": index.generation}
+
+            self._stage("verify")
+            if not len(index.docs):
+                raise ValueError("新しいインデックスが空です")
+            index.search(str(index.docs[0].get("title") or index.docs[0].get("text") or "")[:50], top_k=1)
+
+            self._stage("swap")
+            previous = self.live.base
+            self.live.swap_base(snapshot=out, index=index)
+            if self.live.base.generation != info["generation"]:
+                raise RuntimeError("新しい本体に切り替わりませんでした（ログを確認してください）")
+            if out:
+                set_current_snapshot(self.snapshot_dir, out)
+            self._finish("succeeded", snapshot=out, previous=previous.snapshot_path,
+                         previous_generation=previous.generation, **info)
+            if out:
+                prune_versions(self.snapshot_dir, self.keep, protect=(out,))
+            logger.info("reindex done: docs=%d generation=%s (%.1fs)",
+                        info["n_docs"], info["generation"], self._status["total_sec"])
+        except Exception as e:
+            logger.exception("reindex failed")
+            self._finish("failed", error=f"{type(e).__name__}: {e}")
+
+    def _build_in_subprocess(self, out: str) -> Dict[str, Any]:
+        ctx = mp.get_context("spawn")
+        q = ctx.Queue()
+        proc = ctx.Process(target=build_snapshot, args=(self.texts_json, out, q), name="reindex-build", daemon=True)
+        self._stage("spawn")
+        proc.start()
+        deadline = time.monotonic() + REINDEX_TIMEOUT
+        try:
+            while True:
+                try:
+                    kind, value, at = q.get(timeout=1.0)
+                except queue.Empty:
+                    if not proc.is_alive():
+                        raise RuntimeError(f"構築プロセスが終了しました（exitcode={proc.exitcode}）")
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"構築が {REINDEX_TIMEOUT:.0f} 秒以内に終わりませんでした")
+                    continue
+                if kind == "stage":
+                    self._stage(value, at)
+                elif kind == "done":
+                    return value
+                else:
+                    raise RuntimeError(value)
+        except BaseException:
+            shutil.rmtree(out, ignore_errors=True)
+            raise
+        finally:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.kill()
+
+    # ------------------------------------------------------------------ ロールバック
+    def rollback(self) -> Dict[str, Any]:
+        """記録してある直前の世代のスナップショットに（操作ログ経由で全ワーカー）戻す。もう一度呼ぶと元に戻る。"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                raise RuntimeError("再構築の実行中はロールバックできません")
+        st = self._load()
+        if self._running(st):
+            raise RuntimeError("再構築の実行中はロールバックできません")
+        previous = st.get("previous")
+        if not self.snapshot_dir or not previous:
+            raise RuntimeError("戻せる世代がありません（直前の世代のスナップショットが記録されていません）")
+        if read_meta(previous) is None:
+            raise RuntimeError(f"直前の世代のスナップショットが読めません: {previous}")
+        t0 = time.perf_counter()
+        current = self.live.base
+        self.live.swap_base(snapshot=previous)
+        base = self.live.base
+        if os.path.abspath(base.snapshot_path or "") != os.path.abspath(previous):
+            raise RuntimeError("直前の世代に切り替わりませんでした（ログを確認してください）")
+        set_current_snapshot(self.snapshot_dir, previous)
+        with self._lock:
+            self._status = dict(st, snapshot=previous, previous=current.snapshot_path,
+                                previous_generation=current.generation, generation=base.generation,
+                                rolled_back_at=time.time())
+            self._save()
+        return {
+            "generation": base.generation,
+            "rolled_back_from": current.generation,
+            "snapshot": previous,
+            "sec": round(time.perf_counter() - t0, 3),
+        }
@@ -23,6 +23,8 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from tokenizer import tokenize
+
 # ===== ユーティリティ =====
 
 QUERY_COL_CANDIDATES = ["q", "question", "query", "prompt"]
@@ -50,24 +52,10 @@ def normalize_text(s: str) -> str:
     return s
 
 def tokenize_ja_en(s: str):
-    """超簡易トークナイザ（スペース/句読点/記号で分割）。日本語はユニグラム近似。"""
+    """検索側と同じトークナイザ（tokenizer.py）で分割する。URL は除去してから。"""
     if not s:
         return []
-    # URL除去してから
-    s = URL_RE.sub(" ", s)
-    # 記号で分割
-    s = re.sub(r"[、。,.!?:;()\[\]{}\"'“”’・/\\\-|]+", " ", s)
-    s = normalize_text(s)
-    toks = s.split(" ")
-    toks = [t for t in toks if t]
-    # 日本語が続く場合はユニグラム化して数を底上げ（クエリ側に効く）
-    out = []
-    for t in toks:
-        if re.search(r"[ぁ-んァ-ヶ一-龠]", t):
-            out.extend(list(t))
-        else:
-            out.append(t.lower())
-    return out
+    return tokenize(URL_RE.sub(" ", s))
 
 def per_row_metrics(df: pd.DataFrame, name: str) -> pd.DataFrame:
     """q / answer / results を元に行単位のメトリクスを付与。"""
@@ -0,0 +1,229 @@
+# result_cache.py — 検索結果のキャッシュ（インデックス世代が変わると自動で破棄）
+#   ResultCache       : プロセス内 LRU/TTL
+#   SharedResultCache : 同一ホストの全ワーカーで共有する SQLite ファイル（容量上限つき）
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 連続空白は TF-IDF の char アナライザも 1 個の空白に畳むので、同じ結果になる範囲で正規化する
+# （大文字小文字・前後の空白は BM25 / TF-IDF の結果を変えるので触らない）
+_WS_RUN = re.compile(r"\s\s+")
+
+def normalize_query(q: str) -> str:
+    return _WS_RUN.sub(" ", q)
+
+def make_key(q: str, **params) -> Tuple[Hashable, ...]:
+    """正規化したクエリ + 検索パラメータ（top_k, bm25_top_n, w_bm25, w_vec, min_score, mode ...）"""
+    return (normalize_query(q),) + tuple(sorted(params.items()))
+
+
+class ResultCache:
+    """件数上限つき LRU + TTL。値は共有されるので呼び出し側で書き換えないこと。
+
+    get/put には現在のインデックス世代を渡す。世代が変わった時点で中身を全て捨てる。
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation: Optional[str] = None
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _sync_generation(self, generation: str):
+        if generation != self.generation:
+            self._data.clear()
+            self.generation = generation
+
+    def get(self, generation: str, key: Hashable) -> Optional[Any]:
+        if self.maxsize <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._sync_generation(generation)
+            item = self._data.get(key)
+            if item is None or (self.ttl > 0 and now - item[0] > self.ttl):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, generation: str, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._sync_generation(generation)
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "generation": self.generation,
+            }
+
+
+class SharedResultCache:
+    """SQLite ファイル 1 つを全ワーカーで読み書きするキャッシュ（WAL モード）。
+
+    - キーは sha256(世代 + 正規化クエリ + パラメータ)。他世代の行は世代が変わった時に消す。
+    - 値（検索結果）は JSON。合計サイズが max_bytes を超えたら最終アクセスの古い順に消す。
+    - ロック競合などの SQLite エラーはミス扱いにして検索自体は止めない。
+    - 接続は fork 後・スレッドごとに張り直す。
+    """
+
+    def __init__(self, path: str, max_bytes: int = 64 << 20, ttl: float = 600.0, evict_every: int = 64):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.generation: Optional[str] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " k TEXT PRIMARY KEY, gen TEXT NOT NULL, v BLOB NOT NULL,"
+                " size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results(accessed)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _hash(generation: str, key: Hashable) -> str:
+        raw = json.dumps([generation, key], ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _sync_generation(self, conn: sqlite3.Connection, generation: str):
+        if generation != self.generation:
+            conn.execute("DELETE FROM results WHERE gen != ?", (generation,))
+            self.generation = generation
+
+    def get(self, generation: str, key: Hashable) -> Optional[Any]:
+        k = self._hash(generation, key)
+        now = time.time()
+        try:
+            conn = self._conn()
+            self._sync_generation(conn, generation)
+            row = conn.execute("SELECT v, created FROM results WHERE k = ?", (k,)).fetchone()
+            if row is None or (self.ttl > 0 and now - row[1] > self.ttl):
+                with self._lock:
+                    self.misses += 1
+                return None
+            conn.execute("UPDATE results SET accessed = ? WHERE k = ?", (now, k))
+        except sqlite3.Error as e:
+            logger.debug("shared cache get failed: %s", e)
+            with self._lock:
+                self.errors += 1
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, generation: str, key: Hashable, value: Any):
+        k = self._hash(generation, key)
+        v = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        now = time.time()
+        try:
+            conn = self._conn()
+            self._sync_generation(conn, generation)
+            conn.execute(
+                "INSERT OR REPLACE INTO results (k, gen, v, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (k, generation, v, len(v), now, now),
+            )
+            with self._lock:
+                self._puts += 1
+                due = self._puts % self.evict_every == 0
+            if due:
+                self._evict(conn)
+        except sqlite3.Error as e:
+            logger.debug("shared cache put failed: %s", e)
+            with self._lock:
+                self.errors += 1
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 上限の 90% まで、最終アクセスが古い順に削除
+        excess = total - int(self.max_bytes * 0.9)
+        cut = conn.execute(
+            "SELECT accessed FROM (SELECT accessed, SUM(size) OVER (ORDER BY accessed) AS acc FROM results)"
+            " WHERE acc >= ? ORDER BY accessed LIMIT 1",
+            (excess,),
+        ).fetchone()
+        if cut is not None:
+            conn.execute("DELETE FROM results WHERE accessed <= ?", (cut[0],))
+
+    def clear(self):
+        try:
+            self._conn().execute("DELETE FROM results")
+        except sqlite3.Error as e:
+            logger.debug("shared cache clear failed: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        size = rows = None
+        try:
+            rows, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "path": self.path,
+                "rows": rows,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "generation": self.generation,
+            }
@@ -0,0 +1,698 @@
+# segmented_index.py — 追加・削除をその場で反映するセグメント型インデックス（LSM 風）
+#
+#   本体（HybridIndex, スナップショットの mmap でもよい）
+#   + 差分セグメント（追加・更新された文書だけの小さな索引。数秒で作れる）
+#   + tombstone（削除・置換された行の dead マスク）
+#
+# - 差分セグメントは本体の IDF・平均文書長・TF-IDF ベクトライザで採点するので、
+#   本体の文書と同じ尺度で 1 本のスコア配列に連結して HybridIndex.search の融合にそのまま流せる。
+# - 変更のたびに不変のビュー（SegmentedView, 新しい世代 ID）を作って差し替える。
+#   検索は開始時に取ったビューだけを見るので、途中で追加・マージが起きても一貫している。
+# - 差分が増えたらバックグラウンドでマージする:
+#     差分セグメントが SEGMENT_MAX_DELTAS 個を超えた → 差分どうしを 1 つにまとめる
+#     差分 + 削除が本体の SEGMENT_COMPACT_RATIO 倍を超えた → 本体ごと作り直す（統計も正確に戻る）
+# - 変更は操作ログ（JSONL）に追記し、起動時に再生する。serve.py の各ワーカーはログの
+#   増分を INDEX_OPLOG_POLL 秒ごとに取り込むので、どのワーカーに POST しても全体に反映される。
+#   /admin/reindex の本体差し替え（{"op": "base", "snapshot": ...}）も同じログで全ワーカーに伝わる。
+# - 操作ログがあるときの本体の作り直し（圧縮）は 1 ワーカーだけが行う（<ログ>.compact.lock）:
+#     新しい本体をスナップショット <INDEX_SNAPSHOT>.<時刻>-compact に書き、畳み込んだ add / delete を
+#     その中の doc_ops.jsonl に残す → ログを「{"op": "base", "reset": true, ...} + 圧縮後に来た操作」に
+#     置き換える（旧ログは <ログ>.1）→ 各ワーカーはログの差し替えに気づいて先頭から読み直し、mmap で切り替える。
+#   スナップショットの meta.json にはログの id と reset 行の次の位置を書くので、再起動はそこから再生する。
+#   起動時の再生では .current から開いた本体を正とし、普通の base 操作は読み飛ばす
+#   （texts.json から作り直した本体なら、reset が指すスナップショットの doc_ops.jsonl を適用し直す）。
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+from bm25_engine import InvertedBM25
+from hybrid_index import HybridIndex, top_n_desc
+from index_snapshot import load_snapshot, prune_versions, read_meta, set_current_snapshot, write_snapshot
+from tokenizer import tokenize_query, encode_corpus
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+SEGMENT_MAX_DELTAS = int(os.getenv("SEGMENT_MAX_DELTAS", "8"))
+SEGMENT_COMPACT_RATIO = float(os.getenv("SEGMENT_COMPACT_RATIO", "0.2"))
+INDEX_OPLOG_POLL = float(os.getenv("INDEX_OPLOG_POLL", "1.0"))
+SNAPSHOT_KEEP = int(os.getenv("REINDEX_KEEP", "3"))
+FOLDED_OPS = "doc_ops.jsonl"  # 圧縮スナップショットに畳み込んだ add / delete
+
+
+def fold_doc_ops(ops: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """add / delete の並びを、id ごとの最終状態（delete 1 件 + add 1 件）に畳む。"""
+    last: Dict[str, Optional[Dict[str, Any]]] = {}
+    for op in ops:
+        if op.get("op") == "add":
+            for d in op.get("docs") or []:
+                if d.get("id"):
+                    last.pop(str(d["id"]), None)
+                    last[str(d["id"])] = d
+        elif op.get("op") == "delete":
+            for i in op.get("ids") or []:
+                last.pop(str(i), None)
+                last[str(i)] = None
+    out: List[Dict[str, Any]] = []
+    deleted = [k for k, d in last.items() if d is None]
+    if deleted:
+        out.append({"op": "delete", "ids": deleted})
+    added = [d for d in last.values() if d is not None]
+    if added:
+        out.append({"op": "add", "docs": added})
+    return out
+
+
+def read_folded_ops(snapshot_dir: Optional[str]) -> List[Dict[str, Any]]:
+    p = os.path.join(snapshot_dir, FOLDED_OPS) if snapshot_dir else ""
+    if not p or not os.path.exists(p):
+        return []
+    with open(p, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _base_idf(base: HybridIndex, terms: List[str], df: np.ndarray, n_docs: int) -> np.ndarray:
+    """差分セグメントの語の IDF。本体にある語は本体の値、無い語は本体の文書数と差分の df から求める。"""
+    bm = base.bm25
+    out = np.empty(len(terms), dtype=np.float64)
+    for i, t in enumerate(terms):
+        if isinstance(bm, InvertedBM25):
+            tid = bm.vocab.get(t)
+            v = None if tid is None else float(bm.idf[tid])
+        else:
+            v = bm.idf.get(t)
+        if v is None:
+            f = float(df[i])
+            v = max(np.log(n_docs - f + 0.5) - np.log(f + 0.5), 0.0)
+        out[i] = v
+    return out
+
+
+class DeltaSegment:
+    """追加分の文書だけの小さな索引（本体の統計・ベクトライザで採点する）。"""
+
+    def __init__(self, docs: List[Dict[str, Any]], base: HybridIndex):
+        self.docs = docs
+        texts = [d.get("text", "") for d in docs]
+        ids, offsets, vocab = encode_corpus(texts)
+        n_terms = max(len(vocab), 1)
+        doc_of = np.repeat(np.arange(len(docs), dtype=np.int64), np.diff(offsets))
+        df = np.bincount(np.unique(doc_of * n_terms + ids) % n_terms, minlength=len(vocab))
+        bm = base.bm25
+        idf = _base_idf(base, list(vocab), df, bm.corpus_size + len(docs))
+        self.bm25 = InvertedBM25.from_token_ids(
+            ids, offsets, vocab, k1=bm.k1, b=bm.b, epsilon=getattr(bm, "epsilon", 0.25),
+            idf=idf, avgdl=bm.avgdl,
+        )
+        self.tfidf = normalize(base.vectorizer.transform(texts)).tocsr()
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+
+class ChainDocs:
+    """複数セグメントの docs を 1 本の読み取り専用シーケンスに見せる。"""
+
+    def __init__(self, parts: List[Any]):
+        self.parts = parts
+        self.starts = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in parts], out=self.starts[1:])
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s = int(np.searchsorted(self.starts, i, side="right")) - 1
+        return self.parts[s][i - int(self.starts[s])]
+
+
+class SegmentedView(HybridIndex):
+    """本体 + 差分セグメント + tombstone の不変スナップショット（HybridIndex として検索できる）。
+
+    行番号は本体 → 差分の順に連結した通し番号。削除済みの行はスコア 0 にして候補から外す。
+    """
+
+    def __init__(self, base: HybridIndex, deltas: List[DeltaSegment], dead: np.ndarray, generation: str):
+        self.base = base
+        self.deltas = deltas
+        self.docs = ChainDocs([base.docs] + [s.docs for s in deltas])
+        self.corpus = None
+        self.bm25 = base.bm25
+        self.vectorizer = base.vectorizer
+        # TF-IDF はセグメントごとの行列のまま使う（全体を vstack した行列は作らない）
+        self.tfidf_parts = [base.tfidf] + [s.tfidf for s in deltas]
+        self.dead = dead
+        self.starts = self.docs.starts
+        self.generation = generation
+        self.snapshot_path = base.snapshot_path
+
+    def _dense_leg(self):
+        # FAISS は本体の文書だけ（行番号は本体が先頭なのでそのまま使える。差分の文書は BM25 側で拾う）
+        return self.base._dense_leg()
+
+    def _kill(self, a: np.ndarray) -> np.ndarray:
+        a[self.dead] = 0.0
+        return a
+
+    def _score_bm25(self, q: str) -> np.ndarray:
+        toks = tokenize_query(q)
+        parts = [self.base._score_bm25(q)] + [s.bm25.get_scores(toks) for s in self.deltas]
+        return self._kill(np.concatenate(parts))
+
+    def _bm25_candidates(self, q: str, n: int):
+        base_n = len(self.base.docs)
+        n_dead = int(self.dead[:base_n].sum())
+        idx, sc = self.base._bm25_candidates(q, n + n_dead)
+        keep = ~self.dead[idx]
+        idx, sc = [idx[keep]], [sc[keep]]
+        toks = tokenize_query(q)
+        for k, seg in enumerate(self.deltas):
+            s = seg.bm25.get_scores(toks)
+            hit = np.flatnonzero(s > 0)
+            hit = hit + int(self.starts[k + 1])
+            hit = hit[~self.dead[hit]]
+            idx.append(hit)
+            sc.append(s[hit - int(self.starts[k + 1])])
+        idx, sc = np.concatenate(idx).astype(np.int64), np.concatenate(sc)
+        top = top_n_desc(sc, n)
+        return idx[top], sc[top]
+
+    def _score_vec(self, q: str, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        qv = normalize(self.vectorizer.transform([q]))
+        if rows is not None:
+            return np.asarray((qv @ self._tfidf_rows(rows).T).toarray()[0], dtype=float)
+        parts = [np.asarray((qv @ m.T).toarray()[0], dtype=float) for m in self.tfidf_parts]
+        return self._kill(np.concatenate(parts))
+
+    def _tfidf_rows(self, rows: np.ndarray) -> sp.csr_matrix:
+        rows = np.asarray(rows, dtype=np.int64)
+        seg = np.searchsorted(self.starts, rows, side="right") - 1
+        blocks, where = [], []
+        for k in np.unique(seg).tolist():
+            sel = np.flatnonzero(seg == k)
+            blocks.append(self.tfidf_parts[k][rows[sel] - int(self.starts[k])])
+            where.append(sel)
+        order = np.argsort(np.concatenate(where))
+        return sp.vstack(blocks, format="csr")[order]
+
+    def _drop_dead(self, m: sp.csr_matrix) -> sp.csr_matrix:
+        m = (m @ sp.diags((~self.dead).astype(np.float64))).tocsr()
+        m.eliminate_zeros()
+        return m
+
+    def _score_bm25_many(self, queries: List[str]) -> sp.csr_matrix:
+        parts = [self.base._score_bm25_many(queries)]
+        for s in self.deltas:
+            parts.append(sp.csr_matrix(np.vstack([s.bm25.get_scores(tokenize_query(q)) for q in queries])))
+        return self._drop_dead(sp.hstack(parts, format="csr"))
+
+    def _score_vec_many(self, queries: List[str]) -> sp.csr_matrix:
+        qv = normalize(self.vectorizer.transform(queries))
+        parts = [qv @ m.T for m in self.tfidf_parts]
+        return self._drop_dead(sp.hstack(parts, format="csr"))
+
+
+class LiveIndex:
+    """追加・削除を受け付けるインデックス管理。検索は ``current``（その時点の不変ビュー）に対して行う。
+
+    文書は ``id`` で識別する。同じ id の追加は置換（古い行は tombstone）。
+    """
+
+    def __init__(self, base: HybridIndex, oplog_path: str = "", snapshot_dir: str = "",
+                 max_deltas: int = SEGMENT_MAX_DELTAS, compact_ratio: float = SEGMENT_COMPACT_RATIO,
+                 poll: float = INDEX_OPLOG_POLL):
+        self.oplog_path = oplog_path
+        self.snapshot_dir = snapshot_dir
+        self.max_deltas = max_deltas
+        self.compact_ratio = compact_ratio
+        self.poll = poll
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._base = base
+        self._deltas: List[DeltaSegment] = []
+        self._dead: Dict[Any, np.ndarray] = {base: np.zeros(len(base.docs), dtype=bool)}  # セグメント -> dead マスク
+        self._where_map: Optional[Dict[str, Tuple[Any, int]]] = None  # doc id -> (セグメント, 行)
+        self._applied = 0  # 取り込んだ操作ログの行数
+        self._doc_ops: List[Dict[str, Any]] = []  # これまでの add / delete（本体差し替え時に再適用）
+        self._folded_from: Optional[str] = None  # それより前の add / delete を畳み込んだ圧縮スナップショット
+        self._oplog_pos = 0
+        self._oplog_ino: Optional[int] = None  # ログが差し替わったら先頭から読み直す
+        self._replaying = False
+        self._next_poll = 0.0
+        self._view: HybridIndex = base
+        self._wake = threading.Event()
+        self._merger: Optional[threading.Thread] = None
+        self._merger_pid: Optional[int] = None
+        self._merging: Optional[str] = None
+        self.merges = 0
+        self.compactions = 0
+        self.last_merge_sec: Optional[float] = None
+        if oplog_path:
+            d = os.path.dirname(oplog_path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            # 本体がこのログを圧縮して作ったスナップショットなら、reset 行の次から再生する
+            mark = (read_meta(base.snapshot_path) or {}).get("oplog") if base.snapshot_path else None
+            head = self._oplog_head()
+            if mark and head and head.get("reset") and head.get("id") == mark.get("id"):
+                self._oplog_pos = int(mark["offset"])
+                self._applied = 1
+                self._folded_from = base.snapshot_path
+            self._replaying = True
+            try:
+                self.sync(force=True, kick=False)  # 起動時の再生（fork 前なのでマージスレッドはまだ起こさない）
+            finally:
+                self._replaying = False
+
+    # ------------------------------------------------------------------ 読み取り
+    @property
+    def current(self) -> HybridIndex:
+        if self.oplog_path and time.monotonic() >= self._next_poll:
+            self.sync()
+        return self._view
+
+    @property
+    def base(self) -> HybridIndex:
+        return self._base
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            dead = sum(int(m.sum()) for m in self._dead.values())
+            return {
+                "base_docs": len(self._base.docs),
+                "delta_segments": len(self._deltas),
+                "delta_docs": sum(len(s) for s in self._deltas),
+                "tombstones": dead,
+                "live_docs": sum(len(m) for m in self._dead.values()) - dead,
+                "oplog": self.oplog_path or None,
+                "ops_applied": self._applied,
+                "oplog_pos": self._oplog_pos,
+                "merging": self._merging,
+                "merges": self.merges,
+                "compactions": self.compactions,
+                "last_merge_sec": self.last_merge_sec,
+                "generation": self._view.generation,
+            }
+
+    # ------------------------------------------------------------------ 書き込み
+    @property
+    def _where(self) -> Dict[str, Tuple[Any, int]]:
+        # 本体の id 表は最初の書き込み時に作る（スナップショットの docs を起動時に全部デコードしない）
+        if self._where_map is None:
+            self._where_map = {
+                str(d["id"]): (self._base, i) for i, d in enumerate(self._base.docs) if d.get("id") is not None
+            }
+        return self._where_map
+
+    def add_docs(self, docs: List[Dict[str, Any]]) -> HybridIndex:
+        """文書を追加（同じ id は置換）して、反映後のビューを返す。"""
+        for d in docs:
+            if not d.get("id"):
+                raise ValueError("doc には id が必要です")
+        return self._submit({"op": "add", "docs": docs})
+
+    def delete_docs(self, ids: Iterable[str]) -> HybridIndex:
+        return self._submit({"op": "delete", "ids": [str(i) for i in ids]})
+
+    def _submit(self, op: Dict[str, Any]) -> HybridIndex:
+        if not self.oplog_path:
+            with self._lock:
+                self._apply(op)
+                self._applied += 1
+                self._publish()
+            self._kick()
+            return self._view
+        # ログ経由で適用する（他のワーカーも同じ順で取り込む）
+        line = (json.dumps(dict(op, ts=time.time()), ensure_ascii=False) + "\n").encode("utf-8")
+        with self._oplog_locked():
+            fd = os.open(self.oplog_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        self.sync(force=True)
+        return self._view
+
+    @contextmanager
+    def _oplog_locked(self):
+        """追記と圧縮時のログ差し替えを（プロセスをまたいで）排他する。"""
+        with open(f"{self.oplog_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _oplog_head(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.oplog_path, "rb") as f:
+                return json.loads(f.readline())
+        except (OSError, ValueError):
+            return None
+
+    def sync(self, force: bool = False, kick: bool = True):
+        """操作ログの増分を取り込む（他スレッドが取り込み中なら force でない限り待たない）。"""
+        if not self._sync_lock.acquire(blocking=force):
+            return
+        try:
+            self._next_poll = time.monotonic() + self.poll
+            try:
+                f = open(self.oplog_path, "rb")
+            except OSError:
+                return
+            with f:
+                st = os.fstat(f.fileno())
+                if self._oplog_ino is None:
+                    self._oplog_ino = st.st_ino
+                elif st.st_ino != self._oplog_ino or st.st_size < self._oplog_pos:
+                    # 圧縮でログが差し替わった（先頭の reset から読み直す）
+                    self._oplog_ino, self._oplog_pos, self._applied = st.st_ino, 0, 0
+                if st.st_size <= self._oplog_pos:
+                    return
+                f.seek(self._oplog_pos)
+                chunk = f.read(st.st_size - self._oplog_pos)
+            end = chunk.rfind(b"\n") + 1  # 書きかけの最終行は次回に回す
+            if end <= 0:
+                return
+            ops = []
+            for raw in chunk[:end].splitlines():
+                try:
+                    ops.append(json.loads(raw))
+                except ValueError:
+                    logger.warning("操作ログの壊れた行を読み飛ばします: %r", raw[:80])
+            with self._lock:
+                self._apply_many(ops)
+                self._oplog_pos += end
+                self._applied += len(ops)
+                self._publish()
+        finally:
+            self._sync_lock.release()
+            if kick:
+                self._kick()
+
+    def swap_base(self, snapshot: Optional[str] = None, index: Optional[HybridIndex] = None) -> HybridIndex:
+        """本体を差し替える（/admin/reindex 用）。これまでの追加・削除は新しい本体の上に適用し直す。
+
+        snapshot を渡すと操作ログ経由になり、全ワーカーが同じスナップショットに切り替わる。
+        """
+        if snapshot and self.oplog_path:
+            return self._submit({"op": "base", "snapshot": snapshot})
+        if index is None:
+            index = load_snapshot(snapshot)
+        with self._lock:
+            self._set_base(index)
+            self._publish()
+        return self._view
+
+    def _set_base(self, index: HybridIndex, reapply: bool = True):
+        self._base = index
+        self._deltas = []
+        self._dead = {index: np.zeros(len(index.docs), dtype=bool)}
+        self._where_map = None
+        if reapply:
+            self._apply_many(self._all_doc_ops(), record=False)
+
+    def _all_doc_ops(self) -> List[Dict[str, Any]]:
+        """本体を差し替えるときに適用し直す add / delete（圧縮で畳み込んだ分 + その後の分）。"""
+        return read_folded_ops(self._folded_from) + self._doc_ops
+
+    def _reset_base(self, op: Dict[str, Any]):
+        """圧縮の reset: スナップショットに畳み込まれた本体へ切り替え、それまでの操作を忘れる。"""
+        path = op.get("snapshot")
+        same = bool(self._base.snapshot_path) and os.path.abspath(self._base.snapshot_path) == os.path.abspath(path or "")
+        if self._replaying and not same:
+            # 起動時に別の本体（texts.json から作り直したもの等）で開いた: 畳み込まれた変更をその上に適用する
+            self._apply_many(read_folded_ops(path))
+            return
+        index = self._base
+        if not same:
+            try:
+                index = load_snapshot(path)
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning("圧縮した本体に切り替えられません（%s）: %s", path, e)
+                return
+        self._set_base(index, reapply=False)
+        self._doc_ops = []
+        self._folded_from = path
+
+    def _apply_many(self, ops: List[Dict[str, Any]], record: bool = True):
+        # 連続する add はまとめて 1 セグメントにする（起動時の再生で差分が細切れにならないように）
+        batch: List[Dict[str, Any]] = []
+        for op in ops:
+            if op.get("op") == "add":
+                batch.extend(op.get("docs") or [])
+                continue
+            if batch:
+                self._apply({"op": "add", "docs": batch}, record)
+                batch = []
+            self._apply(op, record)
+        if batch:
+            self._apply({"op": "add", "docs": batch}, record)
+
+    def _apply(self, op: Dict[str, Any], record: bool = True):
+        kind = op.get("op")
+        if kind == "base" and op.get("reset"):
+            self._reset_base(op)
+            return
+        if kind == "base":
+            if self._replaying:
+                return  # 起動時は .current から開いた本体が最新（再生で古い世代に戻さない）
+            try:
+                index = load_snapshot(op["snapshot"])
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning("本体の差し替えに失敗しました（%s）: %s", op.get("snapshot"), e)
+                return
+            self._set_base(index)
+            return
+        if record and kind in ("add", "delete"):
+            self._doc_ops.append(op)  # 本体を差し替えたときに適用し直す
+        if kind == "delete":
+            for i in op.get("ids") or []:
+                self._tombstone(str(i))
+        elif kind == "add":
+            # 同じリクエスト内の重複 id は後勝ち
+            docs = list({str(d["id"]): d for d in op.get("docs") or [] if d.get("id")}.values())
+            if not docs:
+                return
+            for d in docs:
+                self._tombstone(str(d["id"]))
+            seg = DeltaSegment(docs, self._base)
+            self._deltas = self._deltas + [seg]
+            self._dead[seg] = np.zeros(len(docs), dtype=bool)
+            for i, d in enumerate(docs):
+                self._where[str(d["id"])] = (seg, i)
+        else:
+            logger.warning("未知の操作を無視します: %s", kind)
+
+    def _tombstone(self, doc_id: str):
+        loc = self._where.pop(doc_id, None)
+        if loc is None:
+            return
+        seg, row = loc
+        mask = self._dead[seg].copy()  # ビューが参照中の配列は書き換えない
+        mask[row] = True
+        self._dead[seg] = mask
+
+    def _publish(self):
+        segs = [self._base] + self._deltas
+        dead = np.concatenate([self._dead[s] for s in segs])
+        if not self._deltas and not dead.any():
+            self._view = self._base
+            return
+        # 同じ本体に同じ操作ログを適用したワーカーどうしは同じ世代になる（共有キャッシュが使い回せる）
+        gen = f"{self._base.generation}+{self._applied}"
+        self._view = SegmentedView(self._base, self._deltas, dead, gen)
+
+    # ------------------------------------------------------------------ マージ
+    def _kick(self):
+        with self._lock:
+            if not self._needs_merge():
+                return
+            # fork 後の子プロセスにはスレッドが引き継がれないので、プロセスごとに起こす
+            if self._merger is None or not self._merger.is_alive() or self._merger_pid != os.getpid():
+                self._wake = threading.Event()
+                self._merger = threading.Thread(target=self._merge_loop, name="segment-merge", daemon=True)
+                self._merger_pid = os.getpid()
+                self._merger.start()
+            self._wake.set()
+
+    def _needs_merge(self) -> str:
+        base_n = max(len(self._base.docs), 1)
+        changed = sum(len(s) for s in self._deltas) + int(self._dead[self._base].sum())
+        if changed and changed >= self.compact_ratio * base_n:
+            return "compact"
+        if len(self._deltas) > self.max_deltas:
+            return "deltas"
+        return ""
+
+    def _merge_loop(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            while True:
+                with self._lock:
+                    kind = self._needs_merge()
+                if not kind:
+                    break
+                try:
+                    if not self.merge(full=(kind == "compact")):
+                        break  # 他のワーカーが圧縮中（reset がログで届く）
+                except Exception:
+                    logger.exception("segment merge failed")
+                    break
+
+    def merge(self, full: bool = False) -> bool:
+        """差分セグメントを 1 つにまとめる（full=True なら本体ごと作り直して tombstone も消す）。
+
+        構築はロックの外で行い、その間の追加・削除は差し替え時に反映する。
+        操作ログがあるときの full は、1 ワーカーだけがスナップショットに書いてログ経由で全員を切り替える。
+        マージしなかったら False。
+        """
+        if full and self.oplog_path and isinstance(self._base.bm25, InvertedBM25):
+            return self._compact_via_oplog()
+        with self._lock:
+            if self._merging:
+                return False
+            segs = ([self._base] if full else []) + list(self._deltas)
+            if not segs:
+                return False
+            self._merging = "compact" if full else "deltas"
+            live: List[Tuple[Any, int, Dict[str, Any]]] = []
+            for s in segs:
+                mask = self._dead[s]
+                for i in np.flatnonzero(~mask).tolist():
+                    live.append((s, i, s.docs[i]))
+            base = self._base
+        t0 = time.perf_counter()
+        try:
+            docs = [d for _, _, d in live]
+            merged: Any = HybridIndex(docs) if full else DeltaSegment(docs, base)
+        except Exception:
+            with self._lock:
+                self._merging = None
+            raise
+        with self._lock:
+            self._merging = None
+            if self._base is not base:
+                return False  # その間に本体が差し替わった（次のループでやり直す）
+            # マージ中に削除・置換された文書は新しいセグメントでも tombstone にする
+            mask = np.zeros(len(docs), dtype=bool)
+            for j, (s, i, d) in enumerate(live):
+                key = d.get("id")
+                if key is None:
+                    mask[j] = self._dead[s][i]
+                    continue
+                key = str(key)
+                if self._where.get(key) == (s, i):
+                    self._where[key] = (merged, j)
+                else:
+                    mask[j] = True
+            for s in segs:
+                self._dead.pop(s, None)
+            self._dead[merged] = mask
+            rest = [s for s in self._deltas if s not in segs]
+            if full:
+                self._base = merged
+                # 残りの差分は新しい本体の統計・語彙で作り直す
+                rebuilt = []
+                for s in rest:
+                    r = DeltaSegment(s.docs, merged)
+                    self._dead[r] = self._dead.pop(s)
+                    for i, d in enumerate(s.docs):
+                        key = d.get("id")
+                        if key is not None and self._where.get(str(key)) == (s, i):
+                            self._where[str(key)] = (r, i)
+                    rebuilt.append(r)
+                self._deltas = rebuilt
+                self.compactions += 1
+            else:
+                self._deltas = [merged] + rest
+                self.merges += 1
+            self.last_merge_sec = round(time.perf_counter() - t0, 3)
+            self._publish()
+        logger.info("segments merged (%s): docs=%d %.1fs", "compact" if full else "deltas",
+                    len(docs), self.last_merge_sec)
+        return True
+
+    def _compact_via_oplog(self) -> bool:
+        root = self.snapshot_dir or f"{self.oplog_path}.snapshot"
+        with open(f"{self.oplog_path}.compact.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            # 直前に他のワーカーが圧縮を終えていれば、その reset を取り込んだ時点で不要になる
+            self.sync(force=True, kick=False)
+            with self._lock:
+                if self._merging or self._needs_merge() != "compact":
+                    return False
+                self._merging = "compact"
+                base = self._base
+                docs = [s.docs[i] for s in [base] + self._deltas for i in np.flatnonzero(~self._dead[s]).tolist()]
+                folded = fold_doc_ops(self._all_doc_ops())
+                pos, ino = self._oplog_pos, self._oplog_ino
+            t0 = time.perf_counter()
+            try:
+                index = HybridIndex(docs)
+                out = f"{root}.{time.strftime('%Y%m%d-%H%M%S')}-compact"
+                reset = {"op": "base", "snapshot": out, "reset": True, "id": uuid.uuid4().hex, "ts": time.time()}
+                line = (json.dumps(reset, ensure_ascii=False) + "\n").encode("utf-8")
+                source = (read_meta(base.snapshot_path) or {}).get("source", {}) if base.snapshot_path else {}
+                write_snapshot(index, out, extra_meta={"source": source,
+                                                       "oplog": {"id": reset["id"], "offset": len(line)}})
+                with open(os.path.join(out, FOLDED_OPS), "w", encoding="utf-8") as f:
+                    for op in folded:
+                        f.write(json.dumps(op, ensure_ascii=False) + "\n")
+                if not self._rotate_oplog(line, pos, ino):
+                    shutil.rmtree(out, ignore_errors=True)
+                    return False
+                if self.snapshot_dir:
+                    set_current_snapshot(self.snapshot_dir, out)
+                prune_versions(root, SNAPSHOT_KEEP, protect=(out, base.snapshot_path))
+            finally:
+                with self._lock:
+                    self._merging = None
+        self.sync(force=True, kick=False)
+        with self._lock:
+            self.compactions += 1
+            self.last_merge_sec = round(time.perf_counter() - t0, 3)
+        logger.info("segments compacted into %s: docs=%d %.1fs", out, len(docs), self.last_merge_sec)
+        return True
+
+    def _rotate_oplog(self, reset_line: bytes, pos: int, ino: Optional[int]) -> bool:
+        """ログを reset 行 + pos 以降の操作に置き換える（旧ログは <ログ>.1）。pos 以降は圧縮に入っていない。"""
+        with self._oplog_locked():
+            try:
+                with open(self.oplog_path, "rb") as f:
+                    if os.fstat(f.fileno()).st_ino != ino:
+                        return False
+                    f.seek(pos)
+                    tail = f.read()
+            except OSError:
+                return False
+            tmp = f"{self.oplog_path}.tmp-{os.getpid()}"
+            with open(tmp, "wb") as f:
+                f.write(reset_line + tail[:tail.rfind(b"\n") + 1])
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.oplog_path, f"{self.oplog_path}.1")
+            os.replace(tmp, self.oplog_path)
+        return True
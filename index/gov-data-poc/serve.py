@@ -0,0 +1,151 @@
+# serve.py — インデックスを親プロセスで 1 回だけ読み込み、fork した uvicorn ワーカーで共有する
+#
+# `uvicorn qa_service:app --workers N` は各ワーカーが spawn で起動し、それぞれが HybridIndex を
+# 持つため RSS がワーカー数に比例する。こちらは
+#   1) 親でスナップショット（index_snapshot.py）を mmap で開く（無ければ構築して書き出す）
+#   2) gc.freeze() で既存オブジェクトを GC 対象から外し、参照カウント以外の書き込みを防ぐ
+#   3) 待受ソケットを作ってから fork し、各ワーカーは同じソケットで uvicorn を動かす
+# ので、BM25/TF-IDF の配列はページキャッシュ（mmap）または copy-on-write で全ワーカー共有になる。
+#
+# 使い方:
+#   python serve.py --workers 4 --host 0.0.0.0 --port 8010
+
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+from typing import Dict
+
+import uvicorn
+
+logger = logging.getLogger("serve")
+
+
+def ensure_snapshot(texts_json: str, snapshot_dir: str):
+    """スナップショットが無い・texts.json より古いときは親で 1 回だけ構築して書き出す（以後は mmap で共有）。"""
+    from hybrid_index import HybridIndex, load_texts
+    from index_snapshot import current_snapshot, is_stale, read_meta, set_current_snapshot, write_snapshot
+
+    current = current_snapshot(snapshot_dir)
+    meta = read_meta(current)
+    if meta is not None and not is_stale(meta, texts_json):
+        return
+    docs = load_texts(texts_json)
+    if not docs:
+        return
+    t0 = time.perf_counter()
+    write_snapshot(HybridIndex(docs), snapshot_dir, texts_json=texts_json)
+    if current != snapshot_dir:
+        # /admin/reindex の世代を指していたら、作り直した本体に向け直す
+        set_current_snapshot(snapshot_dir, snapshot_dir)
+    logger.info("snapshot %s: %s (%.1fs)", "rebuilt (stale)" if meta is not None else "built",
+                snapshot_dir, time.perf_counter() - t0)
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock: socket.socket, args) -> int:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    config = uvicorn.Config(
+        app,
+        log_level=args.log_level,
+        proxy_headers=args.proxy_headers,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+    return 0
+
+
+def spawn(app, sock: socket.socket, args) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            code = run_worker(app, sock, args)
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    ap = argparse.ArgumentParser(description="インデックス共有モードで qa_service を起動する")
+    ap.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("PORT", "8010")))
+    ap.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    ap.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info").lower())
+    ap.add_argument("--proxy-headers", action="store_true")
+    ap.add_argument("--forwarded-allow-ips", default="127.0.0.1")
+    ap.add_argument("--no-snapshot", action="store_true",
+                    help="スナップショットを作らず、親で構築したヒープ上の配列を copy-on-write で共有する")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if not args.no_snapshot:
+        snapshot_dir = os.getenv("INDEX_SNAPSHOT", "./data/db/hybrid_snapshot")
+        ensure_snapshot(os.getenv("TEXTS_JSON", "./data/db/texts.json"), snapshot_dir)
+    else:
+        os.environ["INDEX_SNAPSHOT"] = ""
+
+    # ここで LIVE（インデックス）が開かれる（親で 1 回だけ）
+    import qa_service
+
+    gc.collect()
+    gc.freeze()
+
+    sock = bind_socket(args.host, args.port)
+    index = qa_service.LIVE.current
+    logger.info("shared index: docs=%d generation=%s workers=%d",
+                len(index.docs), index.generation, args.workers)
+
+    children: Dict[int, int] = {}  # pid -> slot
+    for slot in range(args.workers):
+        children[spawn(qa_service.app, sock, args)] = slot
+
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    # 落ちたワーカーは作り直す（停止中は待つだけ）
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot = children.pop(pid, None)
+        if slot is None or stopping:
+            continue
+        logger.warning("worker %d exited (status=%d); restarting", pid, status)
+        children[spawn(qa_service.app, sock, args)] = slot
+
+    sock.close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,7 @@ pip install -r .\requirements.txt
 if (-not $NoIndex) {
   python .\bm25_index.py
   python .\build_bm25.py
+  python .\index_snapshot.py
 }
 
 uvicorn qa_service:app --host 127.0.0.1 --port 8010 --reload
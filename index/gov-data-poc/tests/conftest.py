@@ -0,0 +1,5 @@
+# gov-data-poc のモジュールは平置きなので、どこから pytest を起動しても import できるようにする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
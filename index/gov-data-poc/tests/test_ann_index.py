@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import ann_index
+
+
+def _data(n=2000, d=16, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n, d)).astype("float32")
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    # embed.py のラベルは sha1 由来の符号付き int64
+    labels = rng.integers(-2 ** 62, 2 ** 62, size=n, dtype=np.int64)
+    return X, labels
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf_flat", "hnsw"])
+def test_remove_drops_labels(kind):
+    X, labels = _data()
+    index, p = ann_index.build(X, labels, kind=kind, codec="flat", reduce="")
+    gone = labels[:50]
+    index = ann_index.remove(index, gone, p)
+    assert index.ntotal == len(labels) - len(gone)
+    assert not np.isin(ann_index.labels_of(index), gone).any()
+    _, got = ann_index.search(index, X[:50], 5)
+    assert not np.isin(got, gone).any()
+
+
+def test_reconstruct_flat_is_exact():
+    X, labels = _data(n=300)
+    index, _ = ann_index.build(X, labels, kind="flat", codec="flat", reduce="")
+    got_labels, V = ann_index.all_vectors(index)
+    order = np.argsort(got_labels)
+    ref = np.argsort(labels)
+    assert np.array_equal(got_labels[order], labels[ref])
+    assert np.array_equal(V[order], X[ref])
+
+
+def test_compressed_index_reranks_with_raw_vectors(tmp_path):
+    X, labels = _data()
+    index, p = ann_index.build(X, labels, kind="flat", codec="int8", reduce="")
+    raw = ann_index.RawVectors.from_unsorted(labels, X)
+    path = str(tmp_path / "faiss.index")
+    ann_index.save(index, p, path, raw)
+    loaded, p2 = ann_index.load(path)
+    assert ann_index.spec(p2) == ("flat", "int8", "")
+    raw2 = ann_index.RawVectors.open(path)
+    sims, got = ann_index.search(loaded, X[:20], 1, raw2)
+    # 元ベクトルで並べ直すので自分自身が内積 1 で 1 位
+    assert np.array_equal(got[:, 0], labels[:20])
+    assert np.allclose(sims[:, 0], 1.0, atol=1e-5)
+
+    raw3 = raw2.updated(labels[:10], np.zeros(0, dtype=np.int64), np.zeros((0, X.shape[1]), dtype="float32"))
+    _, hit = raw3.get(labels[:20])
+    assert not hit[:10].any() and hit[10:].all()
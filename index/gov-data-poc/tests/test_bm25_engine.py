@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from bm25_engine import InvertedBM25
+
+rank_bm25 = pytest.importorskip("rank_bm25")
+
+
+def _corpus(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    # 小さなコーパスでは IDF が負になる語（epsilon の下限）も混ざる
+    return [[f"w{int(x)}" for x in rng.zipf(1.4, size=rng.integers(1, 40)) if x < 200] or ["w1"] for _ in range(n)]
+
+
+def test_scores_match_rank_bm25():
+    corpus = _corpus()
+    ours, ref = InvertedBM25(corpus), rank_bm25.BM25Okapi(corpus)
+    for q in (["w1"], ["w2", "w3", "w2"], ["w5", "w150", "nope"], ["nope"]):
+        assert np.allclose(ours.get_scores(q), ref.get_scores(q), rtol=0, atol=1e-12)
+
+
+def test_top_k_is_exact():
+    corpus = _corpus(seed=1)
+    bm = InvertedBM25(corpus)
+    rng = np.random.default_rng(2)
+    for _ in range(100):
+        q = [f"w{int(x)}" for x in rng.integers(1, 60, size=rng.integers(1, 5))]
+        full = bm.get_scores(q)
+        hit = np.unique(np.concatenate([bm._postings(bm.vocab[t])[0] for t in q if t in bm.vocab] or [[]]).astype(int))
+        for k in (1, 7, 50):
+            ids, scores = bm.top_k(q, k)
+            assert np.allclose(scores, np.sort(full[hit])[::-1][:k])
+            assert np.allclose(full[ids], scores)
+            assert len(set(ids.tolist())) == len(ids)
+
+
+def test_top_k_without_known_terms():
+    bm = InvertedBM25([["a", "b"], ["b"]])
+    ids, scores = bm.top_k(["zzz"], 5)
+    assert len(ids) == 0 and len(scores) == 0
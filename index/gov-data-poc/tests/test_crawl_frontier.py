@@ -0,0 +1,47 @@
+from crawl_frontier import Frontier
+
+
+def _items(urls, depth=0, prio=None):
+    return [(u, u.split("/")[2], depth, depth if prio is None else prio) for u in urls]
+
+
+def test_push_dedups_and_pops_by_priority(tmp_path):
+    f = Frontier(tmp_path / "frontier.sqlite")
+    assert f.push_many(_items(["https://a.go.jp/1", "https://a.go.jp/2"], depth=1)) == 2
+    assert f.push_many(_items(["https://a.go.jp/1", "https://b.go.jp/x.pdf"], depth=1, prio=0.0)) == 1
+    assert f.stats() == {"seen": 3, "pending": 3}
+    order = []
+    while (item := f.pop()) is not None:
+        order.append(item[1]); f.done(item[0])
+    assert order == ["https://b.go.jp/x.pdf", "https://a.go.jp/1", "https://a.go.jp/2"]
+    f.checkpoint()
+    # 済を消しても既出のまま（同じ URL は二度と入らない）
+    assert f.push_many(_items(["https://a.go.jp/1"])) == 0
+    f.close()
+
+
+def test_pop_skips_busy_domains(tmp_path):
+    f = Frontier(tmp_path / "frontier.sqlite")
+    f.push_many(_items(["https://a.go.jp/1", "https://a.go.jp/2", "https://b.go.jp/1"]))
+    assert f.pop()[1] == "https://a.go.jp/1"
+    assert f.pop({"a.go.jp"})[1] == "https://b.go.jp/1"
+    assert f.pop({"a.go.jp", "b.go.jp"}) is None
+    f.close()
+
+
+def test_resume_requeues_inflight(tmp_path):
+    path = tmp_path / "frontier.sqlite"
+    f = Frontier(path)
+    f.push_many(_items(["https://a.go.jp/1", "https://a.go.jp/2", "https://a.go.jp/3"]))
+    s1, _, _ = f.pop(); f.done(s1)
+    f.pop()  # 取得中のまま落ちる
+    f.count_fetch("a.go.jp"); f.count_fetch("a.go.jp")
+    f.close()
+
+    f = Frontier(path)
+    assert f.resume() == 2
+    assert f.pop()[1] == "https://a.go.jp/2"
+    assert f.fetched("a.go.jp") == 2 and f.fetched("b.go.jp") == 0
+    f.reset()
+    assert f.stats() == {"seen": 0, "pending": 0} and f.fetched("a.go.jp") == 0
+    f.close()
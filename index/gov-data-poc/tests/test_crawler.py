@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+
+import httpx
+import pytest
+
+import crawler
+from manifest_store import ManifestStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(crawler, "RAW_DIR", tmp_path / "raw")
+    s = ManifestStore(tmp_path / "meta" / "manifest.sqlite")
+    yield s
+    s.close()
+
+
+def _crawler(store, handler, **kw):
+    c = crawler.AsyncCrawler(store, ignore_robots=True, **kw)
+    c.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return c
+
+
+def test_concurrent_across_domains_but_polite_per_domain(store):
+    active: dict = {}
+    peak: dict = {}
+
+    async def handler(request):
+        dom = request.url.host
+        active[dom] = active.get(dom, 0) + 1
+        peak[dom] = max(peak.get(dom, 0), active[dom])
+        peak["all"] = max(peak.get("all", 0), sum(active.values()))
+        await asyncio.sleep(0.05)
+        active[dom] -= 1
+        return httpx.Response(200, content=b"<html>" + request.url.path.encode() + b"</html>")
+
+    async def run():
+        c = _crawler(store, handler, concurrency=8, per_domain=1, rate=1000.0)
+        async with c.client:
+            urls = [f"https://d{d}.go.jp/p{i}.html" for d in range(4) for i in range(3)]
+            await asyncio.gather(*(c.record(u) for u in urls))
+
+    asyncio.run(run())
+    assert all(peak[f"d{d}.go.jp"] == 1 for d in range(4))
+    assert peak["all"] > 1
+    assert len(store) == 12
+
+
+def test_record_detects_changes_and_keeps_parse_needed(store):
+    body = {"v": b"<html>v1</html>"}
+
+    def handler(request):
+        if request.headers.get("If-None-Match") == '"e"' and body["v"] == b"<html>v1</html>":
+            return httpx.Response(304, headers={"ETag": '"e"'})
+        return httpx.Response(200, content=body["v"], headers={"ETag": '"e"'})
+
+    u = "https://a.go.jp/x.html"
+
+    async def fetch():
+        c = _crawler(store, handler, rate=1000.0)
+        async with c.client:
+            return await c.record(u)
+
+    assert asyncio.run(fetch()) == crawler.raw_path(u)
+    assert crawler.raw_path(u).read_bytes() == b"<html>v1</html>"
+    first = store.get(u)
+    assert first["parse_needed"]
+    store.mark_parsed([(u, "doc")])
+
+    asyncio.run(fetch())  # 304：変わっていない
+    assert not store.get(u)["parse_needed"] and store.get(u)["content_hash"] == first["content_hash"]
+
+    body["v"] = b"<html>v2</html>"
+    asyncio.run(fetch())
+    assert crawler.raw_path(u).read_bytes() == b"<html>v2</html>"
+    meta = store.get(u)
+    assert meta["parse_needed"] and meta["content_hash"] != first["content_hash"] and meta["doc_id"] == "doc"
+    assert list(crawler.RAW_DIR.iterdir()) == [crawler.raw_path(u)]
+
+
+def test_limiter_caps_rate_from_robots():
+    lim = crawler.DomainLimiter(rate=1.0, max_rate=4.0)
+    lim.set_robots(crawler.parse_robots(200, "User-agent: *\nCrawl-delay: 5\n"))
+    assert lim.max_rate == pytest.approx(0.2) and lim.rate == pytest.approx(0.2)
+    for _ in range(20):
+        lim.observe(200, 0.01)
+    assert lim.rate == pytest.approx(0.2)
+
+    lim = crawler.DomainLimiter(rate=1.0, max_rate=4.0)
+    lim.set_robots(crawler.parse_robots(200, "User-agent: *\nRequest-rate: 1/10\n"))
+    assert lim.max_rate == pytest.approx(0.1)
+
+
+def test_limiter_adapts_to_responses():
+    lim = crawler.DomainLimiter(rate=1.0, max_rate=4.0)
+    lim.observe(200, 0.01)
+    assert lim.rate == pytest.approx(1.1)
+    lim.observe(200, 5.0)
+    assert lim.rate == pytest.approx(0.2)
+    lim.observe(500, 0.01)
+    assert lim.rate == pytest.approx(0.1) and lim.errors == 1
+
+
+def test_limiter_pauses_on_retry_after():
+    lim = crawler.DomainLimiter(rate=1000.0, max_rate=1000.0)
+    lim.observe(429, 0.01, crawler.retry_after_seconds("0.2"))
+    assert lim.throttled == 1 and lim.rate == pytest.approx(500.0)
+
+    async def enter():
+        t0 = asyncio.get_running_loop().time()
+        async with lim:
+            pass
+        return asyncio.get_running_loop().time() - t0
+
+    assert asyncio.run(enter()) >= 0.15
+
+
+def test_limiter_spaces_requests_by_rate():
+    lim = crawler.DomainLimiter(per_domain=4, rate=20.0, max_rate=20.0)
+
+    async def run():
+        t0 = asyncio.get_running_loop().time()
+        for _ in range(5):
+            async with lim:
+                pass
+        return asyncio.get_running_loop().time() - t0
+
+    assert asyncio.run(run()) >= 4 / 20 - 0.02
+
+
+def test_retry_after_seconds():
+    assert crawler.retry_after_seconds("12") == 12.0
+    assert crawler.retry_after_seconds(None) is None
+    assert crawler.retry_after_seconds("garbage") is None
+    assert crawler.retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def _stream(content: bytes, dest, max_bytes, headers=None):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(
+                lambda r: httpx.Response(200, content=content, headers=headers))) as client:
+            async with client.stream("GET", "https://a.go.jp/x.pdf") as r:
+                return await crawler.stream_to(r, dest, max_bytes)
+    return asyncio.run(run())
+
+
+def test_stream_to_hashes_while_writing(tmp_path, monkeypatch):
+    monkeypatch.setattr(crawler, "STREAM_CHUNK", 1000)
+    data = bytes(range(256)) * 100
+    dest = tmp_path / "x.part"
+    assert _stream(data, dest, len(data)) == hashlib.sha256(data).hexdigest()
+    assert dest.read_bytes() == data
+
+
+def test_stream_to_stops_over_cap(tmp_path):
+    dest = tmp_path / "x.part"
+    with pytest.raises(crawler.TooLarge):
+        _stream(b"a" * 5000, dest, 4096)
+    # Content-Length だけで本文を読まずに断る
+    with pytest.raises(crawler.TooLarge, match="Content-Length"):
+        _stream(b"a" * 10, dest, 4096, headers={"Content-Length": "99999"})
+
+
+def test_too_large_download_is_skipped(store, monkeypatch):
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        return httpx.Response(200, content=b"a" * 5000)
+
+    stream_to = crawler.stream_to
+    monkeypatch.setattr(crawler, "stream_to", lambda r, dest: stream_to(r, dest, 4096))
+
+    async def run():
+        c = _crawler(store, handler, rate=1000.0)
+        async with c.client:
+            return await c.record("https://a.go.jp/big.pdf")
+
+    assert asyncio.run(run()) is None
+    # 大きすぎるのは再試行しない・途中のファイルも残さない
+    assert paths == ["/big.pdf"] and store.get("https://a.go.jp/big.pdf") is None
+    assert not any(crawler.RAW_DIR.iterdir())
+
+
+def test_seeds_filtered_like_links(tmp_path, monkeypatch):
+    monkeypatch.setattr(crawler, "META_DIR", tmp_path / "meta")
+    monkeypatch.setattr(crawler, "FRONTIER", tmp_path / "meta" / "frontier.sqlite")
+    queued = []
+
+    async def fake_bulk(frontier, *args):
+        while (item := frontier.pop()) is not None:
+            queued.append(item[1]); frontier.done(item[0])
+        return len(queued), 0
+
+    monkeypatch.setattr(crawler, "_bulk_crawl", fake_bulk)
+    crawler.bulk_crawl_from_seeds(["https://a.go.jp/", "https://a.go.jp/x.pdf", "https://a.go.jp/list.php",
+                                   "https://a.go.jp/y.zip?x=1"], 10, True)
+    assert sorted(queued) == ["https://a.go.jp/", "https://a.go.jp/x.pdf"]
+
+
+def test_bulk_crawl_reads_bodies_only_to_follow_links(store, tmp_path, monkeypatch):
+    pages = {"/": b'<a href="/a.html">a</a><a href="/doc.pdf">d</a>', "/a.html": b'<a href="/b.html">b</a>',
+             "/doc.pdf": b"%PDF", "/b.html": b"<html>b</html>"}
+
+    async def aenter(self):
+        self.rate = 1000.0
+        self.client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda r: httpx.Response(200, content=pages[r.url.path])))
+        return self
+
+    monkeypatch.setattr(crawler.AsyncCrawler, "__aenter__", aenter)
+    parsed = []
+    extract = crawler.extract_links
+    monkeypatch.setattr(crawler, "extract_links", lambda u, html: parsed.append(u) or extract(u, html))
+
+    f = crawler.Frontier(tmp_path / "frontier.sqlite")
+    f.push_many([("https://a.go.jp/", "a.go.jp", 0, 0.0)])
+    asyncio.run(crawler._bulk_crawl(f, 10, 1, True, store))
+    f.close()
+    # depth=1 のページ（a.html）は保存するがリンクはたどらない（本文も読まない）
+    assert parsed == ["https://a.go.jp/"]
+    assert store.get("https://a.go.jp/a.html") and store.get("https://a.go.jp/doc.pdf")
+    assert store.get("https://a.go.jp/b.html") is None
@@ -0,0 +1,58 @@
+import json
+
+import numpy as np
+import pytest
+
+import ann_index
+import dense_index
+import hybrid_index
+from hybrid_index import HybridIndex
+
+DOCS = [{"id": f"d{i}", "title": f"t{i}", "text": f"在留資格 {i} 変更"} for i in range(6)]
+
+
+class FakeEncoder:
+    def __init__(self, dim):
+        self.dim, self.model = dim, "m1"
+
+    def encode(self, queries):
+        X = np.ones((len(queries), self.dim), dtype="float32")
+        return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+    def stats(self):
+        return {}
+
+
+@pytest.fixture
+def dense(tmp_path, monkeypatch):
+    X = np.random.default_rng(0).standard_normal((len(DOCS), 8)).astype("float32")
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    index, params = ann_index.build(X, np.arange(len(DOCS), dtype=np.int64), kind="flat", codec="flat", reduce="")
+    params["embed_model"] = "m1"
+    ann_index.save(index, params, str(tmp_path / "faiss.index"))
+    (tmp_path / "id_map.json").write_text(json.dumps([d["id"] for d in DOCS]), encoding="utf-8")
+    monkeypatch.setattr(dense_index, "DENSE_INDEX", str(tmp_path / "faiss.index"))
+    monkeypatch.setattr(dense_index, "DENSE_ID_MAP", str(tmp_path / "id_map.json"))
+    monkeypatch.setattr(dense_index, "_SHARED", {})
+    monkeypatch.setattr(hybrid_index, "VECTOR_LEG", "dense")
+
+
+def test_model_mismatch_disables_dense_leg(dense, monkeypatch):
+    monkeypatch.setattr(dense_index, "EMBED_MODEL", "other-model")
+    assert dense_index.load_dense_leg(DOCS) is None
+    assert HybridIndex(DOCS).search("在留資格", top_k=3)
+
+
+def test_dimension_mismatch_falls_back_to_tfidf(dense, monkeypatch):
+    monkeypatch.setattr(dense_index, "EMBED_MODEL", "m1")
+    index = HybridIndex(DOCS)
+    leg = index._dense_leg()
+    assert leg is not None and leg.dim == 8
+    leg.encoder = FakeEncoder(4)
+    assert index._search_dense(leg, ["在留資格"]) is None
+    assert len(index.search("在留資格", top_k=3)) == 3
+    assert len(index.search_many(["在留資格", "変更"], top_k=2)) == 2
+
+    leg.encoder = FakeEncoder(8)
+    Q, hits = index._search_dense(leg, ["在留資格"])
+    assert Q.shape == (1, 8) and len(hits[0][0]) == len(DOCS)
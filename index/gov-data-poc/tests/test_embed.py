@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+import embed
+
+
+@pytest.fixture
+def maps(tmp_path, monkeypatch):
+    monkeypatch.setattr(embed, "ID_MAP", tmp_path / "id_map.npz")
+    monkeypatch.setattr(embed, "OLD_ID_MAP", tmp_path / "id_map.json")
+    monkeypatch.setattr(embed, "OLD_DOC_MAP", tmp_path / "doc_map.json")
+    return tmp_path
+
+
+ID_MAP = {"c1": embed.str_to_i64("c1"), "c2": embed.str_to_i64("c2"), "c3": -5, "orphan": 7}
+DOC_MAP = {"docA": ["c1", "c2"], "docB": ["c3"], "empty": []}
+
+
+def test_maps_round_trip(maps):
+    embed.save_maps(ID_MAP, DOC_MAP)
+    assert (maps / "id_map.npz").exists()
+    id_map, doc_map = embed.load_maps()
+    assert id_map == ID_MAP and doc_map == DOC_MAP
+
+
+def test_maps_fall_back_to_legacy_json(maps):
+    (maps / "id_map.json").write_text(json.dumps(ID_MAP), encoding="utf-8")
+    (maps / "doc_map.json").write_text(json.dumps(DOC_MAP), encoding="utf-8")
+    assert embed.load_maps() == (ID_MAP, DOC_MAP)
+
+    # 保存すると npz に移り、旧 JSON は消える
+    embed.save_maps(*embed.load_maps())
+    assert not (maps / "id_map.json").exists() and not (maps / "doc_map.json").exists()
+    assert embed.load_maps() == (ID_MAP, DOC_MAP)
+
+
+def test_maps_empty(maps):
+    assert embed.load_maps() == ({}, {})
+    embed.save_maps({}, {})
+    assert embed.load_maps() == ({}, {})
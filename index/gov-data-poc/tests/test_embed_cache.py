@@ -0,0 +1,43 @@
+import numpy as np
+
+from embed_cache import EmbeddingCache, cache_key
+
+
+class Counting:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return np.asarray([[len(t), i] for i, t in enumerate(texts)], dtype="float32")
+
+
+def test_only_missing_texts_are_embedded(tmp_path):
+    cache, fn = EmbeddingCache(str(tmp_path / "c.sqlite")), Counting()
+    a = cache.embed(["在留資格", "手続き", "在留資格"], "m", fn)
+    assert fn.calls == [["在留資格", "手続き"]]
+    assert np.array_equal(a[0], a[2])
+
+    # 空白・全角の違いだけなら同じキー（埋め込みには元の本文を渡す）
+    b = cache.embed(["手続き", " 在留資格 ", "新しい"], "m", fn)
+    assert fn.calls[1] == ["新しい"]
+    assert np.array_equal(b[0], a[1]) and np.array_equal(b[1], a[0])
+    assert cache.stats()["rows"] == 3
+
+
+def test_model_is_part_of_the_key(tmp_path):
+    assert cache_key("a", "本文") != cache_key("b", "本文")
+    assert cache_key("a", "ＡＢＣ  x") == cache_key("a", "ABC x")
+    cache, fn = EmbeddingCache(str(tmp_path / "c.sqlite")), Counting()
+    cache.embed(["本文"], "a", fn)
+    cache.embed(["本文"], "b", fn)
+    assert len(fn.calls) == 2
+
+
+def test_eviction_keeps_recent_rows(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "c.sqlite"), max_bytes=10 * 8)
+    for i in range(30):
+        cache.embed([f"t{i}"], "m", Counting())
+    st = cache.stats()
+    assert st["bytes"] <= 10 * 8
+    assert cache.get_many([cache_key("m", "t29")])
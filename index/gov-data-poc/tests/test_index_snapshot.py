@@ -0,0 +1,54 @@
+import json
+import os
+
+from hybrid_index import HybridIndex
+from index_snapshot import current_snapshot, load_snapshot, open_index, read_meta, set_current_snapshot, write_snapshot
+from serve import ensure_snapshot
+
+DOCS = [{"id": f"d{i}", "title": f"制度 {i}", "text": f"在留資格 {i} の 変更 手続き と 税金 {i % 3}"} for i in range(30)]
+
+
+def _texts(tmp_path, docs):
+    p = tmp_path / "texts.json"
+    p.write_text(json.dumps(docs, ensure_ascii=False), encoding="utf-8")
+    return str(p)
+
+
+def test_round_trip_gives_same_results(tmp_path):
+    texts = _texts(tmp_path, DOCS)
+    index = HybridIndex(DOCS)
+    write_snapshot(index, str(tmp_path / "snap"), texts_json=texts)
+    loaded = load_snapshot(str(tmp_path / "snap"))
+    assert loaded.generation == index.generation
+    for q in ("在留資格 変更", "税金 2", "手続き"):
+        assert loaded.search(q, top_k=5) == index.search(q, top_k=5)
+    assert [dict(d) for d in loaded.docs] == DOCS
+
+
+def test_stale_snapshot_is_not_served(tmp_path):
+    texts = _texts(tmp_path, DOCS)
+    snap = str(tmp_path / "snap")
+    write_snapshot(HybridIndex(DOCS), snap, texts_json=texts)
+    assert open_index(texts, snap).snapshot_path == snap
+
+    new = DOCS + [{"id": "new", "title": "新制度", "text": "特定技能 の 新しい 制度"}]
+    _texts(tmp_path, new)
+    os.utime(texts, (0, 1))  # 同じ秒に書いても mtime が変わるように
+    index = open_index(texts, snap)
+    assert index.snapshot_path is None and len(index.docs) == len(new)
+
+
+def test_ensure_snapshot_rebuilds_and_repoints_current(tmp_path):
+    texts = _texts(tmp_path, DOCS)
+    snap = str(tmp_path / "snap")
+    write_snapshot(HybridIndex(DOCS), snap + ".v1", texts_json=texts)
+    set_current_snapshot(snap, snap + ".v1")
+    ensure_snapshot(texts, snap)
+    assert current_snapshot(snap) == snap + ".v1"  # 新しければ何もしない
+
+    _texts(tmp_path, DOCS[:10])
+    os.utime(texts, (0, 1))
+    ensure_snapshot(texts, snap)
+    assert current_snapshot(snap) == snap
+    assert read_meta(snap)["n_docs"] == 10
+
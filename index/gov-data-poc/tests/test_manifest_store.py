@@ -0,0 +1,54 @@
+import json
+
+import manifest_store
+
+
+def test_migrates_manifest_json(tmp_path):
+    legacy = {
+        "https://a.go.jp/1": {"url": "https://a.go.jp/1", "path": "data/raw/1.html", "content_hash": "h1",
+                              "parse_needed": True, "doc_id": None, "note": "extra field"},
+        "https://a.go.jp/2": {"url": "https://a.go.jp/2", "path": "data/raw/2.html", "content_hash": "h2",
+                              "parse_needed": False, "doc_id": "d2"},
+    }
+    (tmp_path / "manifest.json").write_text(json.dumps(legacy), encoding="utf-8")
+    s = manifest_store.open_store(tmp_path)
+    assert len(s) == 2
+    assert not (tmp_path / "manifest.json").exists() and (tmp_path / "manifest.json.migrated").exists()
+    a = s.get("https://a.go.jp/1")
+    assert a["parse_needed"] is True and a["note"] == "extra field" and "doc_id" not in a
+    assert s.by_doc_id("d2")["url"] == "https://a.go.jp/2"
+    s.close()
+
+    # 2 回目は取り込み済みの SQLite をそのまま開く
+    s = manifest_store.open_store(tmp_path)
+    assert len(s) == 2 and s.get("https://a.go.jp/2")["content_hash"] == "h2"
+    s.close()
+
+
+def test_put_only_overwrites_given_fields(tmp_path):
+    s = manifest_store.open_store(tmp_path)
+    u = "https://a.go.jp/1"
+    s.put(u, {"path": "p", "content_hash": "h1", "parse_needed": True})
+    s.mark_parsed([(u, "d1")])
+    s.mark_embedded([("d1", "h1")])
+    # crawler の記録（parse / embed 側の項目は持たない）で embedded_hash は消えない
+    s.put(u, {"content_hash": "h2", "parse_needed": True, "etag": '"x"'})
+    m = s.get(u)
+    assert m["path"] == "p" and m["doc_id"] == "d1" and m["embedded_hash"] == "h1" and m["etag"] == '"x"'
+    s.close()
+
+
+def test_parse_and_embed_state(tmp_path):
+    s = manifest_store.open_store(tmp_path)
+    for i in range(3):
+        s.put(f"https://a.go.jp/{i}", {"path": f"p{i}", "content_hash": f"h{i}", "parse_needed": i != 1})
+    assert [u for u, _ in s.needs_parse()] == ["https://a.go.jp/0", "https://a.go.jp/2"]
+    assert s.mark_parsed([("https://a.go.jp/0", "d0"), ("https://nowhere/", "dx")]) == 1
+    assert [u for u, _ in s.needs_parse()] == ["https://a.go.jp/2"]
+
+    assert not s.is_embedded("d0")
+    s.mark_embedded([("d0", "h0")])
+    assert s.is_embedded("d0") and not s.is_embedded("d0", "h-new")
+    s.put("https://a.go.jp/0", {"content_hash": "h-new"})
+    assert not s.is_embedded("d0")
+    s.close()
@@ -0,0 +1,38 @@
+import random
+
+import parse
+
+
+def _text(n=600, seed=0):
+    rng = random.Random(seed)
+    words = ["在留資格", "変更", "許可", "申請", "手続き", "書類", "期間", "更新", "窓口", "審査"]
+    return "".join("".join(rng.choice(words) for _ in range(rng.randint(3, 12))) + "。" for _ in range(n))
+
+
+def test_bounds_cover_text_within_size():
+    text = _text()
+    bounds = parse.chunk_bounds(text)
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(text)
+    assert all(a == prev_b for (_, prev_b), (a, _) in zip(bounds, bounds[1:]))
+    assert all(b - a <= parse.CHUNK_SIZE for a, b in bounds)
+    assert all(b - a >= parse.CHUNK_MIN for a, b in bounds[:-1] if text[b - 1] == "。")
+
+
+def test_edit_in_the_middle_keeps_other_chunk_ids():
+    url = "https://ex.go.jp/a"
+    text = _text()
+    mid = len(text) // 2
+    edited = text[:mid] + "新しい一文を足しました。" + text[mid:]
+    before = parse.chunk_ids(url, parse.chunk_text(text))
+    after = parse.chunk_ids(url, parse.chunk_text(edited))
+    changed = set(after) - set(before)
+    assert len(before) > 10
+    assert 1 <= len(changed) <= 3
+    assert after[:2] == before[:2] and after[-2:] == before[-2:]
+
+
+def test_chunk_ids_depend_on_url_and_repeat_count():
+    a = parse.chunk_ids("u1", ["同じ", "同じ", "別"])
+    assert len(set(a)) == 3
+    assert parse.chunk_ids("u1", ["別"]) == [a[2]]
+    assert parse.chunk_ids("u2", ["別"]) != [a[2]]
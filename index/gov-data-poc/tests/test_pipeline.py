@@ -0,0 +1,124 @@
+import hashlib
+import json
+
+import faiss
+import numpy as np
+import pytest
+
+import embed
+import embed_cache
+import manifest_store
+import parse
+import pipeline
+
+PAGES = {f"https://ex.go.jp/p{i}": f"<html><title>p{i}</title><body>" + "".join(
+    f"<p>在留資格 {i} の 手続き {j} について 説明します。</p>" for j in range(40 + 7 * i)) + "</body></html>"
+    for i in range(6)}
+
+
+def fake_embed(texts, dim=16):
+    X = np.stack([np.random.default_rng(int(hashlib.md5(t.encode()).hexdigest()[:8], 16)).standard_normal(dim)
+                  for t in texts]).astype("float32")
+    return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+
+def use_embedder(monkeypatch, model, dim):
+    # embedder_model() が model を返すようにし、埋め込み自体は fake_embed で済ませる
+    monkeypatch.setattr(embed, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(embed, "EMBEDDING_MODEL", model)
+    monkeypatch.setattr(embed, "choose_embedder", lambda: (lambda texts: fake_embed(texts, dim), dim))
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    def make(name):
+        root = tmp_path / name
+        dirs = {k: root / k.lower().replace("_dir", "") for k in ("RAW_DIR", "PARSED_DIR", "DB_DIR", "META_DIR")}
+        for k, d in dirs.items():
+            d.mkdir(parents=True)
+            for m in (parse, embed):
+                if hasattr(m, k):
+                    monkeypatch.setattr(m, k, d)
+        db = dirs["DB_DIR"]
+        for m in (parse, embed):
+            monkeypatch.setattr(m, "OUT_JSONL", db / "texts.json")
+        monkeypatch.setattr(embed, "OUT_INDEX", db / "faiss.index")
+        monkeypatch.setattr(embed, "ID_MAP", db / "id_map.npz")
+        monkeypatch.setattr(embed, "OLD_ID_MAP", db / "id_map.json")
+        monkeypatch.setattr(embed, "OLD_DOC_MAP", db / "doc_map.json")
+        use_embedder(monkeypatch, "m1", 16)
+        monkeypatch.setattr(embed_cache, "EMBED_CACHE", "")
+        monkeypatch.setattr(embed_cache, "_CACHE", None)
+        store = manifest_store.open_store(dirs["META_DIR"])
+        for i, (url, html) in enumerate(PAGES.items()):
+            p = dirs["RAW_DIR"] / f"p{i}.html"
+            p.write_text(html, encoding="utf-8")
+            store.put(url, {"path": str(p), "content_hash": hashlib.sha256(html.encode()).hexdigest(),
+                            "parse_needed": True})
+        store.close()
+        return db
+    return make
+
+
+def _state(db):
+    rows = [json.loads(l) for l in open(db / "texts.json", encoding="utf-8")]
+    with np.load(db / "id_map.npz") as z:
+        id_map = dict(zip(z["chunk_ids"].tolist(), z["labels"].tolist()))
+    index = faiss.read_index(str(db / "faiss.index"))
+    labels = np.asarray(sorted(id_map.values()), dtype=np.int64)
+    V = index.reconstruct_batch(labels)
+    return sorted((r["id"], r["doc_id"], r["text"]) for r in rows), id_map, V
+
+
+def _same(a, b):
+    assert a[0] == b[0] and a[1] == b[1]
+    assert np.allclose(a[2], b[2])
+
+
+def test_pipeline_matches_parse_then_embed(workspace, monkeypatch):
+    a = workspace("batch")
+    parse.main()
+    embed.main()
+    s = workspace("stream")
+    pipeline.main()
+    _same(_state(s), _state(a))
+
+    # 埋め込みモデルを変えると作り直し：どちらの経路でも全チャンクが入り直す
+    use_embedder(monkeypatch, "m2", 16)
+    embed.main()
+    rebuilt = _state(a)
+    b = workspace("stream-rebuild")
+    pipeline.main()
+    use_embedder(monkeypatch, "m2", 16)
+    pipeline.main()
+    _same(_state(b), rebuilt)
+    assert faiss.read_index(str(b / "faiss.index")).ntotal == len(rebuilt[0])
+
+
+def test_pipeline_embeds_docs_parsed_earlier(workspace):
+    a = workspace("batch")
+    parse.main()
+    embed.main()
+    batch = _state(a)
+
+    b = workspace("parsed-only")
+    parse.main()  # 埋め込む前に止まった状態
+    pipeline.main()
+    assert _state(b)[1] == batch[1]
+    store = manifest_store.open_store(parse.META_DIR)
+    assert all(store.is_embedded(parse.sha256_text(u)) for u in PAGES)
+    store.close()
+
+
+@pytest.mark.parametrize("model,dim", [("m2", 16), ("m1", 8)])
+def test_embed_rebuilds_every_chunk_when_model_changes(workspace, monkeypatch, model, dim):
+    db = workspace("batch")
+    parse.main()
+    embed.main()
+    rows, id_map, _ = _state(db)
+
+    use_embedder(monkeypatch, model, dim)
+    embed.main()
+    index = faiss.read_index(str(db / "faiss.index"))
+    assert index.ntotal == len(rows) == len(id_map)
+    assert _state(db)[1] == id_map
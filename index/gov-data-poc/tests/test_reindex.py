@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+import pytest
+
+from hybrid_index import HybridIndex
+from index_snapshot import current_snapshot, load_snapshot, prune_versions, write_reindex_status, write_snapshot
+from reindex import Reindexer
+from segmented_index import LiveIndex
+
+DOCS = [{"id": f"d{i}", "title": f"t{i}", "text": f"在留資格 {i} 変更 手続き"} for i in range(20)]
+
+
+def _setup(tmp_path):
+    texts = tmp_path / "texts.json"
+    texts.write_text(json.dumps(DOCS, ensure_ascii=False), encoding="utf-8")
+    snap = str(tmp_path / "snap")
+    write_snapshot(HybridIndex(DOCS), snap, texts_json=str(texts))
+    live = LiveIndex(load_snapshot(snap), oplog_path=str(tmp_path / "ops.jsonl"), snapshot_dir=snap, poll=0)
+    return str(texts), snap, live
+
+
+def _wait(reindexer, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while reindexer.status()["state"] == "running":
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    return reindexer.status()
+
+
+def test_rollback_needs_a_recorded_snapshot(tmp_path):
+    texts, snap, live = _setup(tmp_path)
+    with pytest.raises(RuntimeError):
+        Reindexer(live, texts, snap).rollback()
+    with pytest.raises(RuntimeError):
+        Reindexer(LiveIndex(HybridIndex(DOCS)), texts, "").rollback()
+
+
+def test_reindex_status_and_rollback_survive_restart(tmp_path):
+    texts, snap, live = _setup(tmp_path)
+    with open(texts, "w", encoding="utf-8") as f:
+        json.dump(DOCS + [{"id": "new", "title": "new", "text": "特定技能"}], f, ensure_ascii=False)
+    live.add_docs([{"id": "admin", "title": "admin", "text": "管理者 が 足した 文書"}])
+
+    reindexer = Reindexer(live, texts, snap)
+    assert reindexer.start()
+    st = _wait(reindexer)
+    assert st["state"] == "succeeded", st
+    assert current_snapshot(snap) == st["snapshot"] and st["previous"] == snap
+    assert {"new", "admin"} <= {str(d["id"]) for d in live.current.docs}
+
+    # 別ワーカー（再起動後）も同じ状態を見て、同じ操作ログで戻せる
+    other = Reindexer(live, texts, snap)
+    assert other.status()["can_rollback"]
+    res = other.rollback()
+    assert res["snapshot"] == snap and current_snapshot(snap) == snap
+    ids = {str(d["id"]) for d in live.current.docs}
+    assert "new" not in ids and "admin" in ids
+    ops = [json.loads(l) for l in open(tmp_path / "ops.jsonl", encoding="utf-8")]
+    assert [o["snapshot"] for o in ops if o["op"] == "base"] == [st["snapshot"], snap]
+    assert Reindexer(live, texts, snap).status()["previous"] == st["snapshot"]
+
+
+def test_prune_keeps_rollback_target(tmp_path):
+    snap = str(tmp_path / "snap")
+    for v in ("v1", "v2", "v3"):
+        write_snapshot(HybridIndex(DOCS[:5]), f"{snap}.{v}")
+    write_reindex_status(snap, {"state": "succeeded", "previous": f"{snap}.v1"})
+    prune_versions(snap, keep=1, protect=(f"{snap}.v3",))
+    assert sorted(p for p in os.listdir(tmp_path) if (tmp_path / p).is_dir()) == ["snap.v1", "snap.v3"]
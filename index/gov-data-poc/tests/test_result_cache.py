@@ -0,0 +1,121 @@
+import importlib
+import json
+import sys
+import types
+
+import pytest
+
+import result_cache
+from result_cache import ResultCache, make_key
+
+DOCS = [{"id": f"d{i}", "title": f"制度 {i}", "text": f"在留資格 {i} の 変更 手続き"} for i in range(20)]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """result_cache の time だけを差し替える（time.time / time.monotonic を手で進める）。"""
+    now = [1000.0]
+    monkeypatch.setattr(result_cache, "time", types.SimpleNamespace(time=lambda: now[0], monotonic=lambda: now[0]))
+    return now
+
+
+def test_hit_and_generation_bump():
+    c = ResultCache(maxsize=4, ttl=0)
+    k = make_key("在留資格  変更", top_k=5)
+    assert c.get("g1", k) is None
+    c.put("g1", k, ["a"])
+    assert c.get("g1", make_key("在留資格 変更", top_k=5)) == ["a"]
+    assert c.get("g2", k) is None and c.stats()["size"] == 0
+    c.put("g2", k, ["b"])
+    assert c.get("g1", k) is None  # 古い世代に戻っても前の値は残っていない
+    assert c.stats()["hits"] == 1
+
+
+def test_ttl_expiry(clock):
+    c = ResultCache(maxsize=4, ttl=10)
+    c.put("g", "k", 1)
+    clock[0] += 9
+    assert c.get("g", "k") == 1
+    clock[0] += 2
+    assert c.get("g", "k") is None and c.stats()["size"] == 0
+
+
+def test_lru_eviction():
+    c = ResultCache(maxsize=2, ttl=0)
+    c.put("g", "a", 1)
+    c.put("g", "b", 2)
+    assert c.get("g", "a") == 1  # a を新しくする → 次は b が落ちる
+    c.put("g", "c", 3)
+    assert c.get("g", "b") is None and c.get("g", "a") == 1 and c.get("g", "c") == 3
+    assert c.stats()["evictions"] == 1
+
+
+@pytest.fixture
+def qa(tmp_path, monkeypatch):
+    texts = tmp_path / "texts.json"
+    texts.write_text(json.dumps(DOCS, ensure_ascii=False), encoding="utf-8")
+    for k, v in {"TEXTS_JSON": texts, "INDEX_SNAPSHOT": tmp_path / "snap", "INDEX_OPLOG": tmp_path / "ops.jsonl",
+                 "LOG_DIR": tmp_path / "logs", "SHARED_CACHE_PATH": ""}.items():
+        monkeypatch.setenv(k, str(v))
+    sys.modules.pop("qa_service", None)
+    mod = importlib.import_module("qa_service")
+    yield mod
+    sys.modules.pop("qa_service", None)
+
+
+def test_cached_search_drops_entries_on_new_generation(qa, monkeypatch):
+    calls = []
+    search = type(qa.LIVE.current).search
+    monkeypatch.setattr(type(qa.LIVE.current), "search", lambda self, q, **kw: calls.append(q) or search(self, q, **kw))
+
+    first = qa.cached_search("特定技能", top_k=5)
+    assert qa.cached_search("特定技能", top_k=5) == first and len(calls) == 1
+
+    qa.LIVE.add_docs([{"id": "new", "title": "新制度", "text": "特定技能 の 新しい 制度"}])
+    hits = qa.cached_search("特定技能", top_k=5)
+    assert len(calls) == 2 and hits[0]["id"] == "new"
+
+
+def test_shared_cache_purges_other_generations(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    a, b = result_cache.SharedResultCache(path), result_cache.SharedResultCache(path)
+    a.put("g1", "k", [{"id": "x"}])
+    assert b.get("g1", "k") == [{"id": "x"}]  # 別ワーカーから見える
+    b.put("g2", "k2", [])
+    assert b.stats()["rows"] == 1  # g1 の行は消えている
+    assert a.get("g1", "k") is None
+
+
+def test_shared_cache_ttl(tmp_path, clock):
+    c = result_cache.SharedResultCache(str(tmp_path / "cache.sqlite"), ttl=10)
+    c.put("g", "k", 1)
+    clock[0] += 11
+    assert c.get("g", "k") is None
+
+
+def test_shared_cache_evicts_oldest_to_size_cap(tmp_path, clock):
+    value = "x" * 98  # JSON で 100 バイト
+    c = result_cache.SharedResultCache(str(tmp_path / "cache.sqlite"), max_bytes=1000, evict_every=1)
+    for i in range(10):
+        clock[0] += 1
+        c.put("g", i, value)
+    assert c.stats()["bytes"] == 1000
+    clock[0] += 1
+    assert c.get("g", 0) == value  # 0 は最近使ったので残す
+    clock[0] += 1
+    c.put("g", 10, value)
+    # 1100 → 上限の 90%（900）以下まで、最終アクセスの古い順（1, 2）に消える
+    st = c.stats()
+    assert st["rows"] == 9 and st["bytes"] == 900
+    assert c.get("g", 1) is None and c.get("g", 2) is None
+    assert all(c.get("g", i) == value for i in (0, 3, 10))
+
+
+def test_shared_cache_errors_are_misses(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    path.write_bytes(b"not a database" * 100)
+    c = result_cache.SharedResultCache(str(path))
+    c.put("g", "k", 1)
+    assert c.get("g", "k") is None
+    st = c.stats()
+    assert st["errors"] == 2 and st["misses"] == 1 and st["rows"] is None
@@ -0,0 +1,101 @@
+import json
+import time
+
+from hybrid_index import HybridIndex
+from index_snapshot import current_snapshot, load_snapshot, read_meta, write_snapshot
+from segmented_index import LiveIndex, fold_doc_ops
+
+DOCS = [{"id": f"d{i}", "title": f"t{i}", "text": f"在留資格 {i} 変更 手続き"} for i in range(40)]
+
+
+def _live_ids(live):
+    view = live.current
+    dead = getattr(view, "dead", None)
+    return sorted(str(view.docs[i]["id"]) for i in range(len(view.docs)) if dead is None or not dead[i])
+
+
+def _hit_ids(live, q):
+    return [r["id"] for r in live.current.search(q, top_k=50) if r["score"] > 0]
+
+
+def _wait_compacted(*lives, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if sum(l.compactions for l in lives) and not any(l.stats()["merging"] for l in lives):
+            return
+        time.sleep(0.05)
+    raise AssertionError("compaction did not finish")
+
+
+def test_add_replace_delete_are_visible():
+    live = LiveIndex(HybridIndex(DOCS), compact_ratio=10)
+    live.add_docs([{"id": "x", "title": "x", "text": "特定技能 新制度"}])
+    assert _hit_ids(live, "特定技能") == ["x"]
+    live.add_docs([{"id": "x", "title": "x", "text": "高度専門職 の 説明"}])
+    assert _hit_ids(live, "特定技能") == [] and _hit_ids(live, "高度専門職") == ["x"]
+    live.delete_docs(["x", "d3"])
+    assert "x" not in _live_ids(live) and "d3" not in _live_ids(live)
+    assert "d3" not in _hit_ids(live, "在留資格 3")
+    assert len(_live_ids(live)) == len(DOCS) - 1
+
+
+def test_views_are_immutable():
+    live = LiveIndex(HybridIndex(DOCS), compact_ratio=10)
+    before = live.current
+    live.delete_docs(["d0"])
+    assert "d0" in [str(before.docs[i]["id"]) for i in range(len(before.docs))]
+    assert live.current.generation != before.generation
+
+
+def test_fold_doc_ops_keeps_last_state():
+    ops = [{"op": "add", "docs": [{"id": "a", "v": 1}, {"id": "b"}]},
+           {"op": "delete", "ids": ["a"]},
+           {"op": "add", "docs": [{"id": "b", "v": 2}]},
+           {"op": "delete", "ids": ["c"]}]
+    assert fold_doc_ops(ops) == [{"op": "delete", "ids": ["a", "c"]}, {"op": "add", "docs": [{"id": "b", "v": 2}]}]
+
+
+def test_oplog_is_shared_between_workers(tmp_path):
+    log = str(tmp_path / "ops.jsonl")
+    a = LiveIndex(HybridIndex(DOCS), oplog_path=log, poll=0, compact_ratio=10)
+    b = LiveIndex(HybridIndex(DOCS), oplog_path=log, poll=0, compact_ratio=10)
+    a.add_docs([{"id": "x", "title": "x", "text": "特定技能"}])
+    b.delete_docs(["d1"])
+    assert _live_ids(a) == _live_ids(b)
+    assert a.current.generation.split("+")[1] == b.current.generation.split("+")[1] == "2"
+
+
+def test_compaction_rotates_oplog_and_restarts_from_offset(tmp_path):
+    texts = tmp_path / "texts.json"
+    texts.write_text(json.dumps(DOCS, ensure_ascii=False), encoding="utf-8")
+    snap, log = str(tmp_path / "snap"), str(tmp_path / "ops.jsonl")
+    write_snapshot(HybridIndex(DOCS), snap, texts_json=str(texts))
+    a = LiveIndex(load_snapshot(snap), oplog_path=log, snapshot_dir=snap, poll=0)
+    b = LiveIndex(load_snapshot(snap), oplog_path=log, snapshot_dir=snap, poll=0)
+    a.delete_docs(["d0", "d1"])
+    for k in range(8):
+        b.add_docs([{"id": f"y{k}", "title": "y", "text": f"追加 {k} 特定技能"}])
+    _wait_compacted(a, b)
+    a.add_docs([{"id": "z", "title": "z", "text": "圧縮後 特定技能"}])
+    a.sync(force=True)
+    b.sync(force=True)
+
+    # 1 ワーカーだけが作り直し、もう 1 つはログの reset で同じ本体に切り替わる
+    assert a.compactions + b.compactions == 1
+    assert a.base.snapshot_path == b.base.snapshot_path == current_snapshot(snap) != snap
+    assert _live_ids(a) == _live_ids(b)
+    lines = [json.loads(l) for l in open(log, encoding="utf-8")]
+    assert lines[0]["op"] == "base" and lines[0]["reset"]
+    assert [l["docs"][0]["id"] for l in lines[1:]][-1] == "z" and len(lines) < 5
+    mark = read_meta(current_snapshot(snap))["oplog"]
+    assert mark["id"] == lines[0]["id"]
+
+    # 再起動: 圧縮したスナップショットから開き、reset 行の次から再生する
+    c = LiveIndex(load_snapshot(current_snapshot(snap)), oplog_path=log, snapshot_dir=snap, poll=0)
+    assert c.stats()["oplog_pos"] == a.stats()["oplog_pos"]
+    assert _live_ids(c) == _live_ids(a)
+
+    # texts.json から作り直した本体で開いても、畳み込まれた変更が適用し直される
+    d = LiveIndex(HybridIndex(DOCS), oplog_path=log, poll=0, compact_ratio=10)
+    assert _live_ids(d) == _live_ids(a)
+    assert "d0" not in _live_ids(d) and "y3" in _live_ids(d)
@@ -0,0 +1,45 @@
+from tokenizer import encode_corpus, tokenize, tokenize_query
+
+TEXTS = [
+    "在留資格の変更手続き（ＡＢＣ申請）について",
+    "ﾏｲﾅﾝﾊﾞｰ カード 2024年度 Tax_Return",
+    "",
+    "日",
+    "Đăng ký tạm trú 外国人 住民票、e-Gov 申請",
+    "々 ひらがな カタカナ 漢字 mixed 日本語text",
+]
+
+
+def test_nfkc_and_lowercase():
+    assert tokenize("ＡＢＣ１２３") == ["abc123"]
+    assert tokenize("ﾏｲﾅ") == ["マイ", "イナ"]
+    assert tokenize("Tax_Return e-Gov") == ["tax", "return", "e", "gov"]
+
+
+def test_cjk_bigrams_and_single_chars():
+    assert tokenize("在留資格") == ["在留", "留資", "資格"]
+    assert tokenize("日 本") == ["日", "本"]
+    assert tokenize("日本語text") == ["日本", "本語", "text"]
+    assert tokenize_query("在留資格") == tuple(tokenize("在留資格"))
+
+
+def test_encode_corpus_matches_tokenize():
+    ids, offsets, vocab = encode_corpus(TEXTS)
+    inv = {i: t for t, i in vocab.items()}
+    assert len(offsets) == len(TEXTS) + 1
+    for i, text in enumerate(TEXTS):
+        assert [inv[t] for t in ids[offsets[i]:offsets[i + 1]].tolist()] == tokenize(text)
+    # 語 ID は初出順
+    seen = []
+    for t in (tok for text in TEXTS for tok in tokenize(text)):
+        if t not in seen: seen.append(t)
+    assert list(vocab) == seen and sorted(vocab.values()) == list(range(len(seen)))
+
+
+def test_encode_corpus_extends_existing_vocab():
+    _, _, vocab = encode_corpus(TEXTS[:2])
+    before = dict(vocab)
+    ids, offsets, vocab = encode_corpus(TEXTS[4:], vocab)
+    assert all(vocab[t] == i for t, i in before.items())
+    inv = {i: t for t, i in vocab.items()}
+    assert [inv[t] for t in ids[offsets[0]:offsets[1]].tolist()] == tokenize(TEXTS[4])
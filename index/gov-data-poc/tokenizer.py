@@ -0,0 +1,128 @@
+# tokenizer.py — 全インデクサ共通のトークナイザ（hybrid_index / bm25_index / report_eval）
+#
+# - NFKC 正規化 + 小文字化（全角英数・半角カナを揃える）
+# - 漢字・ひらがな・カタカナの連続部分は文字 2-gram（1 文字だけの部分はそのまま 1 語）
+# - それ以外の文字・数字の連続部分（英数字, ベトナム語など）はまとめて 1 語
+# - 記号・空白・アンダースコアは区切り
+#
+# 正規表現 1 本で連続部分を切り出し、2-gram は map(operator.add) で作るので Python のループは
+# 連続部分の数だけ。クエリ用は lru_cache つき、コーパス構築用は語 ID 配列をまとめて返す。
+
+import os
+import re
+import operator
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# 分割規則を変えたら上げる（スナップショットはこの値が一致しないと読み込まない）
+TOKENIZER_VERSION = "v1"
+QUERY_CACHE_SIZE = int(os.getenv("TOKENIZER_QUERY_CACHE", "4096"))
+
+# 2-gram にする文字（々, かな, カタカナ拡張, CJK 統合漢字 拡張A/基本, 互換漢字）
+_CJK_RANGES = [(0x3005, 0x3005), (0x3040, 0x30FF), (0x31F0, 0x31FF), (0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF)]
+_CJK = "".join(chr(a) if a == b else f"{chr(a)}-{chr(b)}" for a, b in _CJK_RANGES)
+_RUN_RE = re.compile(rf"[{_CJK}]+|[^\W_{_CJK}]+")
+_WORD_RE = re.compile(rf"[^\W_{_CJK}]+")
+_IS_CJK = re.compile(rf"[{_CJK}]").match
+_add = operator.add
+
+
+def tokenize(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    out: List[str] = []
+    for run in _RUN_RE.findall(text):
+        if _IS_CJK(run) and len(run) > 1:
+            out.extend(map(_add, run[:-1], run[1:]))
+        else:
+            out.append(run)
+    return out
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def tokenize_query(q: str) -> Tuple[str, ...]:
+    """クエリ用（同じ質問の再トークナイズを避ける）。戻り値は共有されるので tuple。"""
+    return tuple(tokenize(q))
+
+
+def _cjk_mask(cp: np.ndarray) -> np.ndarray:
+    mask = np.zeros(len(cp), dtype=bool)
+    for lo, hi in _CJK_RANGES:
+        mask |= (cp >= lo) & (cp <= hi)
+    return mask
+
+
+_LOW = (1 << 21) - 1
+
+
+def _pair_str(key: int) -> str:
+    lo = key & _LOW
+    return chr(key >> 21) + chr(lo) if lo else chr(key >> 21)
+
+
+def encode_corpus(
+    texts: Iterable[str], vocab: Optional[Dict[str, int]] = None
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, int]]:
+    """コーパスを語 ID 列にまとめて変換する（インデックス構築用, tokenize と同じ分割）。
+
+    戻り値は (ids, offsets, vocab)。文書 i の語 ID は ids[offsets[i]:offsets[i+1]]（本文の出現順）。
+    新しい語は初出順に vocab へ追加される（BM25Okapi の語順と同じ）。
+
+    CJK の 2-gram は全文書を連結したコードポイント配列から (前の字 << 21 | 後の字) の整数キーとして
+    NumPy で一括生成し、文字列にするのは異なり語だけ。英数字などの語だけ正規表現で切り出す。
+    """
+    vocab = {} if vocab is None else vocab
+    norm = [unicodedata.normalize("NFKC", t or "").lower() for t in texts]
+    # 文書は改行（どちらの語にも属さない文字）でつなぐ。starts[i] = 文書 i の先頭位置
+    starts = np.zeros(len(norm) + 1, dtype=np.int64)
+    np.cumsum([len(t) + 1 for t in norm], out=starts[1:])
+    big = "\n".join(norm)
+    cp = np.frombuffer(big.encode("utf-32-le", "surrogatepass"), dtype=np.uint32).astype(np.int64)
+
+    # 1) CJK: 連続部分の 2-gram と、1 文字だけの連続部分（下位ビット 0 で区別）
+    cjk = _cjk_mask(cp)
+    both = cjk[:-1] & cjk[1:]
+    alone = cjk.copy()
+    alone[1:] &= ~cjk[:-1]
+    alone[:-1] &= ~cjk[1:]
+    bi_pos = np.flatnonzero(both)
+    one_pos = np.flatnonzero(alone)
+    keys = np.concatenate([(cp[bi_pos] << 21) | cp[bi_pos + 1], cp[one_pos] << 21])
+    kpos = np.concatenate([bi_pos, one_pos])
+    ukeys, kinv = np.unique(keys, return_inverse=True)  # return_index を付けると安定ソートになり遅い
+    kfirst = np.full(len(ukeys), len(cp), dtype=np.int64)
+    np.minimum.at(kfirst, kinv.ravel(), kpos)
+
+    # 2) それ以外の語（英数字など）は文字列のまま局所 ID を振る
+    words, wpos_list = [], []
+    for m in _WORD_RE.finditer(big):
+        words.append(m.group())
+        wpos_list.append(m.start())
+    wpos = np.asarray(wpos_list, dtype=np.int64)
+    wlocal: Dict[str, int] = {}
+    winv = np.fromiter((wlocal.setdefault(w, len(wlocal)) for w in words), dtype=np.int64, count=len(words))
+    wfirst = np.full(len(wlocal), len(big), dtype=np.int64)
+    np.minimum.at(wfirst, winv, wpos)
+
+    # 3) 異なり語を初出位置の順に vocab へ登録して、局所 ID → 語 ID の表を作る
+    terms = [_pair_str(k) for k in ukeys.tolist()] + list(wlocal)
+    first = np.concatenate([kfirst, wfirst])
+    # （setdefault の第 2 引数 len(vocab) は呼び出し前に評価されるので、新語には次の ID が振られる）
+    order = np.argsort(first)
+    gid = np.empty(len(terms), dtype=np.int64)
+    gid[order] = np.fromiter(
+        (vocab.setdefault(terms[i], len(vocab)) for i in order.tolist()), dtype=np.int64, count=len(terms)
+    )
+
+    # 4) トークンは開始位置が互いに重ならないので、位置で引ける配列に置いて本文の出現順に取り出す
+    at = np.full(len(cp), -1, dtype=np.int64)
+    at[kpos] = gid[kinv.ravel()]
+    at[wpos] = gid[len(ukeys) + winv]
+    has = at >= 0
+    ids = at[has].astype(np.int32)
+    before = np.zeros(len(cp) + 1, dtype=np.int64)  # before[p] = 位置 p より前のトークン数
+    np.cumsum(has, out=before[1:])
+    offsets = before[np.minimum(starts, len(cp))]
+    return ids, offsets, vocab
@@ -1,5 +1,10 @@
+import hashlib
 import logging
-from typing import Optional
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
 
 import requests
 import fitz  # PyMuPDF
@@ -7,19 +12,49 @@ from bs4 import BeautifulSoup
 
 logger = logging.getLogger(__name__)
 
+# 1 ファイルの上限（超えたらダウンロードを打ち切る）
+EXTRACT_MAX_BYTES = int(os.getenv("EXTRACT_MAX_BYTES", str(200 << 20)))
+_STREAM_CHUNK = 1 << 16
 
-def _get_response(url: str) -> requests.Response:
-    """共通の HTTP GET。エラー時は例外を投げる。"""
-    logger.info("Fetching URL: %s", url)
-    resp = requests.get(url, timeout=30)
-    resp.raise_for_status()
-    return resp
+
+class TooLargeError(ValueError):
+    """本文が EXTRACT_MAX_BYTES を超えた。"""
 
 
-def _extract_from_html_response(resp: requests.Response) -> str:
+@contextmanager
+def _download(url: str) -> Iterator[Tuple[Path, requests.Response]]:
+    """共通の HTTP GET。エラー時は例外を投げる。
+
+    本文はメモリに載せず、一時ファイルに少しずつ書きながら SHA-256 を計算する
+    （大きな PDF でもメモリ使用量は一定）。with を抜けると一時ファイルは消える。
+    """
+    logger.info("Fetching URL: %s", url)
+    fd, name = tempfile.mkstemp(prefix="extract-", suffix=".part")
+    path = Path(name)
+    try:
+        with os.fdopen(fd, "wb") as f, requests.get(url, timeout=30, stream=True) as resp:
+            resp.raise_for_status()
+            length = resp.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > EXTRACT_MAX_BYTES:
+                raise TooLargeError(f"Content-Length {length} exceeds {EXTRACT_MAX_BYTES} bytes: {url}")
+            digest = hashlib.sha256()
+            size = 0
+            for chunk in resp.iter_content(_STREAM_CHUNK):
+                size += len(chunk)
+                if size > EXTRACT_MAX_BYTES:
+                    raise TooLargeError(f"Body exceeds {EXTRACT_MAX_BYTES} bytes: {url}")
+                digest.update(chunk)
+                f.write(chunk)
+        logger.info("Fetched %s (%d bytes, sha256=%s)", url, size, digest.hexdigest())
+        yield path, resp
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def _extract_from_html_response(path: Path, resp: requests.Response) -> str:
     """HTMLレスポンスからテキストを抽出する共通処理。"""
     # 文字コードを推定してデコード
-    html = resp.content.decode(resp.encoding or "utf-8", errors="ignore")
+    html = path.read_bytes().decode(resp.encoding or "utf-8", errors="ignore")
 
     soup = BeautifulSoup(html, "html.parser")
 
@@ -38,13 +73,44 @@ def _extract_from_html_response(resp: requests.Response) -> str:
 def extract_from_html(url: str) -> str:
     """URL から HTML を取得してテキストを抽出する。"""
     try:
-        resp = _get_response(url)
-        return _extract_from_html_response(resp)
+        with _download(url) as (path, resp):
+            return _extract_from_html_response(path, resp)
     except Exception:
         logger.exception("Failed to extract HTML from %s", url)
         return ""
 
 
+def _extract_pdf_or_html(url: str, path: Path, resp: requests.Response) -> str:
+    content_type = resp.headers.get("Content-Type", "").lower()
+    # ヘッダも拡張子も PDF らしくない場合は HTML とみなす
+    if "pdf" not in content_type and not url.lower().endswith(".pdf"):
+        logger.warning(
+            "URL does not look like a PDF (Content-Type: %s). "
+            "Falling back to HTML extraction: %s",
+            content_type,
+            url,
+        )
+        return _extract_from_html_response(path, resp)
+
+    # いったん PDF としてパースを試す（ファイルから開くので本文全体をメモリに載せない）
+    try:
+        with fitz.open(str(path), filetype="pdf") as doc:
+            texts = [page.get_text("text") for page in doc]
+        return "\n".join(texts).strip()
+    except Exception as e:
+        logger.warning(
+            "Failed to parse PDF at %s (%s). Falling back to HTML extraction.",
+            url,
+            e,
+        )
+        # 実は HTML が返ってきている可能性が高いので HTML として再トライ
+        try:
+            return _extract_from_html_response(path, resp)
+        except Exception:
+            logger.exception("Fallback HTML extraction also failed for %s", url)
+            return ""
+
+
 def extract_from_pdf(url: str) -> str:
     """URL から PDF を取得してテキストを抽出する。
 
@@ -53,37 +119,8 @@ def extract_from_pdf(url: str) -> str:
     - それでもダメなら空文字を返す（例外で ingest 全体を止めない）
     """
     try:
-        resp = _get_response(url)
-
-        content_type = resp.headers.get("Content-Type", "").lower()
-        # ヘッダも拡張子も PDF らしくない場合は HTML とみなす
-        if "pdf" not in content_type and not url.lower().endswith(".pdf"):
-            logger.warning(
-                "URL does not look like a PDF (Content-Type: %s). "
-                "Falling back to HTML extraction: %s",
-                content_type,
-                url,
-            )
-            return _extract_from_html_response(resp)
-
-        # いったん PDF としてパースを試す
-        try:
-            with fitz.open(stream=resp.content, filetype="pdf") as doc:
-                texts = [page.get_text("text") for page in doc]
-            return "\n".join(texts).strip()
-        except Exception as e:
-            logger.warning(
-                "Failed to parse PDF at %s (%s). Falling back to HTML extraction.",
-                url,
-                e,
-            )
-            # 実は HTML が返ってきている可能性が高いので HTML として再トライ
-            try:
-                return _extract_from_html_response(resp)
-            except Exception:
-                logger.exception("Fallback HTML extraction also failed for %s", url)
-                return ""
-
+        with _download(url) as (path, resp):
+            return _extract_pdf_or_html(url, path, resp)
     except Exception:
         logger.exception("Failed to fetch or parse PDF from %s", url)
         return ""